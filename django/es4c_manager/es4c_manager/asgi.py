@@ -2,6 +2,8 @@
 ASGI config for es4c_manager project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Besides Django, it serves the task state streams of main/events.py at
+/api/tasks/<task id>/stream/.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
@@ -13,4 +15,18 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "es4c_manager.settings")
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# imported only after django is set up by get_asgi_application
+from main.events import STREAM_PATH, task_events_app
+
+
+async def application(scope, receive, send):
+    """
+    Task state streams (Server-Sent Events) are served by a plain ASGI
+    application, so an idle watcher costs no thread. Every other request is
+    handled by Django.
+    """
+    if scope["type"] == "http" and STREAM_PATH.match(scope["path"]):
+        return await task_events_app(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -3,6 +3,7 @@ import os
 from django.conf import settings
 
 from celery import Celery
+import task_contract
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'es4c_manager.settings')
 
@@ -16,13 +17,45 @@ app = Celery(
         'ca_certs': '/opt/certificates/rabbitmq_cacert.pem',
         'cert_reqs': True
     },
-    include = ['main.tasks']
+    include = ['main.mail', 'main.campus'],
+    # refuse messages of newer task contracts (see task_contract)
+    task_cls = task_contract.ContractTask
 )
 
 app.conf.update(
-    BROKER_HEARTBEAT=10,
-    BROKER_HEARTBEAT_CHECKRATE=2.0,
-    CELERY_RESULT_EXPIRES=3600
+    broker_heartbeat=10,
+    broker_heartbeat_checkrate=2.0,
+    result_expires=3600,
+    # publish a task-sent event for every task, the first state shown by the
+    # task state streams (main/events.py). Events carry the argsrepr and
+    # kwargsrepr of the message, which main/tasks.py redacts (see
+    # task_contract), since some arguments are passwords
+    task_send_sent_event=True,
 )
 
+# e-mail tasks and the results reported by the campus workers are consumed
+# by the worker that runs in the django container (celery -A es4c_manager
+# worker -Q mail,results), never by the samba workers, which consume the
+# default queue and their campus queues.
+#
+# samba tasks are not routed here: the outbox relay (main/dispatchers.py)
+# publishes them to the samba exchanges, bulk jobs to the bulk ones, so
+# they are consumed by a separate worker of each campus and never delay
+# interactive operations.
+app.conf.task_routes = {
+    'mail.*': {'queue': 'mail'},
+    'campus.*': {'queue': 'results'},
+}
+
+# periodic tasks, run by the beat embedded in the worker of the django
+# container (celery -A es4c_manager worker -B)
+app.conf.beat_schedule = {}
+if settings.DIRECTORY_CHANGES_INTERVAL > 0:
+    app.conf.beat_schedule['poll-directory-changes'] = {
+        'task': 'campus.poll_directory_changes',
+        'schedule': settings.DIRECTORY_CHANGES_INTERVAL,
+        # a poll that could not run in time is replaced by the next one
+        'options': {'expires': settings.DIRECTORY_CHANGES_INTERVAL},
+    }
+
 app.autodiscover_tasks()
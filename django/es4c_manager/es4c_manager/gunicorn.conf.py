@@ -0,0 +1,43 @@
+"""
+Gunicorn configuration for es4c_manager in production.
+
+The number of worker processes follows the number of CPUs of the container
+(2 * CPUs + 1, as recommended by gunicorn) and each worker serves requests
+with a few threads, so the keep-alive connections that nginx keeps open to
+this upstream (see reverse-proxy/nginx.conf.template) are honoured. Every
+setting can be overridden through the environment.
+
+For more information on this file, see
+https://docs.gunicorn.org/en/stable/settings.html
+"""
+
+import multiprocessing
+import os
+
+bind = "0.0.0.0:8000"
+
+workers = int(os.environ.get("ES4C_MANAGER_WEB_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("ES4C_MANAGER_WEB_THREADS", "4"))
+worker_class = os.environ.get("ES4C_MANAGER_WEB_WORKER_CLASS", "gthread")
+
+# ASGI workers (e.g. uvicorn.workers.UvicornWorker) serve asgi.py, every
+# other worker class serves wsgi.py
+if "uvicorn" in worker_class.lower():
+    wsgi_app = "es4c_manager.asgi:application"
+else:
+    wsgi_app = "es4c_manager.wsgi:application"
+
+# must be longer than the idle timeout of the nginx upstream keep-alive
+# connections, otherwise gunicorn closes connections nginx is about to reuse
+keepalive = int(os.environ.get("ES4C_MANAGER_WEB_KEEPALIVE", "75"))
+timeout = int(os.environ.get("ES4C_MANAGER_WEB_TIMEOUT", "30"))
+
+# recycle workers from time to time to bound memory growth
+max_requests = 1000
+max_requests_jitter = 100
+
+# load the application once, before forking the workers
+preload_app = True
+
+accesslog = "-"
+errorlog = "-"
@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 from pathlib import Path
 
 import os
+import sys
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -25,7 +26,8 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = os.environ['DJANGO_SECRET_KEY']
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+# Besides exposing tracebacks, DEBUG keeps every SQL query in memory.
+DEBUG = os.environ.get('ES4C_MANAGER_DEBUG', 'false').lower() == 'true'
 
 
 # Application definition
@@ -78,12 +80,40 @@ WSGI_APPLICATION = "es4c_manager.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
-DATABASES = {
-    "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+#
+# SQLite is the default and is enough for small sites (it runs in WAL mode,
+# see main/signals.py). Set ES4C_MANAGER_DB_ENGINE=postgresql to use a
+# PostgreSQL server, with persistent connections that are checked before
+# being reused, when many users register and login concurrently.
+# docker-compose passes the variables that are not set as empty strings,
+# which fall back to the defaults as well.
+
+DATABASE_ENGINE = os.environ.get('ES4C_MANAGER_DB_ENGINE') or 'sqlite'
+
+if DATABASE_ENGINE == 'postgresql':
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": os.environ.get('ES4C_MANAGER_DB_NAME') or 'es4c_manager',
+            "USER": os.environ.get('ES4C_MANAGER_DB_USER') or 'es4c_manager',
+            "PASSWORD": os.environ.get('ES4C_MANAGER_DB_PASSWORD') or '',
+            "HOST": os.environ.get('ES4C_MANAGER_DB_HOST') or 'localhost',
+            "PORT": os.environ.get('ES4C_MANAGER_DB_PORT') or '5432',
+            "CONN_MAX_AGE": int(os.environ.get('ES4C_MANAGER_DB_CONN_MAX_AGE') or '600'),
+            "CONN_HEALTH_CHECKS": True,
+        }
+    }
+else:
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": BASE_DIR / "db.sqlite3",
+            "OPTIONS": {
+                # seconds a writer waits for the lock before failing
+                "timeout": 20,
+            },
+        }
     }
-}
 
 
 # Password validation
@@ -139,6 +169,12 @@ VERIFICATION_EMAIL_SETTINGS = {
     'smtp_port': os.environ['ES4C_MANAGER_SMTP_PORT'],
     'smtp_username': os.environ['ES4C_MANAGER_SMTP_USERNAME'],
     'smtp_password': os.environ['ES4C_MANAGER_SMTP_PASSWORD'],
+    # disable STARTTLS only to send to a local stand-in relay, e.g.
+    # python3 -m aiosmtpd -n -l localhost:8025
+    'smtp_use_tls': os.environ.get('ES4C_MANAGER_SMTP_USE_TLS', 'true').lower() == 'true',
+    # how many messages are sent through a single SMTP session before it is
+    # recycled, most relays limit it.
+    'smtp_session_max_messages': int(os.environ.get('ES4C_MANAGER_SMTP_SESSION_MAX_MESSAGES', '100')),
 }
 HOST_FQDN = os.environ['ES4C_MANAGER_HOST_FQDN']
 
@@ -150,6 +186,28 @@ CSRF_TRUSTED_ORIGINS = ['https://' + HOST_FQDN]
 CELERY_BROKER_URL = os.environ['ES4C_MANAGER_CELERY_BROKER_URL']
 CELERY_RESULT_BACKEND = os.environ['ES4C_MANAGER_CELERY_RESULT_BACKEND']
 
+# a campus worker is considered down when no heartbeat arrived for this many
+# seconds (samba workers send one every SAMBA_HEARTBEAT_INTERVAL seconds)
+CAMPUS_HEARTBEAT_TIMEOUT = int(os.environ.get('ES4C_MANAGER_CAMPUS_HEARTBEAT_TIMEOUT', '90'))
+
+# attribute updates of a user made within this many seconds are merged and
+# sent to the samba workers as a single task (see main/updates.py)
+ATTRIBUTE_UPDATE_DEBOUNCE = float(os.environ.get('ES4C_MANAGER_ATTRIBUTE_UPDATE_DEBOUNCE', '5'))
+
+# the outbox relay looks for samba tasks to publish (and for attribute
+# updates to send) every this many seconds, when it is idle (see the
+# relay_outbox command)
+OUTBOX_RELAY_INTERVAL = float(os.environ.get('ES4C_MANAGER_OUTBOX_RELAY_INTERVAL', '0.5'))
+
+# task journal rows are buffered and written in batches by a background
+# thread (see main/journal.py). The tests write them right away, since the
+# thread would write after their database is dropped
+TASK_JOURNAL_BUFFERED = sys.argv[1:2] != ['test']
+
+# changes made to the directories of the campuses (e.g. through RSAT) are
+# polled every this many seconds, 0 disables it (see main/campus.py)
+DIRECTORY_CHANGES_INTERVAL = float(os.environ.get('ES4C_MANAGER_DIRECTORY_CHANGES_INTERVAL', '60'))
+
 # Settings for production
 CSRF_COOKIE_SECURE = True
 SESSION_COOKIE_SECURE = True
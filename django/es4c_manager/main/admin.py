@@ -2,8 +2,14 @@ from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.models import Group
 from main.forms import CollegeUserRegistrationForm, CollegeUserChangeForm
-from main.models import CollegeUser
-from main.tasks import create_user, enable_account, update_user_attributes, delete_user
+from main.models import CollegeUser, Campus, TaskJournal, DirectoryDrift
+from main.tasks import create_user, delete_user
+from main.dispatchers import broadcast, dispatch_users_bulk
+from main.updates import queue_attribute_update
+from django.db import transaction
+from django.db.models import Q
+import re
+import uuid
 
 '''
     This file contains configuration to enable CollegeUserModel operations
@@ -17,6 +23,8 @@ from main.tasks import create_user, enable_account, update_user_attributes, dele
     so this file will be updated to perform those changes.
 '''
 
+JOB_ID = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
 class CollegeUserAdmin(BaseUserAdmin):
     form = CollegeUserChangeForm
     add_form = CollegeUserRegistrationForm
@@ -42,37 +50,154 @@ class CollegeUserAdmin(BaseUserAdmin):
         'date_joined', 
     )
 
-    def _create_user(self, username, password, **kwargs):
-        create_user.delay(username, password, **kwargs) # a call to a celery task for user creation
-        enable_account.delay(username) # a call to a celery task to enable a user account
-
-    def _update_user(self, username, **kwargs):
-        update_user_attributes.delay(username, **kwargs)
+    # the samba attributes of the user fields edited in the admin
+    samba_attributes = {
+        'first_name': 'givenName',
+        'last_name': 'sn',
+    }
 
-    # override save_model method to call celery tasks on samba container
+    # override save_model method to call celery tasks on samba container:
+    # a new user is created (enabled, if CollegeUser.samba_enabled) by a
+    # single create_user task and an edited one only has its changed
+    # attributes updated, if any, and its account enabled or disabled when
+    # is_active or is_verified changed.
+    # Tasks are written to the outbox in the transaction of the save, so a
+    # save that is rolled back sends nothing.
     def save_model(self, request, obj, form, change):
         super().save_model(request, obj, form, change)
-        user_fields = {
-            'first_name': form.cleaned_data['first_name'],
-            'last_name': form.cleaned_data['last_name'],
+        if not change:
+            broadcast(
+                create_user, obj.username, form.cleaned_data['password_1'],
+                first_name = obj.first_name,
+                last_name = obj.last_name,
+                enabled = obj.samba_enabled,
+            )
+            return
+        if {'is_active', 'is_verified'} & set(form.changed_data):
+            dispatch_users_bulk([obj.username], 'enable' if obj.samba_enabled else 'disable')
+        attributes = {
+            self.samba_attributes[field]: form.cleaned_data[field]
+            for field in form.changed_data
+            if field in self.samba_attributes
         }
-        if change:
-            self._update_user(obj.username, **user_fields)
-        self._create_user(obj.username, form.cleaned_data['password_1'], **user_fields)
+        if attributes:
+            # merged with other recent updates of the user (see
+            # main/updates.py)
+            queue_attribute_update(obj.username, **attributes)
 
     # override delete_model method to call celery tasks on samba container
     # to delete user from samba container
     def delete_model(self, request, obj):
         print('Here Hagrid!')
         super().delete_model(request, obj)
-        delete_user.delay(obj.username)
+        broadcast(delete_user, obj.username)
+
+    actions = ['enable_accounts', 'disable_accounts', 'force_password_reset']
+
+    def _dispatch_bulk(self, request, usernames, operation):
+        # the users are sent to the samba workers in chunks, as a job whose
+        # progress is listed in the task journal
+        job_id = str(uuid.uuid4())
+        dispatch_users_bulk(usernames, operation, job_id = job_id)
+        self.message_user(request, '{} of {} users sent to the samba servers as job {}. Search for it in the task journal to follow its progress.'.format(
+            operation.replace('_', ' ').capitalize(), len(usernames), job_id
+        ))
 
     # override delete_queryset method to call celery tasks on samba container
-    # for bulk deletion of users
+    # for bulk deletion of users: a single queryset delete in django and
+    # one samba task per chunk of users, instead of one of each per user
+    @transaction.atomic
     def delete_queryset(self, request, queryset):
-        for obj in queryset:
-            self.delete_model(request, obj)
+        usernames = list(queryset.values_list('username', flat = True))
+        super().delete_queryset(request, queryset)
+        self._dispatch_bulk(request, usernames, 'delete')
+
+    @admin.action(description = 'Enable selected users')
+    @transaction.atomic
+    def enable_accounts(self, request, queryset):
+        # users that did not verify their e-mail yet are enabled in samba
+        # when they do (see CollegeUser.samba_enabled)
+        usernames = list(queryset.filter(is_verified = True).values_list('username', flat = True))
+        queryset.update(is_active = True)
+        self._dispatch_bulk(request, usernames, 'enable')
+
+    @admin.action(description = 'Disable selected users')
+    @transaction.atomic
+    def disable_accounts(self, request, queryset):
+        usernames = list(queryset.values_list('username', flat = True))
+        queryset.update(is_active = False)
+        self._dispatch_bulk(request, usernames, 'disable')
+
+    @admin.action(description = 'Force selected users to change their password at next logon')
+    @transaction.atomic
+    def force_password_reset(self, request, queryset):
+        self._dispatch_bulk(request, list(queryset.values_list('username', flat = True)), 'force_password_reset')
+
+
+class CampusAdmin(admin.ModelAdmin):
+    '''
+        The campus registry: which campus workers are alive (they send
+        heartbeats periodically), how many messages are waiting in their
+        queues and when they were last seen.
+    '''
+    model = Campus
+    list_display = ('name', 'server_address', 'worker_hostname', 'is_alive', 'queue_depth', 'last_seen')
+    readonly_fields = ('worker_hostname', 'queue_depth', 'last_seen')
+
+    @admin.display(boolean=True)
+    def is_alive(self, obj):
+        return obj.is_alive
+
+class TaskJournalAdmin(admin.ModelAdmin):
+    '''
+        The task journal is read only and may hold millions of rows, so
+        the list only filters and searches on indexed columns (exact
+        username or task id, status) and skips counting the whole table.
+    '''
+    model = TaskJournal
+    list_display = ('created_at', 'operation', 'username', 'server_address', 'status', 'runtime', 'task_id')
+    list_filter = ('status',)
+    search_fields = ('=username', '=task_id')
+    ordering = ('-created_at',)
+    show_full_result_count = False
+    list_select_related = False
+
+    def get_search_results(self, request, queryset, search_term):
+        # the id of a bulk job (see dispatch_users_bulk) also finds the
+        # tasks of its chunks, <job id>-<n>, with a range on the indexed
+        # task_id ('.' follows '-')
+        if JOB_ID.fullmatch(search_term):
+            return queryset.filter(
+                Q(task_id = search_term) | Q(task_id__gt = search_term + '-', task_id__lt = search_term + '.')
+            ), False
+        return super().get_search_results(request, queryset, search_term)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+class DirectoryDriftAdmin(admin.ModelAdmin):
+    '''
+        The drifts found by the reconciliation runs (see the
+        reconcile_users command), read only.
+    '''
+    model = DirectoryDrift
+    list_display = ('created_at', 'run_id', 'server_address', 'username', 'kind', 'repaired', 'details')
+    list_filter = ('kind', 'repaired', 'server_address')
+    search_fields = ('=run_id', '=username')
+    ordering = ('-created_at',)
+    show_full_result_count = False
+
+    def has_add_permission(self, request):
+        return False
 
+    def has_change_permission(self, request, obj=None):
+        return False
 
 admin.site.register(CollegeUser, CollegeUserAdmin)
+admin.site.register(Campus, CampusAdmin)
+admin.site.register(TaskJournal, TaskJournalAdmin)
+admin.site.register(DirectoryDrift, DirectoryDriftAdmin)
 admin.site.unregister(Group)
@@ -0,0 +1,178 @@
+from django.utils import timezone
+from es4c_manager.celery import app
+from main.models import Campus, CollegeUser, DirectoryDrift, PendingAttributeUpdate
+from main.dispatchers import send_to_campus
+from main.tasks import user_changes
+from task_contract import normalize
+import task_contract
+from main.journal import journal_result
+
+'''
+    This file contains the celery tasks that samba workers send back to
+    django about their campus. Like the tasks in mail.py, they are routed to
+    a queue (`results`) consumed by the celery worker that runs in the
+    django container, so the views never wait for them.
+
+    Whenever a samba worker finishes an operation, it sends a
+    campus.record_result task with its own address, the outcome and the
+    timings, which are written to the task journal (see main/journal.py).
+
+    Campus workers also send a campus.heartbeat task periodically, which
+    keeps the registry of campus workers (the Campus model) up to date.
+
+    During a reconciliation run (see the reconcile_users command), they
+    send the drifts they find in batches, as campus.record_drift tasks.
+
+    Changes made to the directories by other means (RSAT, samba-tool) flow
+    back to the users through a change feed: every
+    DIRECTORY_CHANGES_INTERVAL seconds, celery beat runs
+    campus.poll_directory_changes, which asks each campus for the users
+    changed since the last USN (update sequence number) seen in its DC.
+    The campus answers with campus.apply_directory_changes tasks.
+'''
+
+@app.task(name = task_contract.record_result.name)
+@task_contract.record_result.implementation
+def record_result(task_id, task_name, server_address, status, result, started = None, finished = None, username = ''):
+    '''
+        Journal the result of an operation in one campus.
+
+        Parameters: task_id - the id of the operation
+                    task_name - the name of the task, e.g. tasks.create_user
+                    server_address - the address of the campus worker
+                    status - the celery state of the task in that campus
+                    result - the value returned by the task
+                    started, finished - unix timestamps of the task run
+                    username - the user the operation was about, if any
+    '''
+    journal_result(
+        task_id, task_name, server_address, status, result,
+        started = started, finished = finished, username = username
+    )
+    return 'Result of ' + task_id + ' recorded for ' + server_address
+
+@app.task(name = task_contract.heartbeat.name)
+@task_contract.heartbeat.implementation
+def heartbeat(server_address, worker_hostname, queue_depth):
+    '''
+        Register that the worker of a campus is alive. A campus that is not
+        registered yet is created, named after its address.
+
+        Parameters: server_address - the address of the campus worker
+                    worker_hostname - the hostname of the campus worker
+                    queue_depth - messages waiting in the campus queue
+    '''
+    updated = Campus.objects.filter(server_address = server_address).update(
+        worker_hostname = worker_hostname,
+        queue_depth = queue_depth,
+        last_seen = timezone.now(),
+    )
+    if not updated:
+        Campus.objects.create(
+            name = server_address,
+            server_address = server_address,
+            worker_hostname = worker_hostname,
+            queue_depth = queue_depth,
+            last_seen = timezone.now(),
+        )
+    return 'Heartbeat of ' + server_address + ' recorded'
+
+@app.task(name = task_contract.record_drift.name)
+@task_contract.record_drift.implementation
+def record_drift(run_id, server_address, drifts):
+    '''
+        Store a batch of drifts found by a campus in a reconciliation run.
+
+        Parameters: run_id - identifies the reconciliation run
+                    server_address - the address of the campus worker
+                    drifts - a list of (username, kind, details, repaired)
+    '''
+    campus = Campus.objects.filter(server_address = server_address).values_list('id', flat = True).first()
+    DirectoryDrift.objects.bulk_create([
+        DirectoryDrift(
+            run_id = run_id,
+            campus_id = campus,
+            server_address = server_address,
+            username = username,
+            kind = kind,
+            details = details,
+            repaired = repaired,
+        )
+        for username, kind, details, repaired in drifts
+    ])
+    return str(len(drifts)) + ' drifts of ' + run_id + ' recorded for ' + server_address
+
+@app.task(name='campus.poll_directory_changes')
+def poll_directory_changes():
+    '''
+        Ask every campus whose worker is alive for the users changed in its
+        directory since the last poll (see tasks.user_changes).
+    '''
+    polled = [
+        campus.server_address
+        for campus in Campus.objects.all()
+        if send_to_campus(user_changes, campus, since_usn = campus.changes_usn) is not None
+    ]
+    return 'Directory changes polled from ' + (', '.join(polled) or 'no campus')
+
+@app.task(name = task_contract.apply_directory_changes.name)
+@task_contract.apply_directory_changes.implementation
+def apply_directory_changes(server_address, changes, usn = None):
+    '''
+        Apply a page of the users changed in the directory of a campus.
+
+        Names changed in the directory are copied to the users (names
+        created by the samba workers have no accents, so names are compared
+        without them and only actual changes are copied), accounts enabled
+        or disabled in the directory activate or deactivate the users (see
+        CollegeUser.samba_enabled) and users deleted from the directory are
+        deactivated. Names with attribute updates on their way to samba
+        (see main/updates.py) are kept, since those updates are about to
+        replace them in the directory, but the other changes of their users
+        are applied.
+
+        Parameters: server_address - the address of the campus worker
+                    changes - a list of changed users, dictionaries with
+                              the keys username, first_name, last_name,
+                              enabled and deleted
+                    usn - the USN of the campus DC up to which changes were
+                          sent, only given with the last page
+    '''
+    usernames = [change['username'] for change in changes]
+    users = CollegeUser.objects.filter(username__in = usernames).in_bulk(field_name = 'username')
+    pending = dict(
+        PendingAttributeUpdate.objects.filter(username__in = usernames).values_list('username', 'attributes')
+    )
+    updated = []
+    for change in changes:
+        user = users.get(change['username'])
+        if user is None:
+            continue
+        changed = False
+        if change['deleted']:
+            changed = user.is_active
+            user.is_active = False
+        else:
+            pending_attributes = pending.get(user.username, {})
+            for field, attribute in (('first_name', 'givenName'), ('last_name', 'sn')):
+                value = change[field]
+                if attribute in pending_attributes:
+                    continue
+                if value and normalize(getattr(user, field)) != normalize(value):
+                    setattr(user, field, value)
+                    changed = True
+            if change['enabled'] != user.samba_enabled:
+                # an account enabled by the IT staff is taken as verified
+                if change['enabled']:
+                    user.is_active = user.is_verified = True
+                else:
+                    user.is_active = False
+                changed = True
+        if changed:
+            updated.append(user)
+    if updated:
+        CollegeUser.objects.bulk_update(updated, ['first_name', 'last_name', 'is_active', 'is_verified'])
+    if usn is not None:
+        # a DC restored from a backup may go back to a lower USN
+        Campus.objects.filter(server_address = server_address).update(changes_usn = usn)
+    return str(len(updated)) + ' users updated from ' + server_address
@@ -0,0 +1,287 @@
+from django.db import transaction
+from es4c_manager.celery import app
+from itertools import islice
+from kombu import Exchange, Queue, binding
+from main.models import Campus, OutboxMessage, TaskJournal
+from main.tasks import apply_to_users_bulk, create_users_bulk, samba_tasks
+from django.utils import timezone
+from task_contract import BULK_USER_OPERATIONS, ContractError
+import uuid
+
+'''
+    This file contains the functions that send user operations to the
+    samba workers.
+
+    Operations are not published by the request that makes them: they are
+    written to the outbox (the OutboxMessage model), in the same transaction
+    as the change they reflect, and the outbox relay (see the relay_outbox
+    command) publishes them, with publisher confirms, in batches. Requests
+    thus never wait for the broker, and an operation whose transaction was
+    committed is published at least once, even if the broker was down.
+
+    Operations are broadcast: they are published once to a fanout exchange
+    to which the queue of every campus worker is bound, so every DC applies
+    them in parallel. Each campus worker reports its result back to the
+    task journal (see main/campus.py), so the results can be collected per campus without
+    blocking the view that published the operation.
+
+    Operations can also target specific campuses (e.g. to re-sync a single
+    lagging DC) through the campus (direct) exchange, with the address of
+    the campus as routing key. Campuses whose worker stopped sending
+    heartbeats are skipped, instead of piling messages up in their queues.
+
+    Bulk jobs (the tasks with a bulk contract) are published through a
+    second pair of exchanges, bound to a second queue of each campus consumed by a worker
+    of its own, so they never delay interactive operations such as a
+    password change or an account activation.
+
+    Batches of users are sent in chunks. Instead of enqueueing one celery
+    message per user, which costs a broker round trip and a few LDAP
+    operations each, the users are grouped in chunks and each chunk is sent
+    as a single bulk task. With the default chunk size, importing N users
+    costs N/500 messages.
+'''
+
+# must match the exchanges declared by the samba workers
+# (samba/samba_user_management/celery.py)
+broadcast_exchange = Exchange('samba.broadcast', type = 'fanout')
+campus_exchange = Exchange('samba.campus', type = 'direct')
+bulk_broadcast_exchange = Exchange('samba.broadcast.bulk', type = 'fanout')
+bulk_campus_exchange = Exchange('samba.campus.bulk', type = 'direct')
+
+def is_bulk(task):
+    # tasks that handle many users at once, sent to the bulk queues (see
+    # the bulk flag of their contract in task_contract)
+    return task.bulk
+
+BULK_CHUNK_SIZE = 500
+
+def broadcast_route(task):
+    '''
+        Build the celery routing options that deliver a task to every
+        campus worker, through the interactive or the bulk exchange.
+    '''
+    exchange = bulk_broadcast_exchange if is_bulk(task) else broadcast_exchange
+    return {
+        'exchange': exchange,
+        'routing_key': '',
+        # without the type of the exchange, celery takes the one of the
+        # default queue (direct) and, as the routing key is empty, sends
+        # the message to that queue through the default exchange instead
+        'exchange_type': exchange.type,
+        'declare': [exchange],
+    }
+
+def enqueue(task, args, kwargs, server_address = '', task_id = None):
+    '''
+        Write a task to the outbox, to be published by the outbox relay to
+        the campus with the given address, or to every campus.
+
+        Returns: the AsyncResult of the task, whose id is known right away.
+    '''
+    # the arguments are checked now, instead of when the task is relayed
+    task.contract.message(args, kwargs)
+    task_id = task_id or str(uuid.uuid4())
+    OutboxMessage.objects.create(
+        task_id = task_id,
+        task_name = task.name,
+        args = list(args),
+        kwargs = kwargs,
+        server_address = server_address,
+    )
+    return app.AsyncResult(task_id)
+
+def broadcast(task, *args, **kwargs):
+    '''
+        Publish a task to every campus worker at once, through the outbox.
+
+        Parameters: task - the celery task, e.g. main.tasks.create_user
+                    args, kwargs - the arguments of the task
+
+        Returns: the AsyncResult of the operation. Its id identifies the
+                 results reported by each campus (see campus_results).
+    '''
+    return enqueue(task, args, kwargs)
+
+def campus_route(campus, bulk = False):
+    '''
+        Build the celery routing options that deliver a task to the queue
+        (the interactive or the bulk one) of a single campus. The queue is
+        declared with the same bindings used by the campus worker, so it
+        exists even before the worker starts.
+    '''
+    if bulk:
+        exchanges = (bulk_broadcast_exchange, bulk_campus_exchange)
+        queue_name = campus.queue_name + '.bulk'
+    else:
+        exchanges = (broadcast_exchange, campus_exchange)
+        queue_name = campus.queue_name
+    queue = Queue(queue_name, bindings = [
+        binding(exchanges[0]),
+        binding(exchanges[1], routing_key = campus.server_address),
+    ])
+    return {
+        'exchange': exchanges[1],
+        'routing_key': campus.server_address,
+        'declare': [queue],
+    }
+
+def send_to_campus(task, campus, *args, **kwargs):
+    '''
+        Publish a task to a single campus, if its worker is alive, through
+        the outbox.
+
+        Returns: the AsyncResult of the operation, or None if the campus
+                 was skipped because its worker is down.
+    '''
+    if not campus.is_alive:
+        print(f"Campus {campus} is down, skipping {task.name}")
+        return None
+    return enqueue(task, args, kwargs, server_address = campus.server_address)
+
+def send_to_campuses(task, *args, campuses = None, **kwargs):
+    '''
+        Publish a task to each one of the given campuses (every registered
+        campus by default) whose worker is alive.
+
+        Returns: a dictionary mapping the address of each campus to the
+                 AsyncResult of the operation, or None if it was skipped.
+    '''
+    if campuses is None:
+        campuses = Campus.objects.all()
+    return {
+        campus.server_address: send_to_campus(task, campus, *args, **kwargs)
+        for campus in campuses
+    }
+
+def campus_results(task_id):
+    '''
+        Returns: a dictionary mapping the address of each campus that
+                 already applied the operation to its state and result.
+    '''
+    return {
+        entry.server_address: (entry.status, entry.result)
+        for entry in TaskJournal.objects.filter(task_id = task_id).exclude(server_address = '').order_by('id')
+    }
+
+def task_belongs_to(task_id, username):
+    '''
+        Whether a samba task was sent for the given user, according to the
+        outbox (tasks not relayed yet) or the task journal.
+    '''
+    if TaskJournal.objects.filter(task_id = task_id, username = username).exists():
+        return True
+    return any(
+        message.args[:1] == [username]
+        for message in OutboxMessage.objects.filter(task_id = task_id).only('args')
+    )
+
+def chunked(iterable, size = BULK_CHUNK_SIZE):
+    '''
+        Yield lists with at most `size` items from any iterable (including
+        generators), without loading the whole iterable in memory.
+    '''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def user_record(user, password):
+    '''
+        Build the payload expected by the tasks.create_users_bulk task for
+        a CollegeUser and its plain text password.
+    '''
+    return {
+        'username': user.username,
+        'password': password,
+        'first_name': user.first_name,
+        'last_name': user.last_name,
+    }
+
+def dispatch_create_users_bulk(records, chunk_size = BULK_CHUNK_SIZE):
+    '''
+        Broadcast the given user records (see user_record) to the samba
+        workers in chunks of `chunk_size` users.
+
+        Returns: the list of AsyncResult objects, one per chunk sent.
+    '''
+    return [
+        broadcast(create_users_bulk, chunk)
+        for chunk in chunked(records, chunk_size)
+    ]
+
+def dispatch_users_bulk(usernames, operation, job_id = None, chunk_size = BULK_CHUNK_SIZE):
+    '''
+        Broadcast an operation (one of task_contract.BULK_USER_OPERATIONS,
+        e.g. 'delete') on the given usernames to the samba workers, in
+        chunks of `chunk_size` users.
+
+        The chunks are the tasks of a job and their ids are the id of the
+        job followed by the number of the chunk (<job id>-<n>), so the task
+        journal lists the progress of the whole job when searched by its id
+        (see TaskJournalAdmin).
+
+        Returns: the list of AsyncResult objects, one per chunk sent.
+    '''
+    if operation not in BULK_USER_OPERATIONS:
+        raise ValueError('Unknown bulk operation ' + operation)
+    job_id = job_id or str(uuid.uuid4())
+    return [
+        enqueue(apply_to_users_bulk, (chunk, operation), {}, task_id = '{}-{}'.format(job_id, number))
+        for number, chunk in enumerate(chunked(usernames, chunk_size), 1)
+    ]
+
+OUTBOX_BATCH_SIZE = 100
+
+def relay_outbox(connection, batch_size = OUTBOX_BATCH_SIZE):
+    '''
+        Publish a batch of outbox messages, oldest first, and delete them.
+
+        connection must be a broker connection with publisher confirms
+        (confirm_publish), so each message is only deleted once the broker
+        confirmed it. If publishing fails, the messages published so far
+        are deleted and the others stay in the outbox, so every message is
+        published at least once. Rows locked by another relay are skipped.
+
+        Messages that can never be published as they are (an unknown task,
+        arguments that break the task contract) are set aside, with their
+        error, so they do not block the outbox, and are skipped afterwards.
+
+        Returns: the number of messages published.
+    '''
+    published = []
+    failed = {}
+    try:
+        with transaction.atomic():
+            messages = OutboxMessage.objects.select_for_update(skip_locked = True).filter(
+                failed_at__isnull = True
+            ).order_by('id')[:batch_size]
+            for message in messages:
+                try:
+                    task = samba_tasks.get(message.task_name)
+                    if task is None:
+                        raise ContractError(f"Unknown task {message.task_name}")
+                    if message.server_address:
+                        route = campus_route(Campus(server_address = message.server_address), bulk = is_bulk(task))
+                    else:
+                        route = broadcast_route(task)
+                    task.apply_async(
+                        message.args,
+                        message.kwargs,
+                        task_id = message.task_id,
+                        connection = connection,
+                        **route
+                    )
+                except ContractError as e:
+                    failed[message.id] = str(e)
+                    continue
+                published.append(message.id)
+    finally:
+        if published:
+            OutboxMessage.objects.filter(id__in = published).delete()
+        for id, error in failed.items():
+            print(f"Outbox message {id} set aside: {error}")
+            OutboxMessage.objects.filter(id = id).update(failed_at = timezone.now(), error = error)
+    return len(published)
@@ -0,0 +1,207 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY, get_user_model
+from django.db import connection
+from es4c_manager.celery import app
+from http.cookies import SimpleCookie
+from importlib import import_module
+from main.models import Campus, TaskJournal
+from main.views import may_watch_task
+import asyncio
+import json
+import re
+import threading
+import time
+
+'''
+    This file streams the state changes of celery tasks to browsers through
+    Server-Sent Events, e.g. so the verify e-mail page can tell the user
+    when its account was created in each campus.
+
+    The states come from celery events (task-sent, task-started,
+    task-succeeded, ...), which the workers publish to the broker. A single
+    TaskEventHub per process consumes them in a background thread and hands
+    each event to the watchers of its task, so there are no broker queries
+    per request and watchers only hold an asyncio queue, not a thread. The
+    stream is served by task_events_app, a plain ASGI application mounted by
+    es4c_manager/asgi.py at /api/tasks/<task id>/stream/, so one process can
+    hold thousands of idle watchers.
+'''
+
+STREAM_PATH = re.compile(r'^/api/tasks/(?P<task_id>[0-9a-fA-F-]{1,64})/stream/$')
+
+# how long a stream is kept open and how often a keep-alive comment is sent
+STREAM_TIMEOUT = 300
+KEEPALIVE_INTERVAL = 15
+
+EVENT_STATES = {
+    'task-sent': 'PENDING',
+    'task-received': 'RECEIVED',
+    'task-started': 'STARTED',
+    'task-succeeded': 'SUCCESS',
+    'task-failed': 'FAILURE',
+    'task-retried': 'RETRY',
+    'task-rejected': 'REJECTED',
+    'task-revoked': 'REVOKED',
+}
+
+class TaskEventHub:
+    '''
+        Consume celery task events and dispatch them to the asyncio queues
+        of the watchers of each task.
+    '''
+    def __init__(self, celery_app):
+        self.app = celery_app
+        self._watchers = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._campuses = {}
+        self._campuses_loaded = 0
+
+    def _campus_of(self, hostname):
+        # events carry the node name of the worker (celery@<hostname>),
+        # while the journal and the page identify campuses by address
+        if not hostname or '@' not in hostname:
+            return ''
+        hostname = hostname.split('@', 1)[1]
+        if hostname not in self._campuses and time.monotonic() - self._campuses_loaded > 60:
+            try:
+                self._campuses = dict(Campus.objects.values_list('worker_hostname', 'server_address'))
+            except Exception as e:
+                print(f"Could not load the campuses: {e}")
+            finally:
+                connection.close()
+            self._campuses_loaded = time.monotonic()
+        return self._campuses.get(hostname, '')
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target = self._run, daemon = True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.connection_for_read() as connection:
+                    receiver = self.app.events.Receiver(connection, handlers = {'*': self._dispatch})
+                    receiver.capture(limit = None, timeout = None, wakeup = False)
+            except Exception as e:
+                print(f"Task event receiver disconnected, reconnecting: {e}")
+                time.sleep(5)
+
+    def _dispatch(self, event):
+        state = EVENT_STATES.get(event.get('type'))
+        if state is None:
+            return
+        with self._lock:
+            watchers = list(self._watchers.get(event.get('uuid'), ()))
+        if not watchers:
+            return
+        message = {
+            'state': state,
+            'campus': self._campus_of(event.get('hostname')),
+            'result': event.get('result') or event.get('exception'),
+        }
+        for loop, queue in watchers:
+            loop.call_soon_threadsafe(queue.put_nowait, message)
+
+    def subscribe(self, task_id):
+        self.start()
+        watcher = (asyncio.get_running_loop(), asyncio.Queue())
+        with self._lock:
+            self._watchers.setdefault(task_id, set()).add(watcher)
+        return watcher
+
+    def unsubscribe(self, task_id, watcher):
+        with self._lock:
+            watchers = self._watchers.get(task_id, set())
+            watchers.discard(watcher)
+            if not watchers:
+                self._watchers.pop(task_id, None)
+
+hub = TaskEventHub(app)
+
+def _may_watch(scope, task_id):
+    '''
+        Whether the session of the request belongs to a user that may watch
+        the task: users only watch their own tasks.
+    '''
+    cookies = SimpleCookie()
+    for name, value in scope.get('headers', ()):
+        if name == b'cookie':
+            cookies.load(value.decode('latin-1'))
+    session_key = cookies.get(settings.SESSION_COOKIE_NAME)
+    if session_key is None:
+        return False
+    SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
+    session = SessionStore(session_key = session_key.value)
+    if SESSION_KEY not in session:
+        return False
+    user = get_user_model().objects.filter(pk = session[SESSION_KEY]).first()
+    return user is not None and may_watch_task(session, user, task_id)
+
+def _journal_snapshot(task_id):
+    return [
+        {'state': status, 'campus': server_address, 'result': result}
+        for server_address, status, result in TaskJournal.objects.filter(task_id = task_id)
+        .order_by('id').values_list('server_address', 'status', 'result')
+    ]
+
+async def _wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+def _sse(message):
+    return ('data: ' + json.dumps(message) + '\n\n').encode('utf-8')
+
+async def task_events_app(scope, receive, send):
+    '''
+        ASGI application that streams the state changes of a task as
+        Server-Sent Events. The journal of the task is sent first, so a
+        watcher that connects after the task ran still learns its result.
+    '''
+    task_id = STREAM_PATH.match(scope['path']).group('task_id')
+    if not await sync_to_async(_may_watch)(scope, task_id):
+        await send({'type': 'http.response.start', 'status': 403, 'headers': [(b'content-type', b'text/plain')]})
+        await send({'type': 'http.response.body', 'body': b'Forbidden'})
+        return
+
+    watcher = hub.subscribe(task_id)
+    queue = watcher[1]
+    disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                # ask nginx not to buffer the stream
+                (b'x-accel-buffering', b'no'),
+            ],
+        })
+        for message in await sync_to_async(_journal_snapshot)(task_id):
+            await send({'type': 'http.response.body', 'body': _sse(message), 'more_body': True})
+
+        deadline = time.monotonic() + STREAM_TIMEOUT
+        while time.monotonic() < deadline:
+            next_message = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait(
+                {next_message, disconnected},
+                timeout = KEEPALIVE_INTERVAL,
+                return_when = asyncio.FIRST_COMPLETED
+            )
+            if disconnected in done:
+                next_message.cancel()
+                return
+            if next_message in done:
+                body = _sse(next_message.result())
+            else:
+                next_message.cancel()
+                body = b': keep-alive\n\n'
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnected.cancel()
+        hub.unsubscribe(task_id, watcher)
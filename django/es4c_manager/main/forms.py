@@ -66,6 +66,14 @@ def _clean_password_1(password, email):
         raise ValidationError('Password must not contain email or username.')
     return password
 
+def _clean_email(email):
+    domain = email.split('@')[1]
+    for allowed_domain in settings.ALLOWED_EMAIL_DOMAINS:
+        if re.match(allowed_domain, domain):
+            return email
+    error = 'Email domain must be one of the following: ' + ', '.join(settings.ALLOWED_EMAIL_DOMAINS)
+    raise ValidationError(error)
+
 class CollegeUserLoginForm(forms.Form):
     username = forms.CharField(
         label = 'Username',
@@ -123,12 +131,7 @@ class CollegeUserRegistrationForm(forms.ModelForm):
             informs the user about the allowed email domains.
         '''
         email = self.cleaned_data['email']
-        domain = email.split('@')[1]
-        for allowed_domain in settings.ALLOWED_EMAIL_DOMAINS:
-            if re.match(allowed_domain, domain):
-                return email
-        error = 'Email domain must be one of the following: ' + ', '.join(settings.ALLOWED_EMAIL_DOMAINS)
-        raise ValidationError(error)
+        return _clean_email(email)
 
     def clean_password_1(self):
         '''
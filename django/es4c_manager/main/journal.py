@@ -0,0 +1,194 @@
+from celery.signals import after_task_publish, task_prerun, task_success, task_failure, worker_process_shutdown, worker_shutdown
+from django.conf import settings
+from django.db import connection
+from datetime import datetime, timezone as dt_timezone
+from main.models import Campus, TaskJournal
+import atexit
+import os
+import threading
+import time
+
+'''
+    This file writes the task journal (the TaskJournal model).
+
+    Rows come from celery signals:
+        - after_task_publish: a row with the PUBLISHED status for every
+          samba task that django publishes (views, admin, dispatchers);
+        - task_success / task_failure: a row for every task run by the
+          celery worker of the django container (e.g. mail tasks);
+        - campus.record_result (see main/campus.py): a row for every task
+          run by a samba worker, with its campus, status and timings.
+
+    Writing a row per signal would add an INSERT to every request that
+    publishes a task, so rows are buffered in memory by a JournalWriter and
+    written by a background thread with a single bulk_create per batch.
+    The rows still buffered are written when the process exits, including
+    celery worker processes.
+    Task arguments are never journaled, since some of them are passwords:
+    only the username (the first argument of the user tasks) is kept.
+'''
+
+# tasks that are part of the journaling itself are not journaled
+UNJOURNALED_PREFIXES = ('campus.',)
+
+class JournalWriter:
+    '''
+        Buffer TaskJournal rows and insert them in batches, from a
+        background thread, every `flush_interval` seconds or as soon as
+        `batch_size` rows are waiting. Unless `buffered`, rows are inserted
+        right away.
+    '''
+    def __init__(self, batch_size = 500, flush_interval = 2.0, buffered = True):
+        self.batch_size = batch_size
+        self.buffered = buffered
+        self.flush_interval = flush_interval
+        self._rows = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_thread(self):
+        # threads do not survive a fork (gunicorn and celery prefork
+        # workers), so each process starts its own
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._rows = []
+            self._thread = threading.Thread(target = self._run, daemon = True)
+            self._thread.start()
+
+    def add(self, **fields):
+        if not self.buffered:
+            TaskJournal.objects.create(**fields)
+            return
+        with self._lock:
+            self._ensure_thread()
+            self._rows.append(TaskJournal(**fields))
+            if len(self._rows) >= self.batch_size:
+                self._wake.set()
+
+    def flush(self):
+        with self._lock:
+            # rows copied from the parent by a fork are the parent's to write
+            if self._pid != os.getpid():
+                return
+            rows, self._rows = self._rows, []
+        if not rows:
+            return
+        try:
+            TaskJournal.objects.bulk_create(rows, batch_size = self.batch_size)
+        except Exception as e:
+            print(f"Could not write {len(rows)} task journal rows: {e}")
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+            # do not keep a connection that may have been closed by the server
+            connection.close_if_unusable_or_obsolete()
+
+journal = JournalWriter(buffered = settings.TASK_JOURNAL_BUFFERED)
+atexit.register(journal.flush)
+
+# celery prefork children leave through os._exit, which skips atexit, when
+# they are recycled or the worker stops
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def flush_journal(**kwargs):
+    journal.flush()
+
+class CampusCache:
+    '''
+        Map campus addresses to their ids without a query per row. The
+        table is small and rarely changes, so it is reloaded at most once
+        every `ttl` seconds.
+    '''
+    def __init__(self, ttl = 60):
+        self.ttl = ttl
+        self._ids = {}
+        self._loaded = 0
+
+    def get(self, server_address):
+        if not server_address:
+            return None
+        if time.monotonic() - self._loaded > self.ttl:
+            self._ids = dict(Campus.objects.values_list('server_address', 'id'))
+            self._loaded = time.monotonic()
+        return self._ids.get(server_address)
+
+campus_ids = CampusCache()
+
+def _username(args):
+    # the user tasks receive the username as their first argument, bulk
+    # tasks receive a list of records instead
+    if args and isinstance(args[0], str):
+        return args[0][:40]
+    return ''
+
+def _timestamp(value):
+    if value is None:
+        return None
+    return datetime.fromtimestamp(value, tz = dt_timezone.utc)
+
+def journal_result(task_id, operation, server_address, status, result, started = None, finished = None, username = ''):
+    '''
+        Journal the outcome of a task in a campus (or in django's worker,
+        when server_address is empty). started and finished are unix
+        timestamps.
+    '''
+    journal.add(
+        task_id = task_id,
+        operation = operation,
+        username = username,
+        campus_id = campus_ids.get(server_address),
+        server_address = server_address,
+        status = status,
+        result = result,
+        started_at = _timestamp(started),
+        finished_at = _timestamp(finished),
+        runtime = finished - started if started is not None and finished is not None else None,
+    )
+
+@after_task_publish.connect
+def journal_publish(sender = None, headers = None, body = None, exchange = None, routing_key = None, **kwargs):
+    if sender is None or sender.startswith(UNJOURNALED_PREFIXES):
+        return
+    # with celery's message protocol 2, the body is (args, kwargs, embed)
+    args = body[0] if isinstance(body, (list, tuple)) and body else ()
+    # only operations targeted at one campus have a known campus
+    server_address = routing_key if getattr(exchange, 'name', exchange) in ('samba.campus', 'samba.campus.bulk') else ''
+    journal.add(
+        task_id = headers['id'],
+        operation = sender,
+        username = _username(args),
+        server_address = server_address,
+        campus_id = campus_ids.get(server_address),
+        status = TaskJournal.PUBLISHED,
+    )
+
+_started = {}
+
+@task_prerun.connect
+def journal_start(task_id = None, task = None, **kwargs):
+    if task.name.startswith(UNJOURNALED_PREFIXES):
+        return
+    _started[task_id] = time.time()
+
+@task_success.connect
+def journal_success(sender = None, result = None, **kwargs):
+    if sender.name.startswith(UNJOURNALED_PREFIXES):
+        return
+    journal_result(
+        sender.request.id, sender.name, '', 'SUCCESS', str(result),
+        started = _started.pop(sender.request.id, None), finished = time.time()
+    )
+
+@task_failure.connect
+def journal_failure(sender = None, task_id = None, exception = None, **kwargs):
+    if sender.name.startswith(UNJOURNALED_PREFIXES):
+        return
+    journal_result(
+        task_id, sender.name, '', 'FAILURE', repr(exception),
+        started = _started.pop(task_id, None), finished = time.time()
+    )
@@ -0,0 +1,61 @@
+from celery.utils.time import get_exponential_backoff_interval
+from es4c_manager.celery import app
+from main.models import CollegeUser
+from main.utils import send_email_verification_token
+import smtplib
+
+'''
+    This file contains the celery tasks that send e-mails to the end users.
+
+    Unlike the tasks in tasks.py, these tasks are not run by the samba
+    workers: they are routed to the `mail` queue (see es4c_manager/celery.py),
+    which is consumed by a celery worker that runs in the django container.
+    This way the registration view only has to enqueue a message after the
+    user is saved, instead of waiting for the SMTP relay.
+
+    Every worker process keeps a single SMTP session open (see
+    main.utils.SMTPSession), so many messages are sent per session.
+'''
+
+def is_transient_smtp_error(error):
+    '''
+        Whether sending again later may succeed: the relay dropped the
+        connection, could not be reached or answered with a 4xx (temporary)
+        code. Refused recipients, failed logins and other 5xx answers fail
+        the same way every time.
+    '''
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    # the other smtplib errors (e.g. SMTPNotSupportedError) are permanent,
+    # socket errors (a refused or timed out connection) are not
+    return not isinstance(error, smtplib.SMTPException)
+
+@app.task(name = 'mail.send_verification_email', bind = True, max_retries = 5)
+def send_verification_email(self, user_id):
+    '''
+        A task that sends the verification token to the e-mail of a user.
+        Transient failures are retried with exponential backoff, the others
+        fail the task right away.
+
+        Parameters: user_id - the primary key of the CollegeUser
+
+        Returns: 'Verification e-mail sent to <email>' or a message telling
+                 that the user no longer exists.
+    '''
+    try:
+        user = CollegeUser.objects.get(pk = user_id)
+    except CollegeUser.DoesNotExist:
+        return 'User ' + str(user_id) + ' does not exist'
+    try:
+        send_email_verification_token(user)
+    except OSError as e:
+        if not is_transient_smtp_error(e):
+            raise
+        raise self.retry(exc = e, countdown = get_exponential_backoff_interval(
+            factor = 1, retries = self.request.retries, maximum = 600, full_jitter = True
+        ))
+    return 'Verification e-mail sent to ' + user.email
@@ -0,0 +1,97 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+from main.models import CollegeUser
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+import statistics
+import time
+import uuid
+
+'''
+    bench_concurrency is a load benchmark of the database backend. It runs
+    `--users` virtual users in `--concurrency` threads and each of them
+    registers itself (register view), verifies its e-mail (verify_email
+    view), logs out and logs in again (login_view). The p50 and p99
+    latencies of each view are reported for the database backend that is
+    configured (see DATABASES in settings.py), so running it once with
+    ES4C_MANAGER_DB_ENGINE=sqlite and once with postgresql compares both.
+
+    Celery messages are not published, nor samba tasks written to the
+    outbox, during the benchmark (so no broker is needed) and, unless --real-hasher is given, passwords are hashed
+    with a cheap hasher, otherwise the hashing cost would hide the cost of
+    the database. The users created are deleted at the end.
+
+    Usage:
+        python3 manage.py bench_concurrency --users 200 --concurrency 16
+'''
+
+PASSWORD = 'Bench-Passw0rd!'
+
+def percentile(samples, percent):
+    if len(samples) < 2:
+        return samples[0] if samples else 0
+    return statistics.quantiles(samples, n = 100, method = 'inclusive')[percent - 1]
+
+class Command(BaseCommand):
+    help = 'Measure register, login and verify_email latencies under concurrency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type = int, default = 200, help = 'virtual users')
+        parser.add_argument('--concurrency', type = int, default = 16, help = 'threads running the virtual users')
+        parser.add_argument('--email-domain', default = None, help = 'an allowed e-mail domain, guessed from ALLOWED_EMAIL_DOMAINS if omitted')
+        parser.add_argument('--real-hasher', action = 'store_true', help = 'hash passwords with the configured hashers')
+
+    def handle(self, *args, **options):
+        domain = options['email_domain'] or settings.ALLOWED_EMAIL_DOMAINS[0].replace('\\', '')
+        prefix = 'bench' + uuid.uuid4().hex[:8]
+        latencies = {'register': [], 'verify_email': [], 'login_view': []}
+
+        def virtual_user(number):
+            client = Client(HTTP_HOST = settings.HOST_FQDN)
+            username = '{}{}'.format(prefix, number)
+            try:
+                start = time.perf_counter()
+                client.post('/register/', {
+                    'username': username,
+                    'email': username + '@' + domain,
+                    'first_name': 'Bench',
+                    'last_name': 'User',
+                    'password_1': PASSWORD,
+                    'password_2': PASSWORD,
+                }, secure = True)
+                latencies['register'].append(time.perf_counter() - start)
+
+                token = CollegeUser.objects.values_list('verification_token', flat = True).get(username = username)
+                start = time.perf_counter()
+                client.get('/verify-email/{}/'.format(token), secure = True)
+                latencies['verify_email'].append(time.perf_counter() - start)
+
+                client.logout()
+                start = time.perf_counter()
+                client.post('/login/', {'username': username, 'password': PASSWORD}, secure = True)
+                latencies['login_view'].append(time.perf_counter() - start)
+            finally:
+                connection.close()
+
+        hashers = settings.PASSWORD_HASHERS if options['real_hasher'] else ['django.contrib.auth.hashers.MD5PasswordHasher']
+        start = time.perf_counter()
+        try:
+            with override_settings(PASSWORD_HASHERS = hashers), \
+                    mock.patch('celery.app.task.Task.apply_async'), \
+                    mock.patch('celery.Celery.send_task'), \
+                    mock.patch('main.dispatchers.OutboxMessage'):
+                with ThreadPoolExecutor(max_workers = options['concurrency']) as executor:
+                    list(executor.map(virtual_user, range(options['users'])))
+        finally:
+            CollegeUser.objects.filter(username__startswith = prefix).delete()
+        elapsed = time.perf_counter() - start
+
+        self.stdout.write('backend: {} ({} users, {} threads, {:.1f}s)'.format(
+            connection.vendor, options['users'], options['concurrency'], elapsed
+        ))
+        for view, samples in latencies.items():
+            self.stdout.write('{:<14} p50 {:>8.1f} ms   p99 {:>8.1f} ms   ({} requests)'.format(
+                view, percentile(samples, 50) * 1000, percentile(samples, 99) * 1000, len(samples)
+            ))
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from main.utils import email_body_md, render_email_body
+import markdown as md
+import timeit
+
+'''
+    bench_email_render is a micro-benchmark of the verification e-mail body
+    rendering. It compares the per-message cost of converting the whole
+    markdown template for every user (how the e-mails used to be rendered)
+    with filling the HTML template compiled once at import time.
+
+    Usage:
+        python3 manage.py bench_email_render --messages 10000
+'''
+
+def render_with_markdown(name, link, token):
+    return md.markdown(
+        email_body_md.format(name = name, link = link, token = token)
+    )
+
+class Command(BaseCommand):
+    help = 'Measure the per-message cost of rendering the verification e-mail body'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type = int, default = 10000, help = 'messages rendered per measurement')
+        parser.add_argument('--repeat', type = int, default = 3, help = 'measurements taken, the best one is reported')
+
+    def handle(self, *args, **options):
+        arguments = ('Maria da Silva', 'https://example.org/verify-email/12345678', '12345678')
+        for label, render in (
+            ('markdown per message', render_with_markdown),
+            ('compiled template', render_email_body),
+        ):
+            best = min(timeit.repeat(
+                lambda: render(*arguments),
+                number = options['messages'],
+                repeat = options['repeat']
+            ))
+            self.stdout.write('{:<22} {:>10.2f} us/message'.format(
+                label, best / options['messages'] * 1e6
+            ))
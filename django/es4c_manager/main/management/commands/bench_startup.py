@@ -0,0 +1,67 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+import json
+import statistics
+import subprocess
+import sys
+
+'''
+    bench_startup measures what starting a web process costs: the time to
+    import the django app and everything its URLs need (views, admin,
+    tasks, ...), as a gunicorn worker does before serving its first
+    request, and the memory (maximum resident set size) of the process
+    afterwards. Each run is a fresh python interpreter, so nothing is
+    cached between runs, and the median of `--runs` runs is reported,
+    along with the number of modules loaded and whether the samba python
+    library was among them.
+
+    Running it before and after a change to the imports (e.g. on two
+    checkouts) compares them.
+
+    Usage:
+        python3 manage.py bench_startup --runs 10
+'''
+
+STARTUP = '''
+import json, os, resource, sys, time
+start = time.perf_counter()
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'es4c_manager.settings')
+import django
+django.setup()
+from django.urls import get_resolver
+get_resolver().url_patterns
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    'seconds': elapsed,
+    'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'modules': len(sys.modules),
+    'samba': any(name == 'samba' or name.startswith(('samba.', 'ldb')) for name in sys.modules),
+}))
+'''
+
+class Command(BaseCommand):
+    help = 'Measure the import time and memory of a fresh web process'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type = int, default = 10, help = 'fresh processes started')
+
+    def handle(self, *args, **options):
+        runs = []
+        for _ in range(options['runs']):
+            output = subprocess.run(
+                [sys.executable, '-c', STARTUP],
+                cwd = settings.BASE_DIR,
+                capture_output = True,
+                text = True,
+                check = True
+            ).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+
+        self.stdout.write('import time: {:.1f} ms (median of {} runs)'.format(
+            statistics.median(run['seconds'] for run in runs) * 1000, len(runs)
+        ))
+        self.stdout.write('max RSS:     {:.1f} MB'.format(
+            statistics.median(run['max_rss_kb'] for run in runs) / 1024
+        ))
+        self.stdout.write('modules:     {}'.format(runs[-1]['modules']))
+        self.stdout.write('samba:       {}'.format('loaded' if runs[-1]['samba'] else 'not loaded'))
@@ -0,0 +1,208 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.db.models import Q
+from main.models import CollegeUser
+from main.forms import _clean_password_1, _clean_email
+from main.utils import generate_secure_otp
+from main.dispatchers import chunked, user_record, dispatch_create_users_bulk, BULK_CHUNK_SIZE
+import base64
+import csv
+import time
+
+'''
+    import_users is a management command that imports users from a CSV or
+    an LDIF file into Django and into the samba addc servers.
+
+    The file is read through generators, one row at a time, and the rows
+    are handled in batches: each batch is validated with the same rules
+    used by the registration form, inserted through a single bulk_create
+    and sent to the samba workers as create_users_bulk tasks. This way the
+    memory used by the command does not depend on the size of the file.
+
+    CSV files must have a header with the columns username, email,
+    first_name, last_name and password. LDIF records are read from the
+    sAMAccountName (or uid), mail, givenName, sn and userPassword
+    attributes.
+
+    Usage:
+        python3 manage.py import_users students.csv --batch-size 1000
+'''
+
+LDIF_ATTRIBUTES = {
+    'samaccountname': 'username',
+    'uid': 'username',
+    'mail': 'email',
+    'givenname': 'first_name',
+    'sn': 'last_name',
+    'userpassword': 'password',
+}
+
+def read_csv(stream, delimiter = ','):
+    for row in csv.DictReader(stream, delimiter = delimiter):
+        yield {key.strip(): (value or '').strip() for key, value in row.items() if key}
+
+def _ldif_lines(stream):
+    # join folded lines (the ones starting with a single space) to the
+    # line they continue
+    current = None
+    for line in stream:
+        line = line.rstrip('\r\n')
+        if line.startswith(' ') and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current is not None:
+        yield current
+
+def read_ldif(stream):
+    record = {}
+    for line in _ldif_lines(stream):
+        if not line.strip():
+            if record:
+                yield record
+            record = {}
+            continue
+        if line.startswith('#') or ':' not in line:
+            continue
+        attribute, value = line.split(':', 1)
+        if value.startswith(':'):
+            value = base64.b64decode(value[1:].strip()).decode('utf-8')
+        field = LDIF_ATTRIBUTES.get(attribute.strip().lower())
+        if field:
+            record[field] = value.strip()
+    if record:
+        yield record
+
+def validate_row(row):
+    '''
+        Validate a row with the same rules used by CollegeUserRegistrationForm,
+        plus the lengths of the CollegeUser fields, so one row cannot abort
+        the bulk_create of its batch. The email of the row is normalized as
+        it is stored. Raises ValidationError if the row is not valid.
+    '''
+    for field in ('username', 'email', 'first_name', 'last_name', 'password'):
+        if not row.get(field):
+            raise ValidationError(field + ' is required.')
+    for field in ('username', 'email', 'first_name', 'last_name'):
+        max_length = CollegeUser._meta.get_field(field).max_length
+        if len(row[field]) > max_length:
+            raise ValidationError('{} is longer than {} characters.'.format(field, max_length))
+    row['email'] = CollegeUser.objects.normalize_email(row['email'])
+    validate_email(row['email'])
+    _clean_email(row['email'])
+    _clean_password_1(row['password'], row['email'])
+
+def unique_verification_tokens(count):
+    '''
+        Generate `count` verification tokens that are unique among
+        themselves and among the tokens already stored in the database.
+    '''
+    tokens = set()
+    while len(tokens) < count:
+        candidates = {generate_secure_otp() for _ in range(count - len(tokens))} - tokens
+        taken = set(
+            CollegeUser.objects.filter(verification_token__in = candidates)
+            .values_list('verification_token', flat = True)
+        )
+        tokens |= candidates - taken
+    return list(tokens)
+
+class Command(BaseCommand):
+    help = 'Import users from a CSV or LDIF file into Django and the samba addc servers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help = 'CSV or LDIF file to import')
+        parser.add_argument('--format', choices = ['csv', 'ldif'], help = 'file format, guessed from the extension if omitted')
+        parser.add_argument('--delimiter', default = ',', help = 'CSV delimiter')
+        parser.add_argument('--batch-size', type = int, default = BULK_CHUNK_SIZE, help = 'rows inserted (and sent to samba) per batch')
+        parser.add_argument('--no-samba', action = 'store_true', help = 'only import users into Django')
+
+    def handle(self, *args, **options):
+        file_format = options['format'] or ('ldif' if options['path'].lower().endswith('.ldif') else 'csv')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be a positive number')
+
+        imported = skipped = invalid = 0
+        start = time.monotonic()
+        try:
+            stream = open(options['path'], newline = '', encoding = 'utf-8')
+        except OSError as e:
+            raise CommandError(e)
+        with stream:
+            rows = read_csv(stream, options['delimiter']) if file_format == 'csv' else read_ldif(stream)
+            for number, batch in enumerate(chunked(rows, options['batch_size'])):
+                valid_rows = []
+                for row in batch:
+                    try:
+                        validate_row(row)
+                        valid_rows.append(row)
+                    except ValidationError as e:
+                        invalid += 1
+                        self.stderr.write('Invalid row for user {}: {}'.format(row.get('username', '?'), ' '.join(e.messages)))
+                created, duplicated = self._import_batch(valid_rows, options)
+                imported += created
+                skipped += duplicated
+                elapsed = time.monotonic() - start
+                self.stdout.write('Batch {}: {} imported, {} skipped, {} invalid ({:.1f} rows/s)'.format(
+                    number + 1, imported, skipped, invalid,
+                    (imported + skipped + invalid) / elapsed if elapsed else 0
+                ))
+
+        elapsed = time.monotonic() - start
+        self.stdout.write(self.style.SUCCESS(
+            'Imported {} users in {:.1f}s ({:.1f} rows/s), {} skipped, {} invalid'.format(
+                imported, elapsed,
+                (imported + skipped + invalid) / elapsed if elapsed else 0,
+                skipped, invalid
+            )
+        ))
+
+    def _import_batch(self, rows, options):
+        '''
+            Insert the rows that are not yet in the database and send them
+            to the samba workers. Returns how many rows were imported and
+            how many were skipped for being duplicated.
+        '''
+        if not rows:
+            return 0, 0
+        existing = list(CollegeUser.objects.filter(
+            Q(username__in = [row['username'] for row in rows]) |
+            Q(email__in = [row['email'] for row in rows])
+        ).values_list('username', 'email'))
+        seen_usernames = {username for username, _ in existing}
+        seen_emails = {email for _, email in existing}
+
+        new_rows = []
+        for row in rows:
+            if row['username'] in seen_usernames or row['email'] in seen_emails:
+                continue
+            seen_usernames.add(row['username'])
+            seen_emails.add(row['email'])
+            new_rows.append(row)
+
+        users = [
+            CollegeUser(
+                username = row['username'],
+                email = row['email'],
+                first_name = row['first_name'],
+                last_name = row['last_name'],
+                password = make_password(row['password']),
+                verification_token = token,
+            )
+            for row, token in zip(new_rows, unique_verification_tokens(len(new_rows)))
+        ]
+        # the samba tasks are written to the outbox in the transaction that
+        # creates the users, so there are never users without them
+        with transaction.atomic():
+            CollegeUser.objects.bulk_create(users, batch_size = options['batch_size'])
+            if not options['no_samba']:
+                dispatch_create_users_bulk(
+                    (user_record(user, row['password']) for user, row in zip(users, new_rows)),
+                    options['batch_size']
+                )
+        return len(new_rows), len(rows) - len(new_rows)
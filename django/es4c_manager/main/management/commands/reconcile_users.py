@@ -0,0 +1,100 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models.functions import Collate, Upper
+from main.models import Campus, CollegeUser
+from main.dispatchers import broadcast, chunked, send_to_campus
+from main.tasks import reconcile_users
+import uuid
+
+'''
+    reconcile_users looks for drifts between the CollegeUser table and the
+    directory of the samba addc servers: users without a samba account
+    (e.g. their create_user message was lost), samba accounts without a
+    django user (e.g. created by the IT staff) and users whose names or
+    enabled state differ.
+
+    The users are streamed sorted by username (through .iterator(), so they
+    are never all in memory) and sent in chunks, each one with the range of
+    usernames it covers, as tasks.reconcile_users tasks. Every campus
+    streams the same range of its directory (a paged, sorted search),
+    merge-joins both sides and reports the drifts, which are stored as
+    DirectoryDrift rows. With --repair, the campuses also create the
+    missing users and fix the mismatched ones.
+
+    Usage:
+        python3 manage.py reconcile_users --chunk-size 1000 [--repair]
+        python3 manage.py reconcile_users --campus 10.0.0.2
+'''
+
+def codepoint_order(expression):
+    '''
+        Sort by the codepoints of an expression, as samba compares
+        usernames, instead of by the collation of the database (which, e.g.
+        in PostgreSQL with en_US.UTF-8, ignores punctuation). SQLite already
+        sorts text by codepoint.
+    '''
+    if connection.vendor == 'postgresql':
+        return Collate(expression, 'C')
+    return expression
+
+def chunks_with_ranges(chunks):
+    '''
+        Yield (chunk, lower, upper) for each chunk of users sorted by
+        username, where (lower, upper] is the range of usernames it covers.
+        The first range has no lower bound and the last one no upper bound,
+        so the ranges cover every possible username.
+    '''
+    lower = None
+    previous = None
+    for chunk in chunks:
+        if previous is not None:
+            upper = previous[-1]['username']
+            yield previous, lower, upper
+            lower = upper
+        previous = chunk
+    yield previous or [], lower, None
+
+class Command(BaseCommand):
+    help = 'Compare the CollegeUser table with the directory of the samba servers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type = int, default = 1000, help = 'users per reconcile_users task')
+        parser.add_argument('--campus', default = None, help = 'only reconcile the campus with this address')
+        parser.add_argument('--repair', action = 'store_true', help = 'create missing users and fix mismatched ones')
+
+    def handle(self, *args, **options):
+        campus = None
+        if options['campus']:
+            campus = Campus.objects.filter(server_address = options['campus']).first()
+            if campus is None:
+                raise CommandError('Unknown campus ' + options['campus'])
+            if not campus.is_alive:
+                raise CommandError('The worker of campus ' + options['campus'] + ' is down')
+
+        run_id = str(uuid.uuid4())
+        # samba sorts usernames casefolded to upper case, by codepoint, so
+        # does django
+        users = (
+            {
+                'username': user.username,
+                'first_name': user.first_name,
+                'last_name': user.last_name,
+                'enabled': user.samba_enabled,
+            }
+            for user in CollegeUser.objects.order_by(codepoint_order(Upper('username'))).only(
+                'username', 'first_name', 'last_name', 'is_active', 'is_verified'
+            ).iterator(chunk_size = options['chunk_size'])
+        )
+
+        tasks = 0
+        for chunk, lower, upper in chunks_with_ranges(chunked(users, options['chunk_size'])):
+            kwargs = {'lower': lower, 'upper': upper, 'run_id': run_id, 'repair': options['repair']}
+            if campus is None:
+                broadcast(reconcile_users, chunk, **kwargs)
+            else:
+                send_to_campus(reconcile_users, campus, chunk, **kwargs)
+            tasks += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            'Reconciliation {} sent as {} tasks. Its drifts are listed in the admin (Directory drifts).'.format(run_id, tasks)
+        ))
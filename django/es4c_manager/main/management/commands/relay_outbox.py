@@ -0,0 +1,65 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from es4c_manager.celery import app
+from main.dispatchers import OUTBOX_BATCH_SIZE, relay_outbox
+from main.models import OutboxMessage
+from main.updates import flush_due_attribute_updates
+import time
+
+'''
+    relay_outbox is the outbox relay: it publishes the samba tasks written
+    to the outbox (the OutboxMessage model, see main/dispatchers.py) to the
+    broker, in batches, oldest first, and sends the attribute updates whose
+    debounce window is over (see main/updates.py).
+
+    The broker connection uses publisher confirms, so a message is only
+    removed from the outbox once RabbitMQ confirmed it. While the broker is
+    down, messages pile up in the outbox and are published when it is back.
+    The relay runs in background in the django container (see its
+    Dockerfile). More than one relay may run at once, each one skips the
+    rows locked by the others.
+
+    Messages that can never be published as they are (e.g. of a task
+    removed from the contract) are set aside instead of blocking the
+    outbox. They keep their arguments, passwords included, so once the
+    cause is fixed they should be retried with --retry-failed, or deleted.
+
+    Usage:
+        python3 manage.py relay_outbox [--retry-failed]
+'''
+
+# seconds to wait before reconnecting after an error
+RETRY_INTERVAL = 5
+
+class Command(BaseCommand):
+    help = 'Publish the samba tasks written to the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type = int, default = OUTBOX_BATCH_SIZE, help = 'messages published per transaction')
+        parser.add_argument('--interval', type = float, default = settings.OUTBOX_RELAY_INTERVAL, help = 'seconds between polls of an idle outbox')
+        parser.add_argument('--retry-failed', action = 'store_true', help = 'publish again the messages that were set aside')
+
+    def handle(self, *args, **options):
+        if options['retry_failed']:
+            retried = OutboxMessage.objects.filter(failed_at__isnull = False).update(failed_at = None, error = '')
+            self.stdout.write(f"{retried} outbox messages set aside will be published again")
+        while True:
+            try:
+                with app.connection_for_write(transport_options = {'confirm_publish': True}) as connection:
+                    connection.ensure_connection()
+                    self.relay(connection, options['batch_size'], options['interval'])
+            except Exception as e:
+                self.stderr.write(f"Outbox relay error, retrying in {RETRY_INTERVAL}s: {e}")
+                time.sleep(RETRY_INTERVAL)
+
+    def relay(self, connection, batch_size, interval):
+        while True:
+            # drop database connections closed by the server meanwhile
+            close_old_connections()
+            # keep the broker connection alive while the outbox is idle
+            connection.heartbeat_check()
+            published = relay_outbox(connection, batch_size)
+            flushed = flush_due_attribute_updates()
+            if published < batch_size and not flushed:
+                time.sleep(interval)
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand, CommandError
+from main.models import CollegeUser
+from main.utils import send_email_verification_tokens
+import time
+
+'''
+    send_verification_emails sends the verification token to every user
+    that is not verified yet (or only to the given usernames), e.g. after
+    a cohort is imported through the import_users command.
+
+    To try it against a local stand-in relay instead of the real one:
+        python3 -m aiosmtpd -n -l localhost:8025
+        ES4C_MANAGER_SMTP_SERVER=localhost ES4C_MANAGER_SMTP_PORT=8025 \
+        ES4C_MANAGER_SMTP_USE_TLS=false ES4C_MANAGER_SMTP_PASSWORD= \
+        python3 manage.py send_verification_emails --sessions 4 --rate 50
+'''
+
+class Command(BaseCommand):
+    help = 'Send the verification e-mail to users that are not verified yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs = '*', help = 'only send to these users')
+        parser.add_argument('--sessions', type = int, default = 4, help = 'SMTP sessions sending in parallel')
+        parser.add_argument('--rate', type = float, default = None, help = 'maximum messages per second')
+
+    def handle(self, *args, **options):
+        if options['sessions'] < 1:
+            raise CommandError('--sessions must be a positive number')
+        if options['rate'] is not None and options['rate'] <= 0:
+            raise CommandError('--rate must be a positive number')
+        users = CollegeUser.objects.filter(is_verified = False)
+        if options['usernames']:
+            users = users.filter(username__in = options['usernames'])
+        total = users.count()
+        start = time.monotonic()
+        failures = send_email_verification_tokens(
+            users.iterator(),
+            sessions = options['sessions'],
+            rate_limit = options['rate']
+        )
+        elapsed = time.monotonic() - start
+        for email, error in failures.items():
+            self.stderr.write('Could not send to {}: {}'.format(email, error))
+        self.stdout.write(self.style.SUCCESS(
+            'Sent {} of {} messages in {:.1f}s ({:.1f} messages/s)'.format(
+                total - len(failures), total, elapsed,
+                (total - len(failures)) / elapsed if elapsed else 0
+            )
+        ))
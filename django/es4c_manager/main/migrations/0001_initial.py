@@ -0,0 +1,114 @@
+# Generated by Django 5.0.4 on 2026-10-18 08:53
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Campus',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('server_address', models.CharField(max_length=255, unique=True)),
+                ('worker_hostname', models.CharField(blank=True, max_length=255)),
+                ('queue_depth', models.IntegerField(default=0)),
+                ('last_seen', models.DateTimeField(blank=True, null=True)),
+                ('changes_usn', models.BigIntegerField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='OutboxMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_id', models.CharField(max_length=255)),
+                ('task_name', models.CharField(max_length=255)),
+                ('args', models.JSONField(default=list)),
+                ('kwargs', models.JSONField(default=dict)),
+                ('server_address', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CollegeUser',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('password', models.CharField(max_length=128, verbose_name='password')),
+                ('last_login', models.DateTimeField(blank=True, null=True, verbose_name='last login')),
+                ('username', models.CharField(max_length=40, unique=True)),
+                ('email', models.EmailField(max_length=255, unique=True)),
+                ('first_name', models.CharField(max_length=40)),
+                ('last_name', models.CharField(max_length=100)),
+                ('verification_token', models.CharField(max_length=8, unique=True)),
+                ('is_verified', models.BooleanField(default=False)),
+                ('is_admin', models.BooleanField(default=False)),
+                ('is_staff', models.BooleanField(default=False)),
+                ('is_superuser', models.BooleanField(default=False)),
+                ('is_active', models.BooleanField(default=True)),
+                ('date_joined', models.DateTimeField(auto_now_add=True)),
+                ('groups', models.ManyToManyField(blank=True, help_text='The groups this user belongs to. A user will get all permissions granted to each of their groups.', related_name='user_set', related_query_name='user', to='auth.group', verbose_name='groups')),
+                ('user_permissions', models.ManyToManyField(blank=True, help_text='Specific permissions for this user.', related_name='user_set', related_query_name='user', to='auth.permission', verbose_name='user permissions')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='PendingAttributeUpdate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(max_length=40, unique=True)),
+                ('attributes', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['created_at'], name='main_pendin_created_7647ea_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='DirectoryDrift',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run_id', models.CharField(max_length=255)),
+                ('server_address', models.CharField(max_length=255)),
+                ('username', models.CharField(max_length=40)),
+                ('kind', models.CharField(choices=[('missing', 'Missing in the campus'), ('extra', 'Only in the campus'), ('mismatch', 'Mismatched attributes')], max_length=10)),
+                ('details', models.TextField(blank=True)),
+                ('repaired', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('campus', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='main.campus')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['run_id', 'kind'], name='main_direct_run_id_b3c4d7_idx'), models.Index(fields=['username'], name='main_direct_usernam_4ade50_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='TaskJournal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_id', models.CharField(db_index=True, max_length=255)),
+                ('operation', models.CharField(max_length=255)),
+                ('username', models.CharField(blank=True, max_length=40)),
+                ('server_address', models.CharField(blank=True, max_length=255)),
+                ('status', models.CharField(max_length=50)),
+                ('result', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('runtime', models.FloatField(blank=True, null=True)),
+                ('campus', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='main.campus')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['username', '-created_at'], name='main_taskjo_usernam_8b6b0d_idx'), models.Index(fields=['status', '-created_at'], name='main_taskjo_status_58e142_idx'), models.Index(fields=['-created_at'], name='main_taskjo_created_e4d4ff_idx')],
+            },
+        ),
+    ]
@@ -1,9 +1,12 @@
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
+from datetime import timedelta
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin
 from main.managers import CollegeUserManager
 
 '''
-    There are defined three models in this file:
+    There are defined six models in this file:
         1. CollegeUser: The main model for the application, it is used to store
            user information and is used for creation, authentication, modifica-
            tion and deletion of users both in django web-app as well as in the
@@ -11,16 +14,46 @@ from main.managers import CollegeUserManager
            of AbstractBaseUser and PermissionsMixin, which means that it is
            fully compatible with the django authentication system which helps
            a lot in dealing with the AAA basic requirements of the application.
-        2. ADDCUserCreationTask: This model is intended to store the tasks
-           creation tasks sent to celery workers in SAMBA ADDC servers.
-           In the current release of the application, this model isn't being
-           used and it mostly likely to be refactored in future releases to
-           deal with tasks in a more generic way.
+        2. TaskJournal: This model (formerly ADDCUserCreationTask) is the
+           journal of the tasks sent to celery workers in SAMBA ADDC servers.
+           A row is written when a task is published and another one for
+           each campus that runs it, with its status, timings and result
+           (see main/journal.py). Arguments are never stored, since some
+           of them are passwords. Rows are only inserted, in batches, and
+           the lookups made by the admin (by user, by status and by time)
+           are indexed.
         3. Campus: This model is used to store the information about the
-           sites where samba workers will be deployed. It is not currently
-           used and in future releases it will be refactored to be more generic
-           (as well as the CollegeUser may be renamed) to represent any kind
-           of institution that may use the application.
+           sites where samba workers will be deployed. Its server_address
+           names the queue consumed by the campus worker (samba.<address>),
+           which is bound to the broadcast exchange and to the campus
+           exchange. Campus workers send heartbeats that keep the liveness
+           and queue depth of each campus up to date, and feed the changes
+           made to their directory back to the users. In future releases it
+           will be refactored to be more generic (as well as the CollegeUser
+           may be renamed) to represent any kind of institution that may use
+           the application.
+        4. PendingAttributeUpdate: The attribute updates of a user that
+           were not sent to the samba workers yet. Updates made within a
+           short window are merged here, the latest values winning, and
+           sent as a single task once the window is over (see
+           main/updates.py).
+        5. DirectoryDrift: The differences between the CollegeUser table
+           and the directory of each campus found by a reconciliation run
+           (see the reconcile_users command): users missing in a campus,
+           accounts that exist only in a campus and mismatched users.
+        6. OutboxMessage: The samba tasks waiting to be published. They are
+           written in the same transaction as the change they reflect and
+           published to the broker by the outbox relay (see the
+           relay_outbox command), so requests do not wait for the broker
+           and a task is never lost when the broker is down. A message is
+           deleted once the broker confirmed it, so its arguments
+           (passwords included) are only kept until then. A message that
+           can never be published as it is (an unknown task, arguments
+           that break the task contract) is set aside, with its error,
+           instead of blocking the ones behind it, and keeps its
+           arguments until it is deleted or retried (relay_outbox
+           --retry-failed). Since the arguments are in plain text, the
+           model is not registered in the admin.
 '''
 
 class CollegeUser(AbstractBaseUser, PermissionsMixin):
@@ -44,14 +77,124 @@ class CollegeUser(AbstractBaseUser, PermissionsMixin):
     def __str__(self):
         return self.first_name + ' ' + self.last_name
 
-class ADDCUserCreationTask(models.Model):
-    user = models.ForeignKey(CollegeUser, on_delete=models.CASCADE)
-    task_id = models.CharField(max_length=255)
-    status = models.CharField(max_length=50)
-    result = models.TextField(null=True)
+    @property
+    def samba_enabled(self):
+        '''
+            Whether the samba account of the user should be enabled: users
+            that registered themselves are only enabled once they verified
+            their e-mail, and the admin disables users by deactivating them.
+            Every path that enables, disables or compares the accounts
+            (the admin, reconcile_users, the directory changes) follows it.
+        '''
+        return self.is_active and self.is_verified
+
 
 class Campus(models.Model):
     name = models.CharField(max_length=255)
-    server_address = models.CharField(max_length=255)
+    server_address = models.CharField(max_length=255, unique=True)
+    # the fields below are updated by the heartbeats of the campus worker
+    worker_hostname = models.CharField(max_length=255, blank=True)
+    queue_depth = models.IntegerField(default=0)
+    last_seen = models.DateTimeField(null=True, blank=True)
+    # the highest USN of the campus DC whose changes were applied to the
+    # users (see campus.poll_directory_changes)
+    changes_usn = models.BigIntegerField(null=True, blank=True)
     def __str__(self):
         return self.name
+
+    @property
+    def queue_name(self):
+        return 'samba.' + self.server_address
+
+    @property
+    def is_alive(self):
+        if self.last_seen is None:
+            return False
+        timeout = timedelta(seconds=settings.CAMPUS_HEARTBEAT_TIMEOUT)
+        return timezone.now() - self.last_seen < timeout
+
+class TaskJournal(models.Model):
+    # the status of the rows written when a task is published, the other
+    # rows hold the celery state of the task in a campus
+    PUBLISHED = 'PUBLISHED'
+
+    task_id = models.CharField(max_length=255, db_index=True)
+    operation = models.CharField(max_length=255)
+    # the username is stored instead of a foreign key, so the journal of a
+    # user survives its deletion and rows can be written without lookups
+    username = models.CharField(max_length=40, blank=True)
+    campus = models.ForeignKey(Campus, on_delete=models.SET_NULL, null=True, blank=True)
+    server_address = models.CharField(max_length=255, blank=True)
+    status = models.CharField(max_length=50)
+    result = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    runtime = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['username', '-created_at']),
+            models.Index(fields=['status', '-created_at']),
+            models.Index(fields=['-created_at']),
+        ]
+
+    def __str__(self):
+        return self.operation + ' ' + self.task_id + ' ' + self.status
+
+class PendingAttributeUpdate(models.Model):
+    username = models.CharField(max_length=40, unique=True)
+    # LDAP attribute name -> latest value, e.g. {'givenName': 'Maria'}
+    attributes = models.JSONField(default=dict)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at']),
+        ]
+
+    def __str__(self):
+        return self.username + ' ' + ', '.join(self.attributes)
+
+class DirectoryDrift(models.Model):
+    MISSING = 'missing'
+    EXTRA = 'extra'
+    MISMATCH = 'mismatch'
+    KINDS = [
+        (MISSING, 'Missing in the campus'),
+        (EXTRA, 'Only in the campus'),
+        (MISMATCH, 'Mismatched attributes'),
+    ]
+
+    run_id = models.CharField(max_length=255)
+    campus = models.ForeignKey(Campus, on_delete=models.SET_NULL, null=True, blank=True)
+    server_address = models.CharField(max_length=255)
+    username = models.CharField(max_length=40)
+    kind = models.CharField(max_length=10, choices=KINDS)
+    details = models.TextField(blank=True)
+    repaired = models.BooleanField(default=False)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['run_id', 'kind']),
+            models.Index(fields=['username']),
+        ]
+
+    def __str__(self):
+        return self.username + ' ' + self.kind + ' in ' + self.server_address
+
+class OutboxMessage(models.Model):
+    task_id = models.CharField(max_length=255)
+    task_name = models.CharField(max_length=255)
+    args = models.JSONField(default=list)
+    kwargs = models.JSONField(default=dict)
+    # the campus the task is sent to, empty when it is broadcast
+    server_address = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    # set when the message could not be published and was set aside
+    failed_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    def __str__(self):
+        return self.task_name + ' ' + self.task_id
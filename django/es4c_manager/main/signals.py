@@ -0,0 +1,21 @@
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+'''
+    This file contains the signal handlers of the main app. They are
+    connected when the app is ready (see apps.py).
+'''
+
+@receiver(connection_created)
+def tune_sqlite(sender, connection, **kwargs):
+    '''
+        SQLite is tuned for concurrent access whenever a connection is
+        opened: in WAL mode readers no longer wait for a writer (and the
+        writer no longer waits for readers), and with synchronous=NORMAL a
+        commit does not wait for an fsync of the whole database.
+    '''
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA journal_mode=WAL;')
+        cursor.execute('PRAGMA synchronous=NORMAL;')
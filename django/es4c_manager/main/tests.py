@@ -1,3 +1,561 @@
-from django.test import TestCase
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.contrib import admin
+from django.test import RequestFactory, TestCase, override_settings
+from django.conf import settings
+from django.core.management.base import CommandError
+from django.db import transaction
+from django.utils import timezone
+from datetime import timedelta
+from es4c_manager.celery import app
+from main import tasks
+from celery.signals import worker_process_shutdown
+from main import journal
+from main.admin import CollegeUserAdmin
+from main.dispatchers import broadcast, chunked, dispatch_create_users_bulk, dispatch_users_bulk, enqueue, relay_outbox, send_to_campus, send_to_campuses, user_record
+from main.campus import apply_directory_changes
+from main.mail import is_transient_smtp_error, send_verification_email
+from main.management.commands.import_users import validate_row
+from main.management.commands.reconcile_users import chunks_with_ranges
+from main.events import _may_watch
+from main.models import Campus, CollegeUser, OutboxMessage, PendingAttributeUpdate, TaskJournal
+from main.updates import flush_due_attribute_updates
+from main.utils import RateLimiter, SMTPSession, send_email_verification_tokens
+from unittest import mock
+import io
+import os
+import smtplib
+import socket
+import task_contract
+import tempfile
+import time
+import unittest
 
-# Create your tests here.
+try:
+    from aiosmtpd.controller import Controller
+except ImportError:
+    Controller = None
+
+'''
+    Tests of the main app. They run without RabbitMQ nor samba servers:
+    samba tasks are only written to the outbox, and nothing here relays
+    them.
+
+    Usage:
+        python3 manage.py test main
+'''
+
+PASSWORD = 'Xk9#mpLq2!zR'
+
+def row(**fields):
+    return {
+        'username': 'ana',
+        'email': 'ana@example.org',
+        'first_name': 'Ana',
+        'last_name': 'Silva',
+        'password': PASSWORD,
+        **fields
+    }
+
+@override_settings(ALLOWED_EMAIL_DOMAINS = [r'example\.org'])
+class ImportUsersTests(TestCase):
+    def import_csv(self, rows, no_samba = True):
+        with tempfile.NamedTemporaryFile('w', suffix = '.csv', delete = False, encoding = 'utf-8') as f:
+            f.write('username,email,first_name,last_name,password\n')
+            for r in rows:
+                f.write('{username},{email},{first_name},{last_name},{password}\n'.format(**r))
+        self.addCleanup(os.unlink, f.name)
+        call_command('import_users', f.name, no_samba = no_samba, stdout = io.StringIO(), stderr = io.StringIO())
+
+    def test_validate_row_rejects_values_longer_than_the_fields(self):
+        with self.assertRaises(ValidationError):
+            validate_row(row(username = 'a' * 41))
+        with self.assertRaises(ValidationError):
+            validate_row(row(first_name = 'A' * 41))
+        validate_row(row(username = 'a' * 40))
+
+    def test_validate_row_normalizes_the_email(self):
+        r = row(email = 'ana@Example.ORG')
+        validate_row(r)
+        self.assertEqual(r['email'], 'ana@example.org')
+
+    def test_long_rows_do_not_abort_the_import(self):
+        self.import_csv([row(username = 'a' * 41, email = 'long@example.org'), row()])
+        self.assertEqual(list(CollegeUser.objects.values_list('username', flat = True)), ['ana'])
+
+    def test_users_and_their_samba_tasks_are_written_together(self):
+        self.import_csv([row()], no_samba = False)
+        self.assertEqual(OutboxMessage.objects.get().task_name, 'tasks.create_users_bulk')
+        with mock.patch('main.management.commands.import_users.dispatch_create_users_bulk', side_effect = RuntimeError('crash')):
+            with self.assertRaises(RuntimeError):
+                self.import_csv([row(username = 'bob', email = 'bob@example.org')], no_samba = False)
+        self.assertFalse(CollegeUser.objects.filter(username = 'bob').exists())
+
+    def test_emails_differing_in_domain_case_are_duplicates(self):
+        self.import_csv([row(), row(username = 'ana2', email = 'ana@EXAMPLE.org')])
+        self.assertEqual(list(CollegeUser.objects.values_list('email', flat = True)), ['ana@example.org'])
+
+class SendVerificationEmailTests(TestCase):
+    def setUp(self):
+        self.user = CollegeUser.objects.create(
+            username = 'ana', email = 'ana@example.org', first_name = 'Ana', last_name = 'Silva', verification_token = 'AB12CD34'
+        )
+
+    def test_transient_smtp_errors(self):
+        self.assertTrue(is_transient_smtp_error(smtplib.SMTPServerDisconnected()))
+        self.assertTrue(is_transient_smtp_error(ConnectionRefusedError()))
+        self.assertTrue(is_transient_smtp_error(smtplib.SMTPDataError(451, b'try later')))
+        self.assertTrue(is_transient_smtp_error(smtplib.SMTPRecipientsRefused({'ana@example.org': (450, b'busy')})))
+
+    def test_permanent_smtp_errors(self):
+        self.assertFalse(is_transient_smtp_error(smtplib.SMTPAuthenticationError(535, b'bad credentials')))
+        self.assertFalse(is_transient_smtp_error(smtplib.SMTPRecipientsRefused({'ana@example.org': (550, b'no such user')})))
+        self.assertFalse(is_transient_smtp_error(smtplib.SMTPSenderRefused(553, b'not allowed', 'a@example.org')))
+        self.assertFalse(is_transient_smtp_error(smtplib.SMTPNotSupportedError()))
+
+    def send(self, error):
+        with mock.patch('main.mail.send_email_verification_token', side_effect = error) as send:
+            result = send_verification_email.apply((self.user.pk,))
+        return result, send.call_count
+
+    def test_permanent_errors_are_not_retried(self):
+        result, calls = self.send(smtplib.SMTPRecipientsRefused({'ana@example.org': (550, b'no such user')}))
+        self.assertEqual(result.state, 'FAILURE')
+        self.assertEqual(calls, 1)
+
+    def test_transient_errors_are_retried(self):
+        result, calls = self.send(smtplib.SMTPServerDisconnected())
+        self.assertEqual(result.state, 'FAILURE')
+        self.assertEqual(calls, 1 + send_verification_email.max_retries)
+
+class SMTPSessionTests(unittest.TestCase):
+    def session(self, error):
+        session = SMTPSession()
+        server = mock.Mock()
+        server.send_message.side_effect = [error, None]
+        def open_session():
+            session._server = server
+        session._open = open_session
+        return session, server
+
+    def test_dropped_connections_are_reopened_and_sent_again(self):
+        for error in (smtplib.SMTPServerDisconnected(), ConnectionResetError(), socket.timeout()):
+            session, server = self.session(error)
+            session.send('message')
+            self.assertEqual(server.send_message.call_count, 2)
+
+    def test_replies_of_the_relay_are_not_sent_again(self):
+        session, server = self.session(smtplib.SMTPRecipientsRefused({'ana@example.org': (550, b'no such user')}))
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            session.send('message')
+        self.assertEqual(server.send_message.call_count, 1)
+
+class ChunkedTests(unittest.TestCase):
+    def test_chunks_any_iterable(self):
+        self.assertEqual(list(chunked(iter(range(5)), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(chunked([], 2)), [])
+
+class RateLimiterTests(unittest.TestCase):
+    def test_spaces_acquisitions_by_the_rate(self):
+        limiter = RateLimiter(50)
+        start = time.monotonic()
+        for _ in range(6):
+            limiter.acquire()
+        # the first one is free, the other five wait 1/50 s each
+        self.assertGreaterEqual(time.monotonic() - start, 5 / 50 * 0.9)
+
+class MessageHandler:
+    def __init__(self):
+        self.recipients = []
+        self.refused = set()
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address in self.refused:
+            return '550 no such user'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        self.recipients.extend(envelope.rcpt_tos)
+        return '250 OK'
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+@unittest.skipIf(Controller is None, 'aiosmtpd is not installed')
+class SendEmailVerificationTokensTests(TestCase):
+    '''
+        Sends the verification e-mails to a local aiosmtpd relay.
+    '''
+    def setUp(self):
+        self.handler = MessageHandler()
+        port = free_port()
+        self.controller = Controller(self.handler, hostname = '127.0.0.1', port = port)
+        self.controller.start()
+        self.addCleanup(self.controller.stop)
+        email_settings = {
+            'smtp_server': '127.0.0.1',
+            'smtp_port': port,
+            'smtp_username': 'noreply@example.org',
+            'smtp_password': '',
+            'smtp_use_tls': False,
+            'smtp_session_max_messages': 3,
+        }
+        patch = override_settings(VERIFICATION_EMAIL_SETTINGS = email_settings, HOST_FQDN = 'example.org')
+        patch.enable()
+        self.addCleanup(patch.disable)
+        self.users = [
+            CollegeUser(username = f"user{i}", email = f"user{i}@example.org", first_name = 'User', last_name = str(i), verification_token = f"TOKEN{i:03}")
+            for i in range(10)
+        ]
+
+    def test_sends_one_message_per_user(self):
+        failures = send_email_verification_tokens(self.users, sessions = 3)
+        self.assertEqual(failures, {})
+        self.assertCountEqual(self.handler.recipients, [user.email for user in self.users])
+
+    def test_reports_the_users_it_could_not_send_to(self):
+        self.handler.refused = {'user3@example.org'}
+        failures = send_email_verification_tokens(self.users, sessions = 2)
+        self.assertEqual(set(failures), {'user3@example.org'})
+        self.assertEqual(len(self.handler.recipients), len(self.users) - 1)
+
+    def test_rejects_sessions_that_are_not_positive(self):
+        with self.assertRaises(ValueError):
+            send_email_verification_tokens(self.users, sessions = 0)
+        with self.assertRaises(CommandError):
+            call_command('send_verification_emails', sessions = 0, stdout = io.StringIO())
+
+class ContractTests(unittest.TestCase):
+    def test_message_checks_the_arguments(self):
+        message = task_contract.update_user_password.message(('ana', 'secret'), idempotency_key = 'k')
+        self.assertEqual(message['args'], ('ana', 'secret'))
+        self.assertEqual(message['headers'], {'contract_version': task_contract.VERSION, 'idempotency_key': 'k'})
+        with self.assertRaises(task_contract.ContractError):
+            task_contract.update_user_password.message(('ana',))
+
+    def test_message_checks_the_records(self):
+        with self.assertRaises(task_contract.ContractError):
+            task_contract.create_users_bulk.message(([{'username': 'ana', 'password': 'x'}],))
+
+    def test_message_hides_passwords_from_events(self):
+        message = task_contract.update_user_password.message(('ana', 'secret'))
+        self.assertEqual(message['argsrepr'], repr(('ana', '********')))
+        message = task_contract.create_users_bulk.message(([row()],))
+        self.assertNotIn(PASSWORD, message['argsrepr'])
+        message = task_contract.create_user.message(('ana',), {'password': 'secret', 'first_name': 'Ana'})
+        self.assertEqual(message['kwargsrepr'], repr({'password': '********', 'first_name': 'Ana'}))
+
+    def test_implementation_must_match_the_signature(self):
+        task_contract.delete_user.implementation(lambda username: None)
+        with self.assertRaises(task_contract.ContractError):
+            task_contract.delete_user.implementation(lambda user: None)
+
+    def test_tasks_refuse_newer_contracts(self):
+        @app.task(name = 'tests.newer_contract', bind = True)
+        def task(self):
+            return self.request.id
+
+        result = task.apply(task_id = 'abc', headers = {'contract_version': task_contract.VERSION + 1})
+        self.assertIsInstance(result.result, task_contract.ContractError)
+        # the request of the message is the one seen by the task
+        self.assertEqual(task.apply(task_id = 'abc').result, 'abc')
+
+class OutboxRelayTests(TestCase):
+    def relay(self):
+        # the messages as given to the broker, not the task-sent events
+        producer = mock.MagicMock()
+        with mock.patch.object(app.amqp, 'Producer', return_value = producer):
+            published = relay_outbox(connection = object())
+        messages = []
+        for call in producer.publish.call_args_list:
+            exchange = getattr(call.kwargs['exchange'], 'name', call.kwargs['exchange'])
+            if exchange != 'celeryev':
+                messages.append({**call.kwargs, 'exchange': exchange})
+        return published, messages
+
+    def test_relays_messages_and_deletes_them(self):
+        with self.captureOnCommitCallbacks(execute = True):
+            result = broadcast(tasks.delete_user, 'ana')
+        published, messages = self.relay()
+        self.assertEqual(published, 1)
+        self.assertFalse(OutboxMessage.objects.exists())
+        self.assertEqual(messages[0]['headers']['id'], result.id)
+        self.assertEqual(messages[0]['headers']['idempotency_key'], result.id)
+
+    def test_broadcasts_go_to_the_fanout_exchange(self):
+        broadcast(tasks.delete_user, 'ana')
+        _, messages = self.relay()
+        self.assertEqual((messages[0]['exchange'], messages[0]['routing_key']), ('samba.broadcast', ''))
+
+    def test_bulk_broadcasts_go_to_the_bulk_fanout_exchange(self):
+        dispatch_users_bulk(['ana', 'bob'], 'disable')
+        dispatch_create_users_bulk([user_record(CollegeUser(username = 'carol', first_name = 'Carol', last_name = 'Z'), PASSWORD)])
+        _, messages = self.relay()
+        self.assertEqual(
+            [(message['exchange'], message['routing_key']) for message in messages],
+            [('samba.broadcast.bulk', '')] * 2
+        )
+
+    def test_campus_messages_go_to_the_campus_exchange(self):
+        campus = Campus.objects.create(name = 'A', server_address = '10.0.0.2', last_seen = timezone.now())
+        send_to_campus(tasks.delete_user, campus, 'ana')
+        _, messages = self.relay()
+        self.assertEqual((messages[0]['exchange'], messages[0]['routing_key']), ('samba.campus', '10.0.0.2'))
+
+    def test_keeps_the_messages_that_were_not_published(self):
+        broadcast(tasks.delete_user, 'ana')
+        broadcast(tasks.delete_user, 'bob')
+        with mock.patch.object(tasks.app, 'send_task', side_effect = [None, ConnectionError('broker down')]):
+            with self.assertRaises(ConnectionError):
+                relay_outbox(connection = object())
+        self.assertEqual([message.args for message in OutboxMessage.objects.all()], [['bob']])
+
+    def test_sets_aside_the_messages_that_cannot_be_published(self):
+        OutboxMessage.objects.create(task_id = 'a', task_name = 'tasks.removed_task', args = ['ana'])
+        OutboxMessage.objects.create(task_id = 'b', task_name = 'tasks.delete_user', args = ['ana', 'extra'])
+        broadcast(tasks.delete_user, 'bob')
+        with mock.patch.object(tasks.app, 'send_task') as send_task:
+            self.assertEqual(relay_outbox(connection = object()), 1)
+            self.assertEqual(relay_outbox(connection = object()), 0)
+        self.assertEqual(send_task.call_count, 1)
+        self.assertEqual(
+            sorted(OutboxMessage.objects.filter(failed_at__isnull = False).values_list('task_id', flat = True)),
+            ['a', 'b']
+        )
+        self.assertFalse(OutboxMessage.objects.filter(failed_at__isnull = True).exists())
+
+class StopRelay(BaseException):
+    pass
+
+class RelayOutboxCommandTests(TestCase):
+    def test_reports_to_the_command_output(self):
+        OutboxMessage.objects.create(task_id = 'a', task_name = 'tasks.delete_user', args = ['ana'], failed_at = timezone.now(), error = 'x')
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with mock.patch.object(app, 'connection_for_write', side_effect = ConnectionError('broker down')), \
+             mock.patch('main.management.commands.relay_outbox.time.sleep', side_effect = StopRelay):
+            with self.assertRaises(StopRelay):
+                call_command('relay_outbox', retry_failed = True, stdout = stdout, stderr = stderr)
+        self.assertIn('1 outbox messages set aside will be published again', stdout.getvalue())
+        self.assertIn('Outbox relay error, retrying in', stderr.getvalue())
+        self.assertIsNone(OutboxMessage.objects.get().failed_at)
+
+class AttributeUpdateTests(TestCase):
+    def setUp(self):
+        self.user = CollegeUser.objects.create(username = 'ana', email = 'ana@example.org', verification_token = 'ANA00001')
+        self.client.force_login(self.user)
+
+    def test_edits_within_the_window_are_sent_as_one_task(self):
+        self.client.post('/change-user/', {'first_name': 'Maria', 'last_name': 'Silva'})
+        self.client.post('/change-user/', {'first_name': 'Maria', 'last_name': 'Souza'})
+        pending = PendingAttributeUpdate.objects.get()
+        self.assertEqual(pending.attributes, {'givenName': 'Maria', 'sn': 'Souza'})
+        # the window is not over yet
+        self.assertEqual(flush_due_attribute_updates(), 0)
+        self.assertFalse(OutboxMessage.objects.exists())
+
+        pending.created_at -= timedelta(seconds = settings.ATTRIBUTE_UPDATE_DEBOUNCE)
+        pending.save()
+        self.assertEqual(flush_due_attribute_updates(), 1)
+        message = OutboxMessage.objects.get()
+        self.assertEqual((message.task_name, message.args), ('tasks.update_user_attributes', ['ana']))
+        self.assertEqual(message.kwargs, {'givenName': 'Maria', 'sn': 'Souza'})
+        self.assertFalse(PendingAttributeUpdate.objects.exists())
+
+class SendToCampusTests(TestCase):
+    def campus(self, address, seconds_ago):
+        last_seen = timezone.now() - timedelta(seconds = seconds_ago)
+        return Campus.objects.create(name = address, server_address = address, last_seen = last_seen)
+
+    def test_campuses_with_a_recent_heartbeat_get_the_task(self):
+        campus = self.campus('10.0.0.2', settings.CAMPUS_HEARTBEAT_TIMEOUT - 30)
+        self.assertIsNotNone(send_to_campus(tasks.delete_user, campus, 'ana'))
+        self.assertEqual(OutboxMessage.objects.get().server_address, '10.0.0.2')
+
+    def test_campuses_whose_heartbeat_is_stale_are_skipped(self):
+        campus = self.campus('10.0.0.3', settings.CAMPUS_HEARTBEAT_TIMEOUT + 30)
+        self.assertIsNone(send_to_campus(tasks.delete_user, campus, 'ana'))
+        self.assertIsNone(send_to_campus(tasks.delete_user, Campus(name = 'new', server_address = '10.0.0.4'), 'ana'))
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_send_to_campuses_only_reaches_the_live_ones(self):
+        self.campus('10.0.0.2', 0)
+        self.campus('10.0.0.3', settings.CAMPUS_HEARTBEAT_TIMEOUT + 30)
+        results = send_to_campuses(tasks.delete_user, 'ana')
+        self.assertIsNone(results['10.0.0.3'])
+        self.assertEqual(list(OutboxMessage.objects.values_list('server_address', flat = True)), ['10.0.0.2'])
+
+class JournalWriterTests(TestCase):
+    def test_buffered_rows_are_written_when_a_worker_process_exits(self):
+        writer = journal.JournalWriter(flush_interval = 3600)
+        with mock.patch.object(journal, 'journal', writer):
+            journal.journal_result('abc', 'tasks.delete_user', '', 'SUCCESS', 'done', username = 'ana')
+            self.assertFalse(TaskJournal.objects.exists())
+            worker_process_shutdown.send(sender = None, pid = os.getpid(), exitcode = 0)
+        self.assertEqual(TaskJournal.objects.get().task_id, 'abc')
+
+    def test_flush_writes_the_buffered_rows(self):
+        writer = journal.JournalWriter(flush_interval = 3600)
+        writer.add(task_id = 'abc', operation = 'tasks.delete_user', username = 'ana', status = TaskJournal.PUBLISHED)
+        writer.add(task_id = 'def', operation = 'tasks.delete_user', username = 'bob', status = TaskJournal.PUBLISHED)
+        self.assertFalse(TaskJournal.objects.exists())
+        writer.flush()
+        self.assertEqual(sorted(TaskJournal.objects.values_list('task_id', flat = True)), ['abc', 'def'])
+        writer.flush()
+        self.assertEqual(TaskJournal.objects.count(), 2)
+
+    def test_rows_are_written_right_away_when_not_buffered(self):
+        writer = journal.JournalWriter(buffered = False)
+        writer.add(task_id = 'abc', operation = 'tasks.delete_user', username = 'ana', status = 'SUCCESS')
+        self.assertEqual(TaskJournal.objects.get().username, 'ana')
+
+class TaskStatusTests(TestCase):
+    def setUp(self):
+        self.ana = CollegeUser.objects.create(username = 'ana', email = 'ana@example.org', verification_token = 'ANA00001')
+        self.bob = CollegeUser.objects.create(username = 'bob', email = 'bob@example.org', verification_token = 'BOB00001')
+        TaskJournal.objects.create(task_id = 'abc', operation = 'tasks.enable_account', username = 'ana', status = TaskJournal.PUBLISHED)
+        enqueue(tasks.update_user_password, ('ana', PASSWORD), {}, task_id = 'def')
+
+    def scope(self):
+        cookie = '{}={}'.format(settings.SESSION_COOKIE_NAME, self.client.session.session_key)
+        return {'headers': [(b'cookie', cookie.encode('latin-1'))]}
+
+    def test_users_see_their_own_tasks(self):
+        self.client.force_login(self.ana)
+        for task_id in ('abc', 'def'):
+            self.assertEqual(self.client.get(f"/api/tasks/{task_id}/").status_code, 200)
+            self.assertTrue(_may_watch(self.scope(), task_id))
+
+    def test_users_do_not_see_the_tasks_of_others(self):
+        self.client.force_login(self.bob)
+        for task_id in ('abc', 'def', 'unknown'):
+            self.assertEqual(self.client.get(f"/api/tasks/{task_id}/").status_code, 404)
+            self.assertFalse(_may_watch(self.scope(), task_id))
+
+class ReconcileUsersTests(TestCase):
+    def test_ranges_cover_every_username(self):
+        chunks = [[{'username': 'a'}, {'username': 'b'}], [{'username': 'c'}]]
+        self.assertEqual(
+            [(lower, upper) for _, lower, upper in chunks_with_ranges(chunks)],
+            [(None, 'b'), ('b', None)]
+        )
+        self.assertEqual(list(chunks_with_ranges([])), [([], None, None)])
+
+    def test_records_carry_the_samba_enabled_state(self):
+        for i, (is_active, is_verified) in enumerate(((True, True), (True, False), (False, True))):
+            CollegeUser.objects.create(
+                username = f"user{i}", email = f"{i}@example.org", verification_token = f"TOKEN{i:03}",
+                is_active = is_active, is_verified = is_verified
+            )
+        call_command('reconcile_users', stdout = io.StringIO())
+        records = OutboxMessage.objects.get().args[0]
+        self.assertEqual([record['enabled'] for record in records], [True, False, False])
+
+    def test_chunks_are_sorted_by_codepoint(self):
+        for i, username in enumerate(('ab', 'a_b', 'A.c', 'a.b')):
+            CollegeUser.objects.create(username = username, email = f"{i}@example.org", verification_token = f"TOKEN{i:03}")
+        call_command('reconcile_users', chunk_size = 1, stdout = io.StringIO())
+        messages = OutboxMessage.objects.order_by('id')
+        # samba compares the upper cased usernames by codepoint
+        self.assertEqual([message.args[0][0]['username'] for message in messages], ['a.b', 'A.c', 'ab', 'a_b'])
+        self.assertEqual(
+            [(message.kwargs['lower'], message.kwargs['upper']) for message in messages],
+            [(None, 'a.b'), ('a.b', 'A.c'), ('A.c', 'ab'), ('ab', None)]
+        )
+
+class CollegeUserAdminTests(TestCase):
+    def setUp(self):
+        self.admin = CollegeUserAdmin(CollegeUser, admin.site)
+        self.request = RequestFactory().post('/admin/')
+        self.user = CollegeUser.objects.create(
+            username = 'ana', email = 'ana@example.org', first_name = 'Ana', last_name = 'Silva',
+            verification_token = 'ANA00001', is_verified = True
+        )
+
+    def save(self, user, changed_data, change = True, **cleaned_data):
+        form = mock.Mock(changed_data = changed_data, cleaned_data = cleaned_data)
+        self.admin.save_model(self.request, user, form, change)
+
+    def test_bulk_actions_write_all_their_chunks_or_none(self):
+        CollegeUser.objects.create(username = 'bob', email = 'bob@example.org', verification_token = 'BOB00001', is_verified = True)
+        queryset = CollegeUser.objects.order_by('username')
+
+        def write_first_chunk_only(*args, **kwargs):
+            if OutboxMessage.objects.exists():
+                raise RuntimeError('crash')
+            return enqueue(*args, **kwargs)
+
+        for action in ('enable_accounts', 'disable_accounts', 'force_password_reset'):
+            # one chunk per user, and the second one cannot be written
+            with mock.patch('main.dispatchers.chunked', lambda usernames, size: ([username] for username in usernames)), \
+                 mock.patch('main.dispatchers.enqueue', write_first_chunk_only):
+                with self.assertRaises(RuntimeError):
+                    getattr(self.admin, action)(self.request, queryset)
+            self.assertFalse(OutboxMessage.objects.exists())
+        self.assertTrue(CollegeUser.objects.get(username = 'ana').is_active)
+
+    def test_a_new_user_is_sent_as_one_task_once_committed(self):
+        user = CollegeUser(username = 'bob', email = 'bob@example.org', first_name = 'Bob', last_name = 'Y', verification_token = 'BOB00001', is_verified = True)
+        with mock.patch.object(tasks.app, 'send_task') as send_task:
+            with self.captureOnCommitCallbacks(execute = True) as callbacks:
+                with transaction.atomic():
+                    self.save(user, [], change = False, password_1 = PASSWORD)
+            # nothing is published by the save itself, the relay publishes
+            # the outbox row once the transaction is committed
+            send_task.assert_not_called()
+        self.assertEqual(callbacks, [])
+        message = OutboxMessage.objects.get()
+        self.assertEqual((message.task_name, message.args), ('tasks.create_user', ['bob', PASSWORD]))
+        self.assertEqual(message.kwargs, {'first_name': 'Bob', 'last_name': 'Y', 'enabled': True})
+
+    def test_a_save_that_is_rolled_back_sends_nothing(self):
+        user = CollegeUser(username = 'bob', email = 'bob@example.org', verification_token = 'BOB00001')
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.save(user, [], change = False, password_1 = PASSWORD)
+                raise RuntimeError('rolled back')
+        self.assertFalse(OutboxMessage.objects.exists())
+        self.assertFalse(CollegeUser.objects.filter(username = 'bob').exists())
+
+    def test_edits_without_samba_fields_send_nothing(self):
+        self.user.is_staff = True
+        self.save(self.user, ['is_staff'])
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_deactivating_a_user_disables_its_account(self):
+        self.user.is_active = False
+        self.save(self.user, ['is_active'])
+        message = OutboxMessage.objects.get()
+        self.assertEqual((message.task_name, message.args), ('tasks.apply_to_users_bulk', [['ana'], 'disable']))
+
+class ApplyDirectoryChangesTests(TestCase):
+    def setUp(self):
+        self.user = CollegeUser.objects.create(
+            username = 'joao', email = 'joao@example.org', first_name = 'Jo\u00e3o', last_name = 'Silva',
+            verification_token = 'JOAO0001', is_verified = True
+        )
+
+    def apply(self, **fields):
+        change = {'username': 'joao', 'first_name': 'Joao', 'last_name': 'Silva', 'enabled': True, 'deleted': False, **fields}
+        apply_directory_changes.run('10.0.0.2', [change])
+        self.user.refresh_from_db()
+
+    def test_names_without_accents_are_not_changes(self):
+        self.apply()
+        self.assertEqual(self.user.first_name, 'Jo\u00e3o')
+        self.apply(last_name = 'Souza')
+        self.assertEqual(self.user.last_name, 'Souza')
+
+    def test_accounts_disabled_and_enabled_in_the_directory(self):
+        self.apply(enabled = False)
+        self.assertFalse(self.user.is_active)
+        self.apply(enabled = True)
+        self.assertTrue(self.user.is_active)
+
+    def test_pending_names_are_kept_and_the_other_changes_applied(self):
+        PendingAttributeUpdate.objects.create(username = 'joao', attributes = {'sn': 'Souza'})
+        self.apply(first_name = 'Jose', last_name = 'Pereira', enabled = False)
+        self.assertEqual((self.user.first_name, self.user.last_name), ('Jose', 'Silva'))
+        self.assertFalse(self.user.is_active)
@@ -0,0 +1,59 @@
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from main.dispatchers import broadcast
+from main.models import PendingAttributeUpdate
+from main.tasks import update_user_attributes
+from datetime import timedelta
+
+'''
+    This file coalesces the attribute updates of a user before they reach
+    the samba workers.
+
+    Every profile save used to publish its own tasks.update_user_attributes
+    message, so a user editing the profile a few times in a row (or a script
+    touching many fields one by one) caused as many LDAP writes in every
+    campus. Instead, queue_attribute_update merges the new values into the
+    PendingAttributeUpdate row of the user, the latest values winning, in
+    the transaction of the save. ATTRIBUTE_UPDATE_DEBOUNCE seconds after the
+    row was created, the outbox relay (see the relay_outbox command) calls
+    flush_due_attribute_updates, which removes the row and broadcasts all
+    the merged attributes as a single task, which the samba workers apply in
+    a single modify (and skip when the DC already holds the values).
+'''
+
+FLUSH_BATCH_SIZE = 100
+
+def queue_attribute_update(username, **attributes):
+    '''
+        Queue an update of the samba attributes of a user, e.g.
+        queue_attribute_update('maria', givenName = 'Maria', sn = 'Silva').
+        Updates queued within the debounce window are sent together.
+    '''
+    with transaction.atomic():
+        pending, created = PendingAttributeUpdate.objects.select_for_update().get_or_create(
+            username = username,
+            defaults = {'attributes': attributes}
+        )
+        if not created:
+            pending.attributes.update(attributes)
+            pending.save(update_fields = ['attributes'])
+
+def flush_due_attribute_updates(batch_size = FLUSH_BATCH_SIZE):
+    '''
+        Broadcast, each one as a single tasks.update_user_attributes task,
+        the pending attribute updates whose debounce window is over. Rows
+        locked by a concurrent update are left for the next call.
+
+        Returns: the number of updates sent.
+    '''
+    due = timezone.now() - timedelta(seconds = settings.ATTRIBUTE_UPDATE_DEBOUNCE)
+    with transaction.atomic():
+        pending = list(
+            PendingAttributeUpdate.objects.select_for_update(skip_locked = True)
+            .filter(created_at__lte = due).order_by('created_at')[:batch_size]
+        )
+        for update in pending:
+            broadcast(update_user_attributes, update.username, **update.attributes)
+        PendingAttributeUpdate.objects.filter(id__in = [update.id for update in pending]).delete()
+    return len(pending)
@@ -1,5 +1,5 @@
 from django.urls import path
-from main.views import register, verify_email, index, update_user_attributes, login_view, logout_view, update_user_password
+from main.views import register, verify_email, index, update_user_attributes, login_view, logout_view, update_user_password, task_status
 
 '''
     This file maps URLs that represent actions to the views responsible
@@ -18,4 +18,5 @@ urlpatterns = [
     path('register/', register, name='register'),
     path('verify-email/', verify_email, name='verify_email'),
     path('verify-email/<str:token>/', verify_email, name='verify_email'),
+    path('api/tasks/<str:task_id>/', task_status, name='task_status'),
 ]
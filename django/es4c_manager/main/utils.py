@@ -2,14 +2,25 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import secrets
 from django.conf import settings
+from functools import lru_cache
+import html
 import markdown as md
+import queue
 import smtplib
+import socket
+import threading
+import time
 import unicodedata
 
 '''
     This file contain the functions responsible to send email verification tokens to users.
     The email is sent using the SMTP protocol, and the email content is written in markdown
-    and rendered to HTML using the markdown library.
+    and rendered to HTML using the markdown library. The markdown is rendered only once,
+    to an HTML template, and each message just fills the template with the user's data.
+
+    Messages are sent through a long lived SMTP session (see SMTPSession),
+    and, from the registration view, through the mail celery queue (see
+    main/mail.py), so a slow relay never holds an HTTP request.
 
     This file will be removed in future releases if django's built-in email
     functions are adopted.
@@ -39,24 +50,199 @@ Or by inserting the following token in the verification page:
 
 email_subject_text = 'ES4C Email Verification — {name}, please verify your email'
 
-def send_email_verification_token(user):
+@lru_cache(maxsize = 8)
+def compile_email_body(template_md):
+    '''
+        Convert a markdown e-mail template to HTML. The {placeholders} of
+        the template are kept untouched by markdown, so the result is an
+        HTML template that only needs the per-user values to be filled in.
+        The conversion is cached by template, so it runs once per process.
+    '''
+    return md.markdown(template_md)
+
+# the verification e-mail body is compiled once, at import time
+email_body_html = compile_email_body(email_body_md)
+
+def render_email_body(name, link, token, template_html = email_body_html):
+    '''
+        Fill the compiled HTML template with the per-user values. The values
+        are HTML escaped since they are no longer processed by markdown.
+    '''
+    return template_html.format(
+        name = html.escape(name),
+        link = html.escape(link, quote = True),
+        token = html.escape(token)
+    )
+
+class SMTPSession:
+    '''
+        A long lived SMTP connection that is reused to send many messages.
+
+        Opening a connection to the relay means a TCP handshake, STARTTLS
+        and a login, which used to be paid for every single message. A
+        session keeps the connection open, checks it with a NOOP when it
+        stayed idle for a while, reconnects by itself whenever the relay
+        drops it and recycles it after `max_messages`, since most relays
+        limit how many messages can be sent in a single session.
+    '''
+    def __init__(self, max_messages = 100, idle_check = 30):
+        self.max_messages = max_messages
+        self.idle_check = idle_check
+        self._server = None
+        self._sent = 0
+        self._last_used = 0
+        self._lock = threading.Lock()
+
+    def _open(self):
+        email_settings = settings.VERIFICATION_EMAIL_SETTINGS
+        server = smtplib.SMTP(email_settings['smtp_server'], email_settings['smtp_port'], timeout = 30)
+        if email_settings.get('smtp_use_tls', True):
+            server.starttls()
+        if email_settings['smtp_password']:
+            server.login(email_settings['smtp_username'], email_settings['smtp_password'])
+        self._server = server
+        self._sent = 0
+
+    def _is_alive(self):
+        try:
+            return self._server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._server = None
+
+    def _ensure_open(self):
+        if self._server is not None and self._sent >= self.max_messages:
+            self.close()
+        if self._server is not None and time.monotonic() - self._last_used > self.idle_check:
+            if not self._is_alive():
+                self.close()
+        if self._server is None:
+            self._open()
+
+    def send(self, message):
+        with self._lock:
+            self._ensure_open()
+            try:
+                self._server.send_message(message)
+            except (smtplib.SMTPServerDisconnected, ConnectionError, socket.timeout):
+                # the relay dropped the connection, reconnect and try once
+                # more. Other SMTP errors (e.g. a refused recipient) are
+                # replies of the relay, which a second send would repeat
+                self.close()
+                self._open()
+                self._server.send_message(message)
+            self._sent += 1
+            self._last_used = time.monotonic()
+
+# one session per process, shared by every message sent from it
+smtp_session = SMTPSession(
+    max_messages = settings.VERIFICATION_EMAIL_SETTINGS.get('smtp_session_max_messages', 100)
+)
+
+def build_email_verification_message(user):
     email_settings = settings.VERIFICATION_EMAIL_SETTINGS
     message = MIMEMultipart()
     message['From'] = email_settings['smtp_username']
     message['To'] = user.email
     message['Subject'] = email_subject_text.format(name = user.first_name + ' ' + user.last_name)
-    email_content = md.markdown(
-        email_body_md.format(
-            name = user.first_name + ' ' + user.last_name,
-            link = 'https://' + settings.HOST_FQDN + '/verify-email/{token}'.format(token = user.verification_token),
-            token = user.verification_token
-        )
+    email_content = render_email_body(
+        name = user.first_name + ' ' + user.last_name,
+        link = 'https://' + settings.HOST_FQDN + '/verify-email/{token}'.format(token = user.verification_token),
+        token = user.verification_token
     )
     message.attach(
         MIMEText(email_content, 'html')
     )
-    with smtplib.SMTP(email_settings['smtp_server'], email_settings['smtp_port']) as server:
-        server.starttls()
-        server.login(email_settings['smtp_username'], email_settings['smtp_password'])
-        server.send_message(message)
-        server.quit()
+    return message
+
+def send_email_verification_token(user, session = None):
+    session = session or smtp_session
+    session.send(build_email_verification_message(user))
+
+class RateLimiter:
+    '''
+        A token bucket shared by threads, so that no more than `rate`
+        messages per second are sent, whatever the number of sessions.
+    '''
+    def __init__(self, rate):
+        self.rate = rate
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(1.0, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+def send_email_verification_tokens(users, sessions = 4, rate_limit = None):
+    '''
+        Send the verification token to many users at once, e.g. when a
+        whole cohort is onboarded.
+
+        The messages are sent by `sessions` threads, each one with its own
+        SMTP session that sends many messages before being recycled. Users
+        are read from the iterable as the threads need them, so a queryset
+        iterator of any size can be given.
+
+        Parameters: users - an iterable of CollegeUser objects
+                    sessions - how many SMTP sessions send in parallel
+                    rate_limit - maximum messages per second over all
+                                 sessions (None for no limit), to respect
+                                 the relay quotas
+
+        Returns: a dictionary mapping the e-mail of each user whose message
+                 could not be sent to the error message.
+    '''
+    if sessions < 1:
+        raise ValueError('sessions must be a positive number')
+    if rate_limit is not None and rate_limit <= 0:
+        raise ValueError('rate_limit must be a positive number')
+    limiter = RateLimiter(rate_limit) if rate_limit else None
+    max_messages = settings.VERIFICATION_EMAIL_SETTINGS.get('smtp_session_max_messages', 100)
+    pending = queue.Queue(maxsize = sessions * 2)
+    failures = {}
+    failures_lock = threading.Lock()
+
+    def sender():
+        session = SMTPSession(max_messages = max_messages)
+        try:
+            while True:
+                user = pending.get()
+                if user is None:
+                    return
+                if limiter:
+                    limiter.acquire()
+                try:
+                    send_email_verification_token(user, session)
+                except Exception as e:
+                    with failures_lock:
+                        failures[user.email] = str(e)
+                    session.close()
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target = sender, daemon = True) for _ in range(sessions)]
+    for thread in threads:
+        thread.start()
+    for user in users:
+        pending.put(user)
+    for _ in threads:
+        pending.put(None)
+    for thread in threads:
+        thread.join()
+    return failures
@@ -1,9 +1,15 @@
 from django.shortcuts import render, redirect
 from django.contrib.auth import login, logout, authenticate
 from main.forms import CollegeUserRegistrationForm, CollegeUserLoginForm, CollegeUserChangeForm, CollegeUserPasswordChangeForm
-from main.utils import generate_secure_otp, send_email_verification_token
-from main.tasks import create_user, enable_account, update_user_attributes as celery_update_user_attributes, update_user_password as celery_update_user_password
+from main.utils import generate_secure_otp
+from main.mail import send_verification_email
+from main.dispatchers import broadcast, campus_results, task_belongs_to
+from main.updates import queue_attribute_update
+from main.tasks import create_user, enable_account, update_user_password as celery_update_user_password
 from django.contrib.auth.decorators import login_required
+from django.db import transaction
+from django.http import Http404, JsonResponse
+from functools import partial
 import pdb
 
 from django.contrib import messages
@@ -80,13 +86,14 @@ def _perform_registration(request):
         with the data present in request.POST and if the form is valid, a new
         user object is created with the data present in the form.
 
-        A verification token is generated for the new user and sent to its
-        email address in order to restrain user registration within an
-        organization scope to only those who have access to email addresses
-        allowed by the organization.
+        A verification token is generated for the new user and, once the
+        user object is saved, sent to its email address through the
+        send_verification_email celery task in order to restrain user
+        registration within an organization scope to only those who have
+        access to email addresses allowed by the organization.
 
-        Then the user object is saved and a new user is created on the samba
-        addc servers through the create_user celery task. At the end, the user
+        Then a new user is created on the samba addc servers through the
+        create_user celery task, broadcast to every campus. At the end, the user
         is authenticated, logged in the system and redirected to the verify
         email page so the user can end its registration process.
 
@@ -106,24 +113,33 @@ def _perform_registration(request):
             user.set_password(form.cleaned_data['password_1']) # ensure password is hashed
             # generate a random token for email verification
             user.verification_token = generate_secure_otp()
-            # send this token through email
-            send_email_verification_token(user)
-            # save our user object
-            user.save()
-            # perform user creation on samba addc servers
-            new_user_fields = {
-                'first_name': user.first_name,
-                'last_name': user.last_name,
-            }
-            create_user.delay(
-                user.username,
-                form.cleaned_data['password_1'],
-                **new_user_fields
-            )
+            # the user and its creation task in the outbox are committed
+            # together, so the user is never saved without its task
+            with transaction.atomic():
+                # save our user object
+                user.save()
+                # send this token through email. The e-mail is sent by the mail
+                # celery queue as soon as the user row is committed, so a slow
+                # SMTP relay does not hold this request.
+                transaction.on_commit(partial(send_verification_email.delay, user.pk))
+                # perform user creation on samba addc servers
+                new_user_fields = {
+                    'first_name': user.first_name,
+                    'last_name': user.last_name,
+                }
+                creation = broadcast(
+                    create_user,
+                    user.username,
+                    form.cleaned_data['password_1'],
+                    **new_user_fields
+                )
             # login the user
             user = authenticate(request, username = user.username, password = form.cleaned_data['password_1'])
             # login the user
             login(request, user)
+            # the verify email page follows the creation of the user in
+            # every campus (see main/events.py)
+            request.session['create_user_task_id'] = creation.id
             # redirect to the verify email page
             return redirect('/verify-email/')
     else:
@@ -154,15 +170,17 @@ def update_user_attributes(request):
     if request.method == 'POST':
         form = CollegeUserChangeForm(request.POST, instance = request.user)
         if form.is_valid():
-            form.save()
             update_data = {
                 'givenName': form.cleaned_data['first_name'],
                 'sn': form.cleaned_data['last_name'],
             }
-            celery_update_user_attributes.delay(
-                request.user.username,
-                **update_data
-            )
+            with transaction.atomic():
+                form.save()
+                # repeated saves within a few seconds are sent as one update
+                queue_attribute_update(
+                    request.user.username,
+                    **update_data
+                )
             return redirect('/')
     else:
         form = CollegeUserChangeForm(instance = request.user)
@@ -176,14 +194,16 @@ def update_user_password(request):
         if form.is_valid():
             user = form.save(commit = False)
             user.set_password(form.cleaned_data['password_1'])
-            user.save()
+            with transaction.atomic():
+                user.save()
+                # call celery task to update password on samba addc servers
+                broadcast(
+                    celery_update_user_password,
+                    user.username,
+                    form.cleaned_data['password_1']
+                )
             update_session_auth_hash(request, user)
             messages.success(request, 'Password changed successfully')
-            # call celery task to update password on samba addc servers
-            celery_update_user_password.delay(
-                user.username,
-                form.cleaned_data['password_1']
-            )
             return redirect('/')
         else:
             messages.error(request, 'Please correct the error below')
@@ -210,14 +230,16 @@ def _proceed_user_activation(request, token):
         For default any new user registered is disable in samba, but
         when the user inputs its correct token, its verified flag
         is set to True and the user is enabled in the samba addc servers
-        through the enable_account celery task.
+        through the enable_account celery task, broadcast to every campus.
     '''
     if request.user.verification_token == token:
         request.user.is_verified = True
-        request.user.save()
-        enable_account.delay(
-            request.user.username
-        )
+        with transaction.atomic():
+            request.user.save()
+            broadcast(
+                enable_account,
+                request.user.username
+            )
         return render(request, 'activation/successful.html')
     else:
         return render(request, 'activation/invalid.html')
@@ -233,3 +255,22 @@ def verify_email(request, token = None):
             return _proceed_user_activation(request, token)
         else:
             return render(request, 'verification/verify.html')
+
+def may_watch_task(session, user, task_id):
+    # the creation task is sent before the journal knows its user
+    return session.get('create_user_task_id') == task_id or task_belongs_to(task_id, user.username)
+
+# View with the state of a task in each campus, read from the task journal.
+# Live state changes are streamed by main/events.py instead. Users only see
+# their own tasks.
+@login_required
+def task_status(request, task_id):
+    if not may_watch_task(request.session, request.user, task_id):
+        raise Http404('No such task')
+    return JsonResponse({
+        'task_id': task_id,
+        'campuses': {
+            server_address: {'state': state, 'result': result}
+            for server_address, (state, result) in campus_results(task_id).items()
+        },
+    })
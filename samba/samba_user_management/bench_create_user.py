@@ -0,0 +1,143 @@
+from samba.samdb import SamDB
+from samba.auth import system_session
+from samba import param
+from .tasks import badge, create_user, samdb_pool
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+'''
+    bench_create_user measures what creating a user costs in a samba
+    server: how many LDAP operations (searches, adds, modifies and deletes)
+    and how much time per user, comparing the way create_user used to
+    create users (an existence search, samdb.newuser and disable_account)
+    with the current one (a single add, see _proceed_user_creation in
+    tasks.py). Creating users that already exist is measured as well.
+
+    By default the users are created in a throwaway domain provisioned in a
+    temporary directory (it takes a while), so the server is not touched.
+    With --url, an existing SamDB is used instead (e.g. ldap://localhost,
+    with the credentials of the worker) and the users created are deleted
+    at the end.
+
+    Usage (inside the samba container, from /opt/celery):
+        python3 -m samba_user_management.bench_create_user --users 200
+'''
+
+PASSWORD = 'Bench-Passw0rd!'
+
+class CountingSamDB(SamDB):
+    '''
+        A SamDB that counts the operations sent to the database, including
+        the ones made internally by helpers such as newuser and setpassword.
+    '''
+    operations = 0
+    _depth = 0
+
+    def _count(self, method, *args, **kwargs):
+        # an operation made by another counted operation (e.g. modify_ldif
+        # calling modify) is a single round trip
+        if self._depth == 0:
+            self.operations += 1
+        self._depth += 1
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._depth -= 1
+
+    def search(self, *args, **kwargs):
+        return self._count(SamDB.search, *args, **kwargs)
+
+    def add(self, *args, **kwargs):
+        return self._count(SamDB.add, *args, **kwargs)
+
+    def modify(self, *args, **kwargs):
+        return self._count(SamDB.modify, *args, **kwargs)
+
+    def modify_ldif(self, *args, **kwargs):
+        return self._count(SamDB.modify_ldif, *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self._count(SamDB.delete, *args, **kwargs)
+
+def create_user_before(samdb, username, password):
+    # how create_user created users before: an existence search, newuser
+    # (an add, a modify of the unix attributes and setpassword, which
+    # searches, sets the password and enables the account) and
+    # disable_account (a search and a modify)
+    if samdb.search(base=samdb.domain_dn(), expression=f"(samAccountName={username})", attrs=["dn"]):
+        return 'User ' + username + ' already exists'
+    samdb.newuser(username, password, force_password_change_at_next_login_req=False, givenname='Bench', surname='User', loginshell='/bin/bash', unixhome='/home/' + username, useusernameascn=True)
+    samdb.disable_account('(samAccountName={})'.format(username))
+    return 'User ' + username + ' created'
+
+def create_user_now(samdb, username, password):
+    return create_user(username, password, first_name='Bench', last_name='User')
+
+def provision(targetdir):
+    subprocess.run([
+        'samba-tool', 'domain', 'provision',
+        '--realm=BENCH.TEST', '--domain=BENCH',
+        '--adminpass=' + PASSWORD,
+        '--use-rfc2307',
+        '--targetdir=' + targetdir,
+    ], check=True, stdout=subprocess.DEVNULL)
+    lp = param.LoadParm()
+    lp.load(os.path.join(targetdir, 'etc', 'smb.conf'))
+    return CountingSamDB(url=os.path.join(targetdir, 'private', 'sam.ldb'), session_info=system_session(), lp=lp)
+
+def connect(url):
+    lp = param.LoadParm()
+    lp.load_default()
+    return CountingSamDB(url=url, session_info=None, credentials=badge, lp=lp)
+
+def measure(samdb, create, usernames):
+    samdb.operations = 0
+    start = time.perf_counter()
+    for username in usernames:
+        create(samdb, username, PASSWORD)
+    elapsed = time.perf_counter() - start
+    return samdb.operations / len(usernames), elapsed / len(usernames) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the LDAP operations and the time each created user costs')
+    parser.add_argument('--users', type=int, default=200, help='users created by each approach')
+    parser.add_argument('--url', default=None, help='an existing SamDB, instead of a throwaway domain')
+    options = parser.parse_args()
+
+    targetdir = None
+    if options.url:
+        samdb = connect(options.url)
+    else:
+        targetdir = tempfile.mkdtemp(prefix='bench_create_user')
+        samdb = provision(targetdir)
+
+    # the create_user task borrows the benchmark connection from its pool
+    samdb_pool.clear()
+    samdb_pool._connect = lambda: samdb
+
+    prefix = 'bench{}'.format(os.getpid())
+    created = []
+    try:
+        for label, create in (
+            ('before (newuser)', create_user_before),
+            ('single add', create_user_now),
+        ):
+            usernames = ['{}{}{}'.format(prefix, label[0], number) for number in range(options.users)]
+            operations, milliseconds = measure(samdb, create, usernames)
+            created.extend(usernames)
+            print('{:<18} new users:      {:>5.1f} operations/user {:>8.2f} ms/user'.format(label, operations, milliseconds))
+            operations, milliseconds = measure(samdb, create, usernames)
+            print('{:<18} existing users: {:>5.1f} operations/user {:>8.2f} ms/user'.format(label, operations, milliseconds))
+    finally:
+        if targetdir:
+            shutil.rmtree(targetdir, ignore_errors=True)
+        else:
+            for username in created:
+                samdb.deleteuser(username)
+
+if __name__ == '__main__':
+    main()
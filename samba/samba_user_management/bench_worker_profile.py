@@ -0,0 +1,122 @@
+from celery.result import ResultSet
+from .celery import app
+from .tasks import create_user, delete_user, enable_account, update_user_attributes, update_user_password
+import argparse
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import time
+
+'''
+    bench_worker_profile compares worker profiles (see the worker profile in
+    celery.py) on the user tasks. For each profile, it starts a celery
+    worker consuming a queue of its own, enqueues `--tasks` mixed user
+    tasks at once (create_user, update_user_attributes,
+    update_user_password and enable_account) and reports the tasks per
+    second and the p50 and p99 latencies, from the moment a task is
+    published to the moment its result arrives. The users created are
+    deleted afterwards.
+
+    A profile is written as pool:concurrency:prefetch_multiplier[:acks_late],
+    e.g. threads:8:1 or prefork:4:4:false. gevent profiles need gevent to be
+    installed (pip install gevent).
+
+    Usage (inside the samba container, from /opt/celery):
+        python3 -m samba_user_management.bench_worker_profile --tasks 400 \
+            --profiles prefork:4:4:false prefork:4:1 threads:8:1
+'''
+
+PASSWORD = 'Bench-Passw0rd!'
+
+DEFAULT_PROFILES = ['prefork:4:4:false', 'prefork:4:1', 'threads:8:1']
+
+def parse_profile(profile):
+    pool, concurrency, prefetch, *acks_late = profile.split(':')
+    return {
+        'SAMBA_WORKER_POOL': pool,
+        'SAMBA_WORKER_CONCURRENCY': concurrency,
+        'SAMBA_WORKER_PREFETCH_MULTIPLIER': prefetch,
+        'SAMBA_WORKER_ACKS_LATE': acks_late[0] if acks_late else 'true',
+    }
+
+def percentile(samples, percent):
+    if len(samples) < 2:
+        return samples[0] if samples else 0
+    return statistics.quantiles(samples, n=100, method='inclusive')[percent - 1]
+
+def start_worker(profile, queue, name):
+    worker = subprocess.Popen(
+        ['celery', '-A', 'samba_user_management', 'worker', '-Q', queue, '-n', name,
+         '--loglevel=warning', '--without-gossip', '--without-mingle'],
+        env={**os.environ, **parse_profile(profile)}
+    )
+    # wait for the worker to answer a ping
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if app.control.ping(destination=[name], timeout=1):
+            return worker
+    worker.terminate()
+    raise RuntimeError('The worker of profile ' + profile + ' did not start')
+
+def mixed_tasks(prefix, count):
+    # every user is created, updated, has its password changed and is
+    # enabled. The tasks of a user are published in this order but may run
+    # concurrently (e.g. update a user that is not created yet), as they
+    # may in production
+    for number in range(count):
+        username = '{}{}'.format(prefix, number // 4)
+        yield (
+            (create_user, (username, PASSWORD), {'first_name': 'Bench', 'last_name': 'User'}),
+            (update_user_attributes, (username,), {'sn': 'User {}'.format(number)}),
+            (update_user_password, (username, PASSWORD + '2'), {}),
+            (enable_account, (username,), {}),
+        )[number % 4]
+
+def run(profile, count, queue, number):
+    name = 'bench{}@{}'.format(number, socket.gethostname())
+    prefix = 'bw{}p{}u'.format(os.getpid() % 10000, number)
+    worker = start_worker(profile, queue, name)
+    try:
+        published = {}
+        latencies = []
+        results = []
+        start = time.perf_counter()
+        for task, args, kwargs in mixed_tasks(prefix, count):
+            result = task.apply_async(args, kwargs, queue=queue)
+            published[result.id] = time.perf_counter()
+            results.append(result)
+        ResultSet(results).join_native(
+            callback=lambda task_id, value: latencies.append(time.perf_counter() - published[task_id]),
+            propagate=False
+        )
+        elapsed = time.perf_counter() - start
+
+        ResultSet([
+            delete_user.apply_async(('{}{}'.format(prefix, user),), queue=queue)
+            for user in range((count + 3) // 4)
+        ]).join_native(propagate=False)
+    finally:
+        worker.send_signal(signal.SIGTERM)
+        worker.wait()
+    return count / elapsed, percentile(latencies, 50), percentile(latencies, 99)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare celery worker profiles on the user tasks')
+    parser.add_argument('--tasks', type=int, default=400, help='tasks enqueued per profile')
+    parser.add_argument('--profiles', nargs='+', default=DEFAULT_PROFILES, help='pool:concurrency:prefetch[:acks_late]')
+    options = parser.parse_args()
+
+    queue = 'bench_worker_profile.{}'.format(os.getpid())
+    for number, profile in enumerate(options.profiles):
+        throughput, p50, p99 = run(profile, options.tasks, queue, number)
+        print('{:<20} {:>8.1f} tasks/s   p50 {:>8.1f} ms   p99 {:>8.1f} ms'.format(
+            profile, throughput, p50 * 1000, p99 * 1000
+        ))
+
+    with app.connection_for_write() as connection:
+        connection.default_channel.queue_delete(queue)
+
+if __name__ == '__main__':
+    main()
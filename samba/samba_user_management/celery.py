@@ -1,6 +1,17 @@
 
 from celery import Celery
+from celery.exceptions import Retry
+from celery.signals import task_prerun, task_success, task_failure, worker_ready, worker_shutdown
+from kombu import Exchange, Queue, binding
+from .completed_tasks import MISSING, completed_tasks
+import task_contract
+import ldb
 import os
+import queue
+import random
+import socket
+import threading
+import time
 
 celery_broker = os.environ['RABBITMQ_HOST']
 broker_port = os.environ['RABBITMQ_PORT']
@@ -12,6 +23,84 @@ broker_vhost = os.environ['RABBITMQ_VHOST']
 broker_url = 'amqps://' + broker_user + ':' + broker_password + '@' + celery_broker + ':' + broker_port + '/' + broker_vhost
 backend_url = 'rpc://' + broker_user + ':' + broker_password + '@' + celery_broker + ':' + broker_port + '/' + broker_vhost
 
+class SambaTask(task_contract.ContractTask):
+    '''
+        Base task class of the samba workers, which runs each operation
+        once: a message whose idempotency key (or task id, for messages
+        without one) is among the completed tasks (see completed_tasks.py)
+        gets the result of the first run instead of touching the server.
+
+        A task that fails with a transient error (see is_transient) is
+        retried, with exponential backoff and jitter, up to
+        task_max_retries times. A task that fails with any other error, or
+        that keeps failing, is sent to the dead letter queue of this campus
+        (see dead_letter) and marked as failed.
+    '''
+    def __call__(self, *args, **kwargs):
+        key = task_contract.header(self.request, 'idempotency_key') or self.request.id
+        if key:
+            result = completed_tasks.get(key)
+            if result is not MISSING:
+                print(f"Skipping {self.name} {key}, already completed")
+                return result
+        try:
+            result = super().__call__(*args, **kwargs)
+        except Retry:
+            raise
+        except Exception as e:
+            # a direct call (e.g. from another task) is not a message
+            if self.request.called_directly:
+                raise
+            if is_transient(e) and self.request.retries < task_max_retries:
+                raise self.retry(
+                    exc=e,
+                    countdown=retry_delay(self.request.retries),
+                    max_retries=task_max_retries,
+                    headers=self.message_headers(),
+                    **task_contract.redact(self.name, self.request.args, self.request.kwargs),
+                    # back to the queue of this worker, not to an exchange
+                    # that fans out to every campus
+                    **queue_route(origin_queue(self.request))
+                )
+            self.dead_letter(e)
+            raise
+        if key:
+            completed_tasks.put(key, self.name, result)
+        return result
+
+    def message_headers(self):
+        # the headers of the task contract, kept by retries and replays
+        return {
+            name: task_contract.header(self.request, name)
+            for name in ('contract_version', 'idempotency_key')
+            if task_contract.header(self.request, name) is not None
+        }
+
+    def dead_letter(self, error):
+        '''
+            Publish the message of the task being run to the dead letter
+            queue, along with the error and the queue it came from, so
+            replay_dead_letters can send it again.
+        '''
+        try:
+            app.send_task(
+                self.name,
+                args=self.request.args,
+                kwargs=self.request.kwargs,
+                task_id=self.request.id,
+                headers={
+                    **self.message_headers(),
+                    'dead_letter_error': repr(error),
+                    'dead_letter_queue': origin_queue(self.request),
+                    'dead_letter_retries': self.request.retries,
+                },
+                queue=dead_letter_queue,
+                **task_contract.redact(self.name, self.request.args, self.request.kwargs)
+            )
+            print(f"Task {self.name} {self.request.id} sent to {dead_letter_queue.name}: {error!r}")
+        except Exception as e:
+            print(f"Could not dead letter {self.name} {self.request.id}: {e}")
+
 app = Celery(
     'samba_user_management_tasks',
     broker=broker_url,
@@ -22,12 +111,226 @@ app = Celery(
         'ca_certs': '/opt/certificates/rabbitmq_cacert.pem',
         'cert_reqs': True
     },
-    include = ['samba_user_management.tasks']
+    include = ['samba_user_management.tasks'],
+    # refuse messages of newer task contracts (see task_contract) and skip
+    # the ones already completed
+    task_cls=SambaTask
 )
 
 app.conf.update(
-    BROKER_HEARTBEAT=10,
-    BROKER_HEARTBEAT_CHECKRATE=2.0,
-    CELERY_RESULT_EXPIRES=3600,
+    broker_heartbeat=10,
+    broker_heartbeat_checkrate=2.0,
+    result_expires=3600,
+    # task events feed the task state streams of the django app
+    # (main/events.py). They carry the argsrepr and kwargsrepr of each
+    # message, which every publisher redacts (see task_contract)
+    worker_send_task_events=True,
+    task_send_sent_event=True,
 )
 
+# The worker profile. User tasks are short and spend their time waiting for
+# LDAP, so by default each process only reserves the message it is running
+# (prefetch multiplier 1), instead of queueing prefetched messages behind a
+# slow one, and messages are only acknowledged once their task finished, so
+# the tasks of a worker killed mid-way are delivered again (the tasks that
+# already completed are skipped, see SambaTask). The pool type and concurrency are the ones of the
+# `celery worker` command line, which takes them from here.
+WORKER_POOLS = ('prefork', 'threads', 'gevent', 'solo')
+
+def env_flag(name, default):
+    return os.environ.get(name, default).lower() in ('1', 'true', 'yes')
+
+# The role of the worker tells which queues it consumes (see below):
+# interactive, bulk or all of them. The samba container runs an interactive
+# and a bulk worker, each one with its own processes, so bulk jobs never
+# take the capacity reserved for interactive operations.
+WORKER_ROLES = ('interactive', 'bulk', 'all')
+
+worker_role = os.environ.get('SAMBA_WORKER_ROLE', 'all')
+if worker_role not in WORKER_ROLES:
+    raise ValueError(f"SAMBA_WORKER_ROLE must be one of {', '.join(WORKER_ROLES)}, not {worker_role}")
+
+worker_pool = os.environ.get('SAMBA_WORKER_POOL', 'prefork')
+if worker_pool not in WORKER_POOLS:
+    raise ValueError(f"SAMBA_WORKER_POOL must be one of {', '.join(WORKER_POOLS)}, not {worker_pool}")
+
+if worker_role == 'bulk':
+    worker_concurrency = int(os.environ.get('SAMBA_BULK_WORKER_CONCURRENCY', '1'))
+else:
+    worker_concurrency = int(os.environ.get('SAMBA_WORKER_CONCURRENCY', '0'))
+
+app.conf.update(
+    worker_pool=worker_pool,
+    # prefork defaults to one process per CPU
+    worker_concurrency=worker_concurrency or (
+        None if worker_pool == 'prefork' else 8
+    ),
+    worker_prefetch_multiplier=int(os.environ.get('SAMBA_WORKER_PREFETCH_MULTIPLIER', '1')),
+    task_acks_late=env_flag('SAMBA_WORKER_ACKS_LATE', 'true'),
+    task_reject_on_worker_lost=env_flag('SAMBA_WORKER_REJECT_ON_WORKER_LOST', 'true'),
+)
+
+# Every samba worker consumes its own campus queue, named after the address
+# of its server (the same address registered in the django Campus model),
+# which is bound to the broadcast (fanout) exchange. A user operation
+# published once to this exchange is thus applied by every DC in parallel.
+# The same queue is bound to the campus (direct) exchange with the address
+# as routing key, so an operation can also target this DC only.
+# The default queue is still consumed, for operations sent to any one DC.
+#
+# Bulk jobs (imports, reconciliation, change feeds) go through a second pair
+# of exchanges to a second campus queue (samba.<address>.bulk), so a batch
+# of thousands of users never sits in front of a password change. Django
+# picks the exchanges of each task (see main/dispatchers.py).
+server_address = os.environ.get('SAMBA_SERVER_ADDRESS', os.environ.get('SERVER_IP', 'localhost'))
+
+broadcast_exchange = Exchange('samba.broadcast', type='fanout')
+campus_exchange = Exchange('samba.campus', type='direct')
+campus_queue = Queue('samba.' + server_address, bindings=[
+    binding(broadcast_exchange),
+    binding(campus_exchange, routing_key=server_address),
+])
+
+bulk_broadcast_exchange = Exchange('samba.broadcast.bulk', type='fanout')
+bulk_campus_exchange = Exchange('samba.campus.bulk', type='direct')
+campus_bulk_queue = Queue('samba.' + server_address + '.bulk', bindings=[
+    binding(bulk_broadcast_exchange),
+    binding(bulk_campus_exchange, routing_key=server_address),
+])
+
+app.conf.task_queues = {
+    'interactive': (Queue('celery'), campus_queue),
+    'bulk': (campus_bulk_queue,),
+    'all': (Queue('celery'), campus_queue, campus_bulk_queue),
+}[worker_role]
+
+# Messages that failed for good (a permanent error, or a transient one
+# that outlasted every retry) are kept, one queue per campus, in the dead
+# letter queue (samba.<address>.dead), which no worker consumes. Once the
+# cause is fixed, replay_dead_letters publishes them again to the queue
+# they came from.
+dead_letter_exchange = Exchange('samba.dead', type='direct')
+dead_letter_queue = Queue('samba.' + server_address + '.dead', exchange=dead_letter_exchange, routing_key=server_address)
+
+def queue_route(name):
+    '''
+        The options of app.send_task (or Task.retry) that publish a message
+        straight to an existing queue, through the default exchange. celery
+        routes messages by queue: an exchange and routing key given without
+        one are replaced by the ones of the default queue (celery).
+    '''
+    return {'queue': Queue(name, routing_key=name, no_declare=True)}
+
+def origin_queue(request):
+    '''
+        The name of the queue a task message was consumed from, which
+        retries and replays are sent to (see queue_route).
+    '''
+    delivery_info = request.delivery_info or {}
+    exchange = delivery_info.get('exchange')
+    if exchange in (bulk_broadcast_exchange.name, bulk_campus_exchange.name):
+        return campus_bulk_queue.name
+    if exchange in (broadcast_exchange.name, campus_exchange.name):
+        return campus_queue.name
+    # the default queue, or a retried or replayed message
+    return delivery_info.get('routing_key') or 'celery'
+
+# The retries of transient failures: the samba server restarting, busy or
+# unreachable. The n-th retry waits a random time between 0 and
+# SAMBA_TASK_RETRY_BACKOFF * 2^n seconds (capped by
+# SAMBA_TASK_RETRY_BACKOFF_MAX), so the tasks held back by a DC restart do
+# not all hit it again at the same moment. With the defaults, a task keeps
+# being retried for about 8 minutes.
+task_max_retries = int(os.environ.get('SAMBA_TASK_MAX_RETRIES', '8'))
+retry_backoff = float(os.environ.get('SAMBA_TASK_RETRY_BACKOFF', '2'))
+retry_backoff_max = float(os.environ.get('SAMBA_TASK_RETRY_BACKOFF_MAX', '600'))
+
+# ldb errors of a server that is down, restarting or overloaded (a failed
+# connection is an operations error). The others (constraint violations,
+# invalid attributes, ...) fail the same way when retried.
+TRANSIENT_LDB_ERRORS = frozenset((
+    ldb.ERR_OPERATIONS_ERROR,
+    ldb.ERR_TIME_LIMIT_EXCEEDED,
+    ldb.ERR_BUSY,
+    ldb.ERR_UNAVAILABLE,
+))
+
+def is_transient(error):
+    if isinstance(error, ldb.LdbError):
+        return bool(error.args) and error.args[0] in TRANSIENT_LDB_ERRORS
+    # queue.Empty: every pooled samba connection was busy (see SamDBPool)
+    return isinstance(error, (ConnectionError, TimeoutError, queue.Empty))
+
+def retry_delay(retries):
+    return random.uniform(0, min(retry_backoff_max, retry_backoff * 2 ** retries))
+
+# start time of the tasks being run by this worker process
+task_started = {}
+
+def report_result(task, task_id, status, result):
+    '''
+        Send the result of every operation back to django (to its `results`
+        queue), tagged with the address of this campus and with the task
+        timings, so django can journal which DCs applied the operation and
+        which did not (see django's main/journal.py).
+    '''
+    args = task.request.args or ()
+    app.send_task(
+        task_contract.record_result.name,
+        **task_contract.record_result.message((
+            task_id, task.name, server_address, status, str(result),
+            task_started.pop(task_id, None), time.time(),
+            args[0] if args and isinstance(args[0], str) else '',
+        )),
+        queue='results'
+    )
+
+@task_prerun.connect
+def record_start(task_id=None, **kwargs):
+    task_started[task_id] = time.time()
+
+@task_success.connect
+def report_success(sender=None, result=None, **kwargs):
+    report_result(sender, sender.request.id, 'SUCCESS', result)
+
+@task_failure.connect
+def report_failure(sender=None, task_id=None, exception=None, **kwargs):
+    report_result(sender, task_id, 'FAILURE', repr(exception))
+
+# the heartbeat tells django that this campus worker is alive and how many
+# messages are waiting in its queue (see the Campus model in django)
+heartbeat_interval = float(os.environ.get('SAMBA_HEARTBEAT_INTERVAL', '30'))
+heartbeat_stop = threading.Event()
+
+def send_heartbeat():
+    with app.connection_for_write() as connection:
+        queue_depth = campus_queue.bind(connection.default_channel).queue_declare(passive=True).message_count
+        app.send_task(
+            task_contract.heartbeat.name,
+            **task_contract.heartbeat.message((server_address, socket.gethostname(), queue_depth)),
+            queue='results',
+            expires=heartbeat_interval * 2,
+            connection=connection
+        )
+
+def heartbeat_loop():
+    while not heartbeat_stop.wait(heartbeat_interval):
+        try:
+            send_heartbeat()
+        except Exception as e:
+            print(f"Could not send heartbeat: {e}")
+
+@worker_ready.connect
+def start_heartbeat(**kwargs):
+    # the interactive worker speaks for the campus
+    if worker_role == 'bulk':
+        return
+    try:
+        send_heartbeat()
+    except Exception as e:
+        print(f"Could not send heartbeat: {e}")
+    threading.Thread(target=heartbeat_loop, daemon=True).start()
+
+@worker_shutdown.connect
+def stop_heartbeat(**kwargs):
+    heartbeat_stop.set()
@@ -0,0 +1,80 @@
+import json
+import os
+import sqlite3
+import threading
+
+'''
+    CompletedTasks is the store of the idempotency keys of the tasks this
+    worker completed, so a task delivered twice (redelivered after a lost
+    acknowledgement, published twice by the outbox relay of django) is not
+    run twice: the second delivery returns the result of the first one
+    without touching the samba server. It matters for more than speed: a
+    password written twice may, for instance, trip the password history
+    policy of the domain.
+
+    The keys are kept in a SQLite database on local disk, so they survive
+    worker restarts and are shared by every process (and by the interactive
+    and bulk workers) of the container. Only the `size` most recent keys
+    are kept: duplicates arrive within minutes, not weeks. A lookup is a
+    primary key search in a local file, a few microseconds.
+'''
+
+MISSING = object()
+
+class CompletedTasks:
+    def __init__(self, path, size=100000, prune_every=1000):
+        self.path = path
+        self.size = size
+        self.prune_every = prune_every
+        self._local = threading.local()
+        self._puts = 0
+
+    def _connection(self):
+        # a connection per thread, opened again after a fork (prefork pool)
+        if getattr(self._local, 'pid', None) != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS completed ('
+                'key TEXT PRIMARY KEY, task TEXT, result TEXT, completed_at INTEGER DEFAULT (strftime(\'%s\', \'now\')))'
+            )
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def get(self, key):
+        '''
+            Returns: the result of the completed task with this key, or
+                     MISSING if there is none.
+        '''
+        row = self._connection().execute('SELECT result FROM completed WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return MISSING
+        return json.loads(row[0])
+
+    def put(self, key, task, result):
+        connection = self._connection()
+        connection.execute(
+            'INSERT OR REPLACE INTO completed (key, task, result) VALUES (?, ?, ?)',
+            (key, task, json.dumps(result, default=str))
+        )
+        self._puts += 1
+        if self._puts % self.prune_every == 0:
+            self.prune()
+
+    def prune(self):
+        # rowids grow with every insert, so the most recent keys are the
+        # ones with the highest rowids
+        self._connection().execute(
+            'DELETE FROM completed WHERE rowid <= (SELECT MAX(rowid) FROM completed) - ?',
+            (self.size,)
+        )
+
+completed_tasks = CompletedTasks(
+    os.environ.get('SAMBA_COMPLETED_TASKS_PATH', '/var/lib/samba-celery/completed_tasks.sqlite3'),
+    size=int(os.environ.get('SAMBA_COMPLETED_TASKS_SIZE', '100000')),
+)
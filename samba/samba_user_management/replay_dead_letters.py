@@ -0,0 +1,81 @@
+from .celery import app, dead_letter_queue, queue_route
+import argparse
+import task_contract
+
+'''
+    replay_dead_letters lists or publishes again the messages of the dead
+    letter queue of this campus (see SambaTask in celery.py): the tasks
+    that failed with a permanent error or kept failing after every retry.
+    Once the cause is fixed (e.g. the DC is back, the worker was upgraded
+    to a newer task contract), each message is sent back to the queue it
+    came from, with its task id and idempotency key, and removed from the
+    dead letter queue once the broker confirmed it.
+
+    Usage (inside the samba container, from /opt/celery):
+        python3 -m samba_user_management.replay_dead_letters --list
+        python3 -m samba_user_management.replay_dead_letters --limit 100
+'''
+
+# the headers of the dead letter message published again with the task
+REPLAYED_HEADERS = ('contract_version', 'idempotency_key')
+
+def dead_letters(connection, limit):
+    '''
+        Yield up to `limit` messages of the dead letter queue, oldest first,
+        without acknowledging them: the ones not acknowledged go back to
+        the queue when the connection is closed.
+    '''
+    queue = dead_letter_queue.bind(connection.default_channel)
+    queue.declare()
+    count = 0
+    while limit is None or count < limit:
+        message = queue.get(no_ack=False, accept=['json'])
+        if message is None:
+            return
+        count += 1
+        yield message
+
+def describe(message):
+    headers = message.headers
+    args, _, _ = message.decode()
+    # only the username, the other arguments may hold passwords
+    username = args[0] if args and isinstance(args[0], str) else ''
+    return '{} {}({}) from {} after {} retries: {}'.format(
+        headers['id'], headers['task'], username,
+        headers.get('dead_letter_queue'), headers.get('dead_letter_retries'), headers.get('dead_letter_error')
+    )
+
+def replay(message, connection):
+    headers = message.headers
+    args, kwargs, _ = message.decode()
+    app.send_task(
+        headers['task'],
+        args=args,
+        kwargs=kwargs,
+        task_id=headers['id'],
+        headers={name: headers[name] for name in REPLAYED_HEADERS if name in headers},
+        # straight to the queue it came from, through the default exchange
+        **queue_route(headers.get('dead_letter_queue') or 'celery'),
+        connection=connection,
+        **task_contract.redact(headers['task'], args, kwargs)
+    )
+    message.ack()
+
+def main():
+    parser = argparse.ArgumentParser(description='List or replay the dead lettered samba tasks')
+    parser.add_argument('--list', action='store_true', help='only list the messages, leaving them in the queue')
+    parser.add_argument('--limit', type=int, default=None, help='messages listed or replayed, all of them by default')
+    options = parser.parse_args()
+
+    replayed = 0
+    with app.connection_for_write(transport_options={'confirm_publish': True}) as connection:
+        for message in dead_letters(connection, options.limit):
+            print(describe(message))
+            if not options.list:
+                replay(message, connection)
+                replayed += 1
+    if not options.list:
+        print(f"{replayed} messages replayed from {dead_letter_queue.name}")
+
+if __name__ == '__main__':
+    main()
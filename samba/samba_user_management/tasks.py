@@ -1,19 +1,30 @@
 
 from __future__ import unicode_literals
 
-from .celery import app
+from .celery import app, is_transient
 
+import task_contract
+from task_contract import normalize
 from samba.samdb import SamDB
-from samba import param
+from samba import dsdb, param
 from samba.credentials import Credentials
+from celery.signals import worker_process_init, worker_process_shutdown, worker_ready
+from collections import OrderedDict
+from contextlib import contextmanager
+import base64
 import ldb
-import unicodedata
+import queue
+import secrets
+import threading
+import time
 import os
 
 '''
-    This file is exactly the same as the tasks.py present either in django
-    `es4c_manager/main/tasks.py` and in each of the samba workers,
-    as the celery documentation, as far as the author knows, recommends.
+    This file contains the tasks run by the samba workers. Their names and
+    signatures are declared by the task contract (task_contract, at the
+    root of the repository), which is all the django app knows about them:
+    it publishes them by name (see django's main/tasks.py), so it does not
+    need the samba python library.
 
     Here you can see that Samba Users operations are made by the use of
     the samba python library and LDAP filters.
@@ -35,44 +46,370 @@ badge.guess(lp)
 badge.set_username('Administrator')
 badge.set_password(server_admin_password)
 
-# this ldif template is used to update user attributes on the samba server.
-# It is required by the update_user_attributes task.
+# these ldif templates are used to update user attributes on the samba
+# server. They are required by the update_user_attributes task, which
+# replaces every changed attribute in a single modify: one replace
+# section per attribute, separated by '-'.
 ldif_template = '''dn: {dn}
 changetype: modify
-replace: {attr}
-{attr}: {value}
+{changes}'''
+
+ldif_replace_template = '''replace: {attr}
+{attr}{value}
+-
 '''
 
-def normalize(s):
-    return str(unicodedata.normalize('NFKD', s).encode('ascii', 'ignore').decode('utf-8'))
+# this one is used by the update_user_password task. The password is
+# written as samdb.setpassword does, base64 encoded in UTF-16 and quoted.
+ldif_password_template = '''dn: {dn}
+changetype: modify
+replace: unicodePwd
+unicodePwd:: {password}
+'''
 
-def user_exists(username):
+# and this one to switch flags of userAccountControl, replacing its value
+# only if it did not change since it was read, as samdb.enable_account does
+ldif_account_control_template = '''dn: {dn}
+changetype: modify
+delete: userAccountControl
+userAccountControl: {old}
+-
+add: userAccountControl
+userAccountControl: {new}
+'''
+
+def ldif_value(value):
+    '''
+        Format an attribute value for a LDIF line. Values that are not safe
+        LDIF strings (e.g. names with accents) are base64 encoded.
     '''
-        Check if a user exists in the Samba server.
+    value = str(value)
+    safe = (
+        value.isascii()
+        and not any(c in value for c in '\0\r\n')
+        and not value.startswith((' ', ':', '<'))
+        and not value.endswith(' ')
+    )
+    if safe:
+        return ': ' + value
+    return ':: ' + base64.b64encode(value.encode('utf-8')).decode('ascii')
 
-        Parameters: username - the username of the user to check
+class SamDBPool:
+    '''
+        A small pool of already bound SamDB connections.
 
-        Returns: True if the user exists, False otherwise
+        Opening a SamDB means a new LDAP bind and a schema load, which used
+        to happen on every task (twice on create_user). The pool keeps up to
+        `size` connections per worker process and lends them to the tasks
+        through the `connection` context manager:
+
+            with samdb_pool.connection() as samdb:
+                samdb.search(...)
+
+        A connection that stayed idle longer than `check_interval` seconds
+        is checked with a cheap rootDSE search before being lent. Whenever
+        an ldb.LdbError escapes the `with` block, the connection is
+        discarded, so the next borrower gets a fresh bind instead of a
+        broken socket (e.g. after a samba restart).
     '''
-    # Connect to the SamDB
-    samdb = SamDB(url="ldap://localhost", session_info=None, credentials=badge, lp=lp)
+    def __init__(self, size=1, check_interval=30, timeout=30):
+        self.size = size
+        self.check_interval = check_interval
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
 
-    try:
-        # Try to get the user DN thorugh samdb.search and the filter expression
-        # (samAccountName=username). If the user does not exist, an exception
-        # will be raised and the function will return False. Else, it will return
-        # True.
-        username = normalize(username)
-        user_dn = samdb.search(base=samdb.domain_dn(), expression=f"(samAccountName={username})", attrs=["dn"])
-        if user_dn:
-            print(f"User {username} exists.")
+    def _connect(self):
+        return SamDB(url='ldap://localhost', session_info=None, credentials=badge, lp=lp)
+
+    def _is_healthy(self, samdb):
+        try:
+            samdb.search(base='', scope=ldb.SCOPE_BASE, attrs=['dnsHostName'])
             return True
+        except ldb.LdbError:
+            return False
+
+    def fill(self):
+        '''
+            Open connections until the pool holds `size` of them. It is
+            called when a worker process starts, so the bind cost is paid
+            before the first task arrives.
+        '''
+        while True:
+            with self._lock:
+                if self._created >= self.size:
+                    return
+                self._created += 1
+            try:
+                self._idle.put((self._connect(), time.monotonic()))
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+    def clear(self):
+        '''
+            Drop every idle connection of the pool.
+        '''
+        while True:
+            try:
+                self._idle.get_nowait()
+            except queue.Empty:
+                return
+            with self._lock:
+                self._created -= 1
+
+    def _acquire(self):
+        try:
+            samdb, last_used = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created < self.size
+                if can_create:
+                    self._created += 1
+            if not can_create:
+                # every connection is lent, wait for one to be released
+                samdb, last_used = self._idle.get(timeout=self.timeout)
+            else:
+                try:
+                    return self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+        if time.monotonic() - last_used > self.check_interval and not self._is_healthy(samdb):
+            try:
+                samdb = self._connect()
+            except Exception:
+                self._discard()
+                raise
+        return samdb
+
+    def _discard(self):
+        with self._lock:
+            self._created -= 1
+
+    @contextmanager
+    def connection(self):
+        samdb = self._acquire()
+        try:
+            yield samdb
+        except ldb.LdbError:
+            # the connection may be broken, do not give it back
+            self._discard()
+            raise
+        except BaseException:
+            self._idle.put((samdb, time.monotonic()))
+            raise
+        else:
+            self._idle.put((samdb, time.monotonic()))
+
+# the pool is sized through environment variables so it can follow the
+# worker pool type and concurrency (e.g. threads need more than one
+# connection per process, prefork is fine with one). By default, thread
+# and green thread pools get a connection per concurrent task.
+if app.conf.worker_pool in ('threads', 'gevent') and app.conf.worker_concurrency:
+    default_pool_size = app.conf.worker_concurrency
+else:
+    default_pool_size = 1
+
+samdb_pool = SamDBPool(
+    size=int(os.environ.get('SAMDB_POOL_SIZE', default_pool_size)),
+    check_interval=float(os.environ.get('SAMDB_POOL_CHECK_INTERVAL', '30')),
+    timeout=float(os.environ.get('SAMDB_POOL_TIMEOUT', '30')),
+)
+
+class UserDNCache:
+    '''
+        An in-process LRU cache, with a TTL, of the DNs of the users.
+
+        Most tasks only search for a user to learn its DN before writing to
+        it. With the DN cached, they write to it right away (or read it with
+        a base search, when they need its current values). The tasks keep
+        the cache consistent with their own changes: create_user caches the
+        DN of the user it adds and delete_user drops it. Changes made by
+        other means (samba-tool, another DC, a rename) are caught by:
+            - the TTL, after which the DN is searched again;
+            - a DN that no longer exists, which makes the task search it
+              again and retry once (see _apply_to_user);
+            - optionally, a periodic refresh that drops the users changed
+              since the last one, read from their uSNChanged (see refresh).
+    '''
+    def __init__(self, size=10000, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._usn = None
+
+    @staticmethod
+    def _key(username):
+        # samAccountName comparisons are case insensitive
+        return normalize(username).lower()
+
+    def get(self, username):
+        key = self._key(username)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            dn, expires = entry
+            if time.monotonic() > expires:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return dn
+
+    def put(self, username, dn):
+        if self.size <= 0:
+            return
+        key = self._key(username)
+        with self._lock:
+            self._entries[key] = (str(dn), time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username):
+        with self._lock:
+            self._entries.pop(self._key(username), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._usn = None
+
+    def refresh(self, samdb):
+        '''
+            Drop the users changed (including renamed or deleted) since the
+            previous refresh, found by their uSNChanged.
+        '''
+        usn = highest_committed_usn(samdb)
+        if self._usn is not None and usn > self._usn:
+            changed = samdb.search(
+                base=domain_constants(samdb)['dn'],
+                scope=ldb.SCOPE_SUBTREE,
+                expression=f"(&(objectClass=user)(uSNChanged>={self._usn + 1}))",
+                attrs=['sAMAccountName'],
+                # deleted users are only found with this control
+                controls=['show_deleted:1']
+            )
+            for entry in changed:
+                if 'sAMAccountName' in entry:
+                    self.invalidate(str(entry['sAMAccountName'][0]))
+        self._usn = usn
+
+    def _refresh_periodically(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                with samdb_pool.connection() as samdb:
+                    self.refresh(samdb)
+            except Exception as e:
+                # better forget every DN than keep stale ones
+                self.clear()
+                print(f"Could not refresh the user DN cache: {e}")
+
+    def start_refresh(self, interval):
+        threading.Thread(target=self._refresh_periodically, args=(interval,), daemon=True).start()
+
+# like the pool, the cache is sized through environment variables. The
+# refresh runs every SAMBA_DN_CACHE_REFRESH_INTERVAL seconds, if not 0.
+user_dns = UserDNCache(
+    size=int(os.environ.get('SAMBA_DN_CACHE_SIZE', '10000')),
+    ttl=float(os.environ.get('SAMBA_DN_CACHE_TTL', '300')),
+)
+dn_cache_refresh_interval = float(os.environ.get('SAMBA_DN_CACHE_REFRESH_INTERVAL', '0'))
+
+# the domain of a DC never changes, so its DN and DNS name are computed
+# once per process
+_domain = {}
+
+def highest_committed_usn(samdb):
+    # every change made to a DC gets the next USN of that DC
+    return int(samdb.search(base='', scope=ldb.SCOPE_BASE, attrs=['highestCommittedUSN'])[0]['highestCommittedUSN'][0])
+
+def domain_constants(samdb):
+    if not _domain:
+        domain_dn = str(samdb.domain_dn())
+        _domain['dn'] = domain_dn
+        _domain['dnsdomain'] = ldb.Dn(samdb, domain_dn).canonical_str().replace('/', '')
+    return _domain
+
+@worker_process_init.connect
+def _open_samdb_pool(**kwargs):
+    # connections must be opened after the fork, never inherited from the
+    # parent process
+    samdb_pool.clear()
+    user_dns.clear()
+    try:
+        samdb_pool.fill()
     except Exception as e:
-        print(f"User {username} does not exist. Error: {e}")
+        # the pool will be filled lazily on the first borrow
+        print(f"Could not prefill the SamDB pool: {e}")
+    if dn_cache_refresh_interval > 0:
+        user_dns.start_refresh(dn_cache_refresh_interval)
+
+@worker_ready.connect
+def _start_dn_cache_refresh(**kwargs):
+    # worker_process_init is only sent to the processes of a prefork pool,
+    # the other pools run the tasks in the main process
+    if app.conf.worker_pool != 'prefork' and dn_cache_refresh_interval > 0:
+        user_dns.start_refresh(dn_cache_refresh_interval)
+
+@worker_process_shutdown.connect
+def _close_samdb_pool(**kwargs):
+    samdb_pool.clear()
 
-    return False
+def _search_user_dn(samdb, username):
+    result = samdb.search(
+        base=domain_constants(samdb)['dn'],
+        scope=ldb.SCOPE_SUBTREE,
+        expression=f"(samAccountName={ldb.binary_encode(normalize(username))})",
+        attrs=[]
+    )
+    if not result:
+        return None
+    user_dns.put(username, result[0].dn)
+    return str(result[0].dn)
+
+def _apply_to_user(samdb, username, operation, dn=None):
+    '''
+        Call operation(dn) with the DN of the user: the given one (e.g.
+        resolved for a whole chunk), or the cached one when possible. Such
+        a DN may be stale (e.g. the user was renamed or deleted by other
+        means): if it no longer exists, the DN is searched again and the
+        operation is retried once.
+
+        Returns: the value returned by operation, or None if the user does
+                 not exist.
+    '''
+    cached = dn or user_dns.get(username)
+    dn = cached or _search_user_dn(samdb, username)
+    if dn is None:
+        return None
+    try:
+        return operation(dn)
+    except ldb.LdbError as e:
+        if cached is None or e.args[0] != ldb.ERR_NO_SUCH_OBJECT:
+            raise
+    user_dns.invalidate(username)
+    dn = _search_user_dn(samdb, username)
+    if dn is None:
+        return None
+    return operation(dn)
 
-def _proceed_user_creation(username, password, **kwargs):
+# userAccountControl of the users created by the tasks: a normal account,
+# disabled until the user verifies its e-mail (see enable_account)
+NEW_USER_ACCOUNT_CONTROL = dsdb.UF_NORMAL_ACCOUNT | dsdb.UF_ACCOUNTDISABLE
+
+def _new_user_message(samdb, username, password, **kwargs):
+    '''
+        Build the entry of a new user, with the same attributes set by
+        samdb.newuser (using the username as CN), plus its password and its
+        userAccountControl, so the user is created by a single add.
+    '''
     # here all attributes from the celery user creation task
     # extracted and normalized to avoid encoding issues.
     givenname = normalize(kwargs.get('first_name', ''))
@@ -81,121 +418,257 @@ def _proceed_user_creation(username, password, **kwargs):
     unixhome = normalize(kwargs.get('unix_home', '/home/' + username))
     username = normalize(username)
 
-    # make connection to samdb through ldap and necessary credentials
-    samdb = SamDB(url='ldap://localhost',lp=lp,credentials=badge)
-    # create new user through the samba python's library samdb.newuser method
-    samdb.newuser(username, password, force_password_change_at_next_login_req=False, givenname=givenname, surname=surname, loginshell=loginshell, unixhome=unixhome, useusernameascn=True)
-    # and disable its account until the user verifies it through verification
-    # code sent to its email. The disable_account is also performed through
-    # the samdb's method disable_account.
-    samdb.disable_account(
-        '(samAccountName={})'.format(username)
-    )
+    domain = domain_constants(samdb)
+    message = {
+        'dn': 'CN={},CN=Users,{}'.format(username, domain['dn']),
+        'objectClass': 'user',
+        'sAMAccountName': username,
+        'userPrincipalName': '{}@{}'.format(username, domain['dnsdomain']),
+        # users created already verified (e.g. from the django admin) are
+        # enabled by the add as well
+        'userAccountControl': str(dsdb.UF_NORMAL_ACCOUNT if kwargs.get('enabled') else NEW_USER_ACCOUNT_CONTROL),
+        # the password is set by the add itself, as samdb.setpassword
+        # would do, and pwdLastSet is set to the time of the add
+        'unicodePwd': '"{}"'.format(password).encode('utf-16-le'),
+        'loginShell': loginshell,
+        'unixHomeDirectory': unixhome,
+    }
+    if givenname:
+        message['givenName'] = givenname
+    if surname:
+        message['sn'] = surname
+    if givenname or surname:
+        message['displayName'] = ' '.join(name for name in (givenname, surname) if name)
+    return message
 
-    return 'User ' + username + ' created'
+def _already_exists(error):
+    # an add fails with ERR_ENTRY_ALREADY_EXISTS both when the DN and when
+    # the sAMAccountName is already taken
+    return error.args[0] == ldb.ERR_ENTRY_ALREADY_EXISTS
 
-@app.task(name='tasks.create_user')
+def _proceed_user_creation(samdb, username, password, **kwargs):
+    # create the new user, already disabled, with a single add. The account
+    # stays disabled until the user verifies it through the verification
+    # code sent to its email (see enable_account). samdb.newuser is not
+    # used because it enables the account when it sets the password, which
+    # left a window where the account was enabled before disable_account,
+    # and it costs a few more searches and modifies.
+    message = _new_user_message(samdb, username, password, **kwargs)
+    samdb.add(message)
+    user_dns.put(username, message['dn'])
+    return 'User ' + normalize(username) + ' created'
+
+@app.task(name=task_contract.create_user.name)
+@task_contract.create_user.implementation
 def create_user(username, password, **kwargs):
     '''
         A task that will create a user if and only if the user
         does not exist in the Samba server.
 
+        There is no existence check before the creation: the add is
+        attempted and its constraint error tells that the user exists.
+
         Parameters: username - the username of the user to create
                     password - the password of the user to create
                     kwargs - a dictionary with the attributes of the user to 
-                             create
+                             create (first_name, last_name, login_shell,
+                             unix_home) and enabled, to create the account
+                             enabled instead of disabled
 
         Returns: 'User <username> created' if the user was created successfully,
                  'User <username> already exists' if the user already exists.
     '''
-    if not user_exists(username):
-        # if and only if the user does not exist, then proceed with the user
-        # creation through the private function _proceed_user_creation
-        return _proceed_user_creation(username, password, **kwargs)
+    with samdb_pool.connection() as samdb:
+        try:
+            return _proceed_user_creation(samdb, username, password, **kwargs)
+        except ldb.LdbError as e:
+            # any other error escapes the block, so the connection is
+            # discarded by the pool
+            if not _already_exists(e):
+                raise
     return 'User ' + username + ' already exists'
 
-@app.task(name='tasks.enable_account')
+def _existing_usernames(samdb, usernames):
+    '''
+        Resolve, with a single OR-filtered search, which of the given
+        usernames already exist in the Samba server.
+
+        Parameters: samdb - a borrowed connection
+                    usernames - the normalized usernames to look for
+
+        Returns: a set with the (lower cased) usernames that exist, since
+                 samAccountName comparisons are case insensitive.
+    '''
+    if not usernames:
+        return set()
+    expression = '(|{})'.format(''.join(
+        '(samAccountName={})'.format(ldb.binary_encode(username))
+        for username in usernames
+    ))
+    result = samdb.search(
+        base=domain_constants(samdb)['dn'],
+        scope=ldb.SCOPE_SUBTREE,
+        expression=expression,
+        attrs=['samAccountName']
+    )
+    return {str(entry['samAccountName'][0]).lower() for entry in result}
+
+@app.task(name=task_contract.create_users_bulk.name)
+@task_contract.create_users_bulk.implementation
+def create_users_bulk(users):
+    '''
+        A task that creates a whole chunk of users in one pass, instead of
+        one create_user message per user.
+
+        Which users already exist is resolved by a single search for the
+        whole chunk and the remaining ones are created over the same
+        connection, each one with a single add. There is no transaction:
+        over ldap:// an ldb transaction does not roll back the adds already
+        made, so each user is created on its own and an error on one record
+        does not prevent the others from being created.
+
+        Parameters: users - a list of dictionaries, each one with the keys
+                            username, password and, optionally, the same
+                            attributes accepted by create_user (first_name,
+                            last_name, login_shell, unix_home)
+
+        Returns: a dictionary mapping each username to 'created', 'exists'
+                 or 'error: <message>'.
+    '''
+    statuses = {}
+    with samdb_pool.connection() as samdb:
+        existing = _existing_usernames(
+            samdb,
+            [normalize(user['username']) for user in users]
+        )
+        for user in users:
+            if normalize(user['username']).lower() in existing:
+                statuses[user['username']] = 'exists'
+                continue
+            attributes = {
+                key: value for key, value in user.items()
+                if key not in ('username', 'password')
+            }
+            try:
+                _proceed_user_creation(samdb, user['username'], user['password'], **attributes)
+                statuses[user['username']] = 'created'
+            except ldb.LdbError as e:
+                # the whole chunk is retried, the users created so far
+                # are found to exist then
+                if is_transient(e):
+                    raise
+                # e.g. created meanwhile by a create_user task
+                statuses[user['username']] = 'exists' if _already_exists(e) else f"error: {e}"
+            except Exception as e:
+                # a bad record (e.g. a value that is not a string)
+                statuses[user['username']] = f"error: {e}"
+    return statuses
+
+def _toggle_account_flags(samdb, dn, flags, on):
+    # as samdb.toggle_userAccountFlags, but with the DN of the user instead
+    # of a search filter
+    current = samdb.search(base=dn, scope=ldb.SCOPE_BASE, attrs=['userAccountControl'])[0]
+    old = int(current['userAccountControl'][0])
+    new = old | flags if on else old & ~flags
+    if new != old:
+        samdb.modify_ldif(ldif_account_control_template.format(dn=dn, old=old, new=new))
+    return new
+
+@app.task(name=task_contract.enable_account.name)
+@task_contract.enable_account.implementation
 def enable_account(username):
     '''
-        A task that will enable a user account in the Samba server. It does
-        not check if the user exists or not in the server, it forwards this
-        responsibility for those who call this task.
+        A task that will enable a user account in the Samba server, as
+        samdb.enable_account does, with the DN of the user taken from the
+        cache.
 
         Parameters: username - the username of the user to enable
 
         Returns: 'Account <username> enabled'
+                 'User <username> does not exist' if there is no such user
     '''
-    samdb = SamDB(url='ldap://localhost',lp=lp,credentials=badge)
-    samdb.enable_account(
-        '(samAccountName={})'.format(username)
-    )
+    with samdb_pool.connection() as samdb:
+        enabled = _apply_to_user(
+            samdb, username,
+            lambda dn: _toggle_account_flags(samdb, dn, dsdb.UF_ACCOUNTDISABLE | dsdb.UF_PASSWD_NOTREQD, on=False)
+        )
+    if enabled is None:
+        return 'User ' + username + ' does not exist'
     return 'Account ' + username + ' enabled'
 
-@app.task(name='tasks.update_user_attributes')
+@app.task(name=task_contract.update_user_attributes.name)
+@task_contract.update_user_attributes.implementation
 def update_user_attributes(username, **kwargs):
     '''
         A task that will update the attributes of a user in the Samba server.
 
+        The current values of the attributes are read with a base search on
+        the (cached) DN of the user, and only the attributes whose value
+        differs are written, all of them in a single modify. When the DC
+        already holds every value, nothing is written.
+
         Parameters: username - the username of the user to update
                     kwargs - a dictionary with the attributes to update
 
         Returns: 'User <username> updated' if the user was updated successfully
-                  An error message if something went wrong
+                 'User <username> unchanged' if there was nothing to update
+                 'User <username> does not exist' if there is no such user
     '''
-    # make connection to samdb through ldap and necessary credentials
-    samdb = SamDB(url='ldap://localhost',lp=lp,credentials=badge)
-    # try to update user
-    try:
-        # Search for the user DN
-        user_dn = samdb.search(base=samdb.domain_dn(), expression=f"(samAccountName={username})", attrs=["dn"])
-        # if user don't exist
-        if not user_dn:
-            return 'User ' + username + ' does not exist'
-        # Update attributes
-        for key, value in kwargs.items():
-            # Here we use the ldif_template to update the user attributes
+    def update(samdb, dn):
+        current = samdb.search(base=dn, scope=ldb.SCOPE_BASE, attrs=list(kwargs))[0]
+        changes = ''.join(
+            # Here we use the ldif templates to update the user attributes
             # through the samdb.modify_ldif method. This is benefical because
             # the template is the most generic as possible and can be used to
             # update (virtualy) any attribute of the user.
-            samdb.modify_ldif(
-                ldif_template.format(
-                    dn=user_dn[0]['dn'],
-                    attr=key,
-                    value=value
-                )
-            )
-        return 'User ' + username + ' updated'
-    except Exception as e:
-        return f"Error updating user {username}: {e}"
+            ldif_replace_template.format(attr=key, value=ldif_value(value))
+            for key, value in kwargs.items()
+            if current.get(key) is None or [str(v) for v in current[key]] != [str(value)]
+        )
+        if not changes:
+            return 'unchanged'
+        samdb.modify_ldif(ldif_template.format(dn=dn, changes=changes))
+        return 'updated'
 
+    # errors are raised, so the task is retried or dead lettered (see
+    # SambaTask in celery.py)
+    with samdb_pool.connection() as samdb:
+        result = _apply_to_user(samdb, username, lambda dn: update(samdb, dn))
+    # if user don't exist
+    if result is None:
+        return 'User ' + username + ' does not exist'
+    return 'User ' + username + ' ' + result
 
-@app.task(name='tasks.update_user_password')
+@app.task(name=task_contract.update_user_password.name)
+@task_contract.update_user_password.implementation
 def update_user_password(username, password):
     '''
         A task that will update the password of a user in the Samba server.
-        It needs to be different from update_user_attributes because there
-        is a specific method in the samba python's library to update
-        passwords.
+        It needs to be different from update_user_attributes because the
+        password is written to the special unicodePwd attribute.
+
+        The password is written with a single modify on the (cached) DN of
+        the user. Unlike samdb.setpassword, it does not enable the account,
+        which stays disabled until the user verifies its e-mail.
 
         Parameters: username - the username of the user to update the password
                     password - the new password to set for the user
 
         Returns: 'Password updated for <username>' if the password was updated.
-                  An error message if something went wrong.
+                 An error message if the user does not exist.
     '''
-    samdb = SamDB(url='ldap://localhost',lp=lp,credentials=badge)
-    try:
-        # samdb setpassword method needs two parameters: the filter expression
-        # to find the user and the new password.
-        samdb.setpassword(
-            '(samAccountName={})'.format(username),
-            password
+    encoded = base64.b64encode('"{}"'.format(password).encode('utf-16-le')).decode('ascii')
+    with samdb_pool.connection() as samdb:
+        updated = _apply_to_user(
+            samdb, username,
+            lambda dn: samdb.modify_ldif(ldif_password_template.format(dn=dn, password=encoded)) or True
         )
-        return 'Password updated for ' + username
-    except Exception as e:
-        return f"Error updating password for {username}: {e}"
+    if updated is None:
+        return f"Error updating password for {username}: user does not exist"
+    return 'Password updated for ' + username
 
-@app.task(name='tasks.delete_user')
+@app.task(name=task_contract.delete_user.name)
+@task_contract.delete_user.implementation
 def delete_user(username):
     '''
         A task that will delete a user from the Samba server.
@@ -203,13 +676,371 @@ def delete_user(username):
         Parameters: username - the username of the user to delete
 
         Returns: 'User <username> deleted' if the user was deleted successfully
-                  An error message if something went wrong.
+                 An error message if the user does not exist.
     '''
-    samdb = SamDB(url='ldap://localhost',lp=lp,credentials=badge)
     try:
-        samdb.deleteuser(
-            username
+        with samdb_pool.connection() as samdb:
+            deleted = _apply_to_user(samdb, username, lambda dn: samdb.delete(dn) or True)
+    finally:
+        user_dns.invalidate(username)
+    if deleted is None:
+        return f"Error deleting user {username}: user does not exist"
+    return 'User ' + username + ' deleted'
+
+# errors listed in the result of apply_to_users_bulk, the others are only
+# counted
+BULK_ERRORS_REPORTED = 10
+
+def _resolve_user_dns(samdb, usernames):
+    '''
+        Resolve the DNs of the given users: the cached ones from the cache,
+        the others with a single OR-filtered search, whose results are
+        cached as well.
+
+        Returns: a dictionary mapping the lower cased usernames of the
+                 users that exist to their DNs. It does not depend on the
+                 cache keeping them, which may be smaller than the chunk or
+                 disabled.
+    '''
+    dns = {}
+    for username in usernames:
+        dn = user_dns.get(username)
+        if dn is not None:
+            dns[UserDNCache._key(username)] = dn
+    missing = [username for username in usernames if UserDNCache._key(username) not in dns]
+    if not missing:
+        return dns
+    expression = '(|{})'.format(''.join(
+        '(samAccountName={})'.format(ldb.binary_encode(normalize(username)))
+        for username in missing
+    ))
+    result = samdb.search(
+        base=domain_constants(samdb)['dn'],
+        scope=ldb.SCOPE_SUBTREE,
+        expression=expression,
+        attrs=['samAccountName']
+    )
+    for entry in result:
+        username = str(entry['samAccountName'][0])
+        dns[UserDNCache._key(username)] = str(entry.dn)
+        user_dns.put(username, entry.dn)
+    return dns
+
+def _user_operations(samdb):
+    # the operations of apply_to_users_bulk, as functions of the DN of a user
+    return {
+        'delete': samdb.delete,
+        'enable': lambda dn: _toggle_account_flags(samdb, dn, dsdb.UF_ACCOUNTDISABLE | dsdb.UF_PASSWD_NOTREQD, on=False),
+        'disable': lambda dn: _toggle_account_flags(samdb, dn, dsdb.UF_ACCOUNTDISABLE, on=True),
+        # a pwdLastSet of 0 makes the user change its password at next logon
+        'force_password_reset': lambda dn: samdb.modify_ldif(ldif_template.format(
+            dn=dn, changes=ldif_replace_template.format(attr='pwdLastSet', value=ldif_value('0'))
+        )),
+    }
+
+@app.task(name=task_contract.apply_to_users_bulk.name)
+@task_contract.apply_to_users_bulk.implementation
+def apply_to_users_bulk(usernames, operation):
+    '''
+        A task that deletes, enables, disables or forces a password reset
+        on a whole chunk of users over a single connection, instead of one
+        message per user (e.g. the bulk actions of the django admin).
+
+        The DNs of the users that are not cached are resolved by a single
+        search for the whole chunk (see _resolve_user_dns). An error on one user does not stop the
+        others.
+
+        Parameters: usernames - a list of usernames
+                    operation - one of task_contract.BULK_USER_OPERATIONS
+
+        Returns: a dictionary with the operation and the number of users
+                 it was applied to (done), that do not exist (missing) and
+                 that failed (failed), with the first errors.
+    '''
+    if operation not in task_contract.BULK_USER_OPERATIONS:
+        raise ValueError(f"Unknown bulk operation {operation}")
+    summary = {'operation': operation, 'done': 0, 'missing': 0, 'failed': 0, 'errors': []}
+    with samdb_pool.connection() as samdb:
+        dns = _resolve_user_dns(samdb, usernames)
+        apply = _user_operations(samdb)[operation]
+        for username in usernames:
+            dn = dns.get(UserDNCache._key(username))
+            if dn is None:
+                summary['missing'] += 1
+                continue
+            try:
+                done = _apply_to_user(samdb, username, lambda dn: apply(dn) or True, dn=dn)
+            except ldb.LdbError as e:
+                # the whole chunk is retried, which is harmless for the
+                # users already done (the deleted ones are then missing)
+                if is_transient(e):
+                    raise
+                summary['failed'] += 1
+                if len(summary['errors']) < BULK_ERRORS_REPORTED:
+                    summary['errors'].append(f"{username}: {e}")
+                continue
+            if done is None:
+                summary['missing'] += 1
+            else:
+                summary['done'] += 1
+            if operation == 'delete':
+                user_dns.invalidate(username)
+    return summary
+
+# the address of this campus, as in celery.py, to tag the drifts reported
+# by reconcile_users
+server_address = os.environ.get('SAMBA_SERVER_ADDRESS', os.environ.get('SERVER_IP', 'localhost'))
+
+# drifts are sent back to django in batches of this size
+DRIFT_BATCH_SIZE = 500
+
+# sAMAccountType of user accounts, so computers and trusts are left out
+USER_ACCOUNT_FILTER = '(sAMAccountType=805306368)(!(isCriticalSystemObject=TRUE))'
+
+def _paged_search(samdb, page_size, controls=(), **kwargs):
+    '''
+        Yield the results of a search sorted by sAMAccountName, a page of
+        `page_size` entries at a time, so the whole result is never held in
+        memory.
+    '''
+    cookie = ''
+    while True:
+        control = 'paged_results:1:' + str(page_size)
+        if cookie:
+            control += ':' + cookie
+        result = samdb.search(controls=['server_sort:1:0:sAMAccountName', control, *controls], **kwargs)
+        yield from result
+        cookie = ''
+        for response in result.controls or ():
+            spl = str(response).rsplit(':', 3)
+            if spl[0] == 'paged_results' and len(spl) == 3:
+                cookie = spl[-1]
+        if not cookie:
+            return
+
+def _reconcile_key(username):
+    # the order of the sorted search: samba compares sAMAccountName values
+    # casefolded to upper case
+    return normalize(username).upper()
+
+def _compare_user(user, entry):
+    '''
+        Returns: a dictionary with the differences between a django user
+                 and its samba entry, as attribute: (django, samba).
+    '''
+    differences = {}
+    for attribute, field in (('givenName', 'first_name'), ('sn', 'last_name')):
+        # created users get ASCII names, while update_user_attributes keeps
+        # the accents, so both sides are compared in the ASCII form
+        expected = normalize(user.get(field) or '')
+        current = str(entry[attribute][0]) if attribute in entry else ''
+        if expected != normalize(current):
+            differences[attribute] = (expected, current)
+    enabled = not int(entry['userAccountControl'][0]) & dsdb.UF_ACCOUNTDISABLE
+    if enabled != bool(user.get('enabled')):
+        differences['enabled'] = (bool(user.get('enabled')), enabled)
+    return differences
+
+def _repair_user(samdb, user, dn, differences):
+    # make the samba entry match the django user
+    changes = ''.join(
+        ldif_replace_template.format(attr=attribute, value=ldif_value(expected))
+        for attribute, (expected, current) in differences.items()
+        if attribute != 'enabled' and expected
+    )
+    if changes:
+        samdb.modify_ldif(ldif_template.format(dn=dn, changes=changes))
+    if 'enabled' in differences:
+        _toggle_account_flags(samdb, dn, dsdb.UF_ACCOUNTDISABLE, on=not user.get('enabled'))
+
+def _create_missing_user(samdb, user):
+    # the password of a django user is not known, so the account gets a
+    # random one, which the user replaces by changing its password
+    password = secrets.token_urlsafe(24) + 'aA1!'
+    _proceed_user_creation(
+        samdb, user['username'], password,
+        first_name=user.get('first_name') or '', last_name=user.get('last_name') or ''
+    )
+    if user.get('enabled'):
+        # the DN is searched again when the cache does not keep it
+        _apply_to_user(samdb, user['username'], lambda dn: _toggle_account_flags(samdb, dn, dsdb.UF_ACCOUNTDISABLE, on=False))
+
+@app.task(name=task_contract.reconcile_users.name)
+@task_contract.reconcile_users.implementation
+def reconcile_users(users, lower=None, upper=None, run_id='', repair=False, page_size=1000):
+    '''
+        A task that compares a range of the django users with the users of
+        this Samba server and reports their drifts to django (to the
+        campus.record_drift task), one of:
+            - missing: a django user without a samba account;
+            - extra: a samba account without a django user (never
+              repaired, since accounts created by the IT staff are legit);
+            - mismatch: different names, or an account enabled while the
+              django user should not be (or the other way around).
+
+        Both sides are streamed sorted by username and merge-joined, so
+        only the given users and a page of samba entries are in memory.
+        The django side (see the reconcile_users django command) sends its
+        users in chunks, each one with the range of usernames it covers.
+
+        Parameters: users - a chunk of django users sorted by username,
+                            dictionaries with the keys username,
+                            first_name, last_name and enabled (see
+                            CollegeUser.samba_enabled in django)
+                    lower, upper - the range of usernames of the chunk,
+                                   lower excluded and upper included.
+                                   None means unbounded.
+                    run_id - identifies the reconciliation run
+                    repair - whether missing and mismatched users are
+                             repaired (created, updated, enabled or
+                             disabled) in this Samba server
+                    page_size - samba entries fetched per page
+
+        Returns: a dictionary with the number of users compared and of
+                 each kind of drift.
+    '''
+    expression = '(&' + USER_ACCOUNT_FILTER
+    if lower is not None:
+        expression += f"(!(sAMAccountName<={ldb.binary_encode(normalize(lower))}))"
+    if upper is not None:
+        expression += f"(sAMAccountName<={ldb.binary_encode(normalize(upper))})"
+    expression += ')'
+
+    users = sorted(users, key=lambda user: _reconcile_key(user['username']))
+    summary = {'compared': 0, 'missing': 0, 'extra': 0, 'mismatch': 0, 'repaired': 0}
+    drifts = []
+
+    def drift(username, kind, details, repaired):
+        summary[kind] += 1
+        summary['repaired'] += repaired
+        drifts.append((username, kind, details, repaired))
+        if len(drifts) >= DRIFT_BATCH_SIZE:
+            report_drifts()
+
+    def report_drifts():
+        if drifts:
+            app.send_task(
+                task_contract.record_drift.name,
+                **task_contract.record_drift.message((run_id, server_address, list(drifts))),
+                queue='results'
+            )
+            drifts.clear()
+
+    def handle_drift(samdb, user, kind, fix, details=''):
+        repaired = False
+        if repair:
+            try:
+                fix()
+                repaired = True
+            except ldb.LdbError as e:
+                if is_transient(e):
+                    raise
+                details += f" (not repaired: {e})"
+        drift(user['username'], kind, details.strip(), repaired)
+
+    with samdb_pool.connection() as samdb:
+        entries = _paged_search(
+            samdb, page_size,
+            base=domain_constants(samdb)['dn'],
+            scope=ldb.SCOPE_SUBTREE,
+            expression=expression,
+            attrs=['sAMAccountName', 'givenName', 'sn', 'userAccountControl']
         )
-        return 'User ' + username + ' deleted'
-    except Exception as e:
-        return f"Error deleting user {username}: {e}"
+        entry = next(entries, None)
+        for user in users:
+            key = _reconcile_key(user['username'])
+            # samba entries before this user have no django user
+            while entry is not None and _reconcile_key(str(entry['sAMAccountName'][0])) < key:
+                drift(str(entry['sAMAccountName'][0]), 'extra', '', False)
+                entry = next(entries, None)
+            summary['compared'] += 1
+            if entry is None or _reconcile_key(str(entry['sAMAccountName'][0])) != key:
+                handle_drift(samdb, user, 'missing', lambda: _create_missing_user(samdb, user))
+                continue
+            differences = _compare_user(user, entry)
+            if differences:
+                dn = str(entry.dn)
+                handle_drift(
+                    samdb, user, 'mismatch',
+                    lambda: _repair_user(samdb, user, dn, differences),
+                    repr(differences)
+                )
+            user_dns.put(user['username'], entry.dn)
+            entry = next(entries, None)
+        while entry is not None:
+            drift(str(entry['sAMAccountName'][0]), 'extra', '', False)
+            entry = next(entries, None)
+    report_drifts()
+    return summary
+
+@app.task(name=task_contract.user_changes.name)
+@task_contract.user_changes.implementation
+def user_changes(since_usn=None, page_size=1000):
+    '''
+        A task that feeds django with the users changed in this Samba
+        server (e.g. through RSAT or samba-tool) since a given USN, the
+        update sequence number of the DC, so django stays in sync without
+        full scans (see the reconcile_users task for those).
+
+        The changed users are read with a paged search and sent to django
+        a page at a time, as campus.apply_directory_changes tasks. The last
+        one carries the highest committed USN of the DC, which django
+        remembers for this campus and passes as since_usn in the next call.
+
+        Parameters: since_usn - the USN of the previous call. None (the
+                                first call) or a USN higher than the one
+                                of the DC (e.g. after a restore) only
+                                returns the current USN.
+                    page_size - users per page
+
+        Returns: a dictionary with the number of changed users and the
+                 highest committed USN.
+    '''
+    def send_page(changes, usn=None):
+        app.send_task(
+            task_contract.apply_directory_changes.name,
+            **task_contract.apply_directory_changes.message((server_address, changes, usn)),
+            queue='results'
+        )
+
+    with samdb_pool.connection() as samdb:
+        usn = highest_committed_usn(samdb)
+        if since_usn is None or since_usn > usn:
+            send_page([], usn)
+            return {'changed': 0, 'usn': usn}
+        if since_usn == usn:
+            return {'changed': 0, 'usn': usn}
+
+        entries = _paged_search(
+            samdb, page_size,
+            # deleted users are only found with this control
+            controls=['show_deleted:1'],
+            base=domain_constants(samdb)['dn'],
+            scope=ldb.SCOPE_SUBTREE,
+            expression=(
+                f"(&(|(&{USER_ACCOUNT_FILTER})(&(objectClass=user)(isDeleted=TRUE)))"
+                f"(uSNChanged>={since_usn + 1})(uSNChanged<={usn}))"
+            ),
+            attrs=['sAMAccountName', 'givenName', 'sn', 'userAccountControl', 'isDeleted']
+        )
+        changed = 0
+        page = []
+        for entry in entries:
+            if 'sAMAccountName' not in entry:
+                continue
+            username = str(entry['sAMAccountName'][0])
+            # these users may have been renamed or deleted
+            user_dns.invalidate(username)
+            page.append({
+                'username': username,
+                'first_name': str(entry['givenName'][0]) if 'givenName' in entry else '',
+                'last_name': str(entry['sn'][0]) if 'sn' in entry else '',
+                'enabled': 'userAccountControl' in entry and not int(entry['userAccountControl'][0]) & dsdb.UF_ACCOUNTDISABLE,
+                'deleted': 'isDeleted' in entry and str(entry['isDeleted'][0]).upper() == 'TRUE',
+            })
+            changed += 1
+            if len(page) >= page_size:
+                send_page(page)
+                page = []
+        send_page(page, usn)
+    return {'changed': changed, 'usn': usn}
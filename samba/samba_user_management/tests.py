@@ -0,0 +1,287 @@
+import os
+import tempfile
+
+# the celery app reads the broker settings when imported; the tests never
+# reach the broker nor a samba server
+os.environ.setdefault('RABBITMQ_PORT', '5671')
+for name in ('RABBITMQ_HOST', 'RABBITMQ_USER', 'RABBITMQ_PASSWORD', 'RABBITMQ_VHOST', 'SAMBA_ADMIN_PASSWORD'):
+    os.environ.setdefault(name, 'test')
+os.environ.setdefault('SAMBA_COMPLETED_TASKS_PATH', os.path.join(tempfile.mkdtemp(), 'completed_tasks.sqlite3'))
+
+from contextlib import contextmanager
+from unittest import mock
+from . import celery, tasks
+from .completed_tasks import MISSING, CompletedTasks
+from .replay_dead_letters import replay
+from celery.exceptions import Retry
+import base64
+import ldb
+import re
+import unittest
+
+'''
+    Tests of the samba worker code that do not need a samba server: the
+    tasks run against FakeSamDB, an in-memory directory that understands
+    the few searches and writes they make.
+
+    Usage (inside the samba container, from /opt/celery):
+        python3 -m unittest samba_user_management.tests
+'''
+
+DOMAIN_DN = 'DC=example,DC=org'
+
+class Entry(dict):
+    def __init__(self, dn, attributes):
+        super().__init__(attributes)
+        self.dn = dn
+
+class FakeSamDB:
+    '''
+        An in-memory directory of users, keyed by their lower cased
+        sAMAccountName.
+    '''
+    def __init__(self, usernames=()):
+        self.users = {}
+        self.adds = []
+        self.deletes = []
+        self.modifies = []
+        for username in usernames:
+            self.users[username.lower()] = {'dn': f"CN={username},CN=Users,{DOMAIN_DN}", 'sAMAccountName': username}
+
+    def domain_dn(self):
+        return DOMAIN_DN
+
+    def search(self, base=None, scope=None, expression=None, attrs=None, controls=None):
+        if scope == ldb.SCOPE_BASE:
+            for user in self.users.values():
+                if user['dn'] == base:
+                    return [Entry(user['dn'], {'userAccountControl': [user.get('userAccountControl', '512')]})]
+            raise ldb.LdbError(ldb.ERR_NO_SUCH_OBJECT, 'no such object')
+        usernames = re.findall(r'samAccountName=([^)]*)\)', expression or '', re.IGNORECASE)
+        return [
+            Entry(self.users[username.lower()]['dn'], {'samAccountName': [self.users[username.lower()]['sAMAccountName']]})
+            for username in usernames if username.lower() in self.users
+        ]
+
+    def add(self, message):
+        username = message['sAMAccountName']
+        if username.lower() in self.users:
+            raise ldb.LdbError(ldb.ERR_ENTRY_ALREADY_EXISTS, 'entry already exists')
+        if username.startswith('bad'):
+            raise ldb.LdbError(ldb.ERR_CONSTRAINT_VIOLATION, 'constraint violation')
+        self.users[username.lower()] = dict(message)
+        self.adds.append(username)
+
+    def delete(self, dn):
+        for key, user in list(self.users.items()):
+            if user['dn'] == dn:
+                del self.users[key]
+                self.deletes.append(dn)
+                return
+        raise ldb.LdbError(ldb.ERR_NO_SUCH_OBJECT, 'no such object')
+
+    def modify_ldif(self, ldif):
+        self.modifies.append(ldif)
+
+class FakePool:
+    def __init__(self, samdb):
+        self.samdb = samdb
+
+    @contextmanager
+    def connection(self):
+        yield self.samdb
+
+class SambaTestCase(unittest.TestCase):
+    dn_cache_size = 10000
+
+    def setUp(self):
+        self.samdb = FakeSamDB(['Existing', 'ana'])
+        patches = [
+            mock.patch.object(tasks, 'samdb_pool', FakePool(self.samdb)),
+            mock.patch.object(tasks, 'user_dns', tasks.UserDNCache(size=self.dn_cache_size)),
+            mock.patch.dict(tasks._domain, {'dn': DOMAIN_DN, 'dnsdomain': 'example.org'}),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+class CreateUsersBulkTests(SambaTestCase):
+    def test_creates_missing_users_and_skips_existing_ones(self):
+        statuses = tasks.create_users_bulk.run([
+            {'username': 'existing', 'password': 'x', 'first_name': 'E', 'last_name': 'X'},
+            {'username': 'bob', 'password': 'x', 'first_name': 'Bob', 'last_name': 'Y'},
+        ])
+        self.assertEqual(statuses, {'existing': 'exists', 'bob': 'created'})
+        self.assertEqual(self.samdb.adds, ['bob'])
+
+    def test_a_bad_record_does_not_stop_the_others(self):
+        statuses = tasks.create_users_bulk.run([
+            {'username': 'bad', 'password': 'x', 'first_name': '', 'last_name': ''},
+            {'username': 'odd', 'password': 'x', 'first_name': None, 'last_name': ''},
+            {'username': 'carol', 'password': 'x', 'first_name': 'Carol', 'last_name': 'Z'},
+        ])
+        self.assertTrue(statuses['bad'].startswith('error: '))
+        self.assertTrue(statuses['odd'].startswith('error: '))
+        self.assertEqual(statuses['carol'], 'created')
+        self.assertEqual(self.samdb.adds, ['carol'])
+
+    def test_transient_errors_fail_the_chunk_so_it_is_retried(self):
+        with mock.patch.object(self.samdb, 'add', side_effect=ldb.LdbError(ldb.ERR_UNAVAILABLE, 'down')):
+            with self.assertRaises(ldb.LdbError):
+                tasks.create_users_bulk.run([{'username': 'dave', 'password': 'x', 'first_name': '', 'last_name': ''}])
+
+class UpdateUserAttributesTests(SambaTestCase):
+    def test_merged_attributes_are_written_by_one_modify(self):
+        self.assertEqual(tasks.update_user_attributes.run('ana', givenName='Maria', sn='Souza'), 'User ana updated')
+        self.assertEqual(len(self.samdb.modifies), 1)
+        self.assertIn('givenName: Maria', self.samdb.modifies[0])
+        self.assertIn('sn: Souza', self.samdb.modifies[0])
+
+class CompareUserTests(unittest.TestCase):
+    def entry(self, **attributes):
+        return Entry('CN=joao,CN=Users,' + DOMAIN_DN, {'userAccountControl': ['512'], **{k: [v] for k, v in attributes.items()}})
+
+    def test_names_with_and_without_accents_are_the_same(self):
+        user = {'username': 'joao', 'first_name': 'Jo\u00e3o', 'last_name': 'Concei\u00e7\u00e3o', 'enabled': True}
+        # as written by create_user and by update_user_attributes
+        self.assertEqual(tasks._compare_user(user, self.entry(givenName='Joao', sn='Conceicao')), {})
+        self.assertEqual(tasks._compare_user(user, self.entry(givenName='Jo\u00e3o', sn='Concei\u00e7\u00e3o')), {})
+        self.assertEqual(tasks._compare_user(user, self.entry(givenName='Jose', sn='Conceicao')), {'givenName': ('Joao', 'Jose')})
+
+    def test_the_account_is_compared_with_the_enabled_state_of_django(self):
+        user = {'username': 'joao', 'first_name': 'Joao', 'last_name': '', 'enabled': False}
+        self.assertEqual(tasks._compare_user(user, self.entry(givenName='Joao')), {'enabled': (False, True)})
+        disabled = self.entry(givenName='Joao')
+        disabled['userAccountControl'] = ['514']
+        self.assertEqual(tasks._compare_user(user, disabled), {})
+
+class ApplyToUsersBulkTests(SambaTestCase):
+    def test_deletes_the_users_that_exist(self):
+        summary = tasks.apply_to_users_bulk.run(['ANA', 'nobody', 'existing'], 'delete')
+        self.assertEqual((summary['done'], summary['missing'], summary['failed']), (2, 1, 0))
+        self.assertEqual(self.samdb.users, {})
+
+    def test_does_not_depend_on_the_dn_cache(self):
+        summary = tasks.apply_to_users_bulk.run(['ana', 'existing'], 'disable')
+        self.assertEqual((summary['done'], summary['missing']), (2, 0))
+        self.assertEqual(len(self.samdb.modifies), 2)
+
+class ApplyToUsersBulkWithoutDNCacheTests(ApplyToUsersBulkTests):
+    # SAMBA_DN_CACHE_SIZE=0
+    dn_cache_size = 0
+
+@celery.app.task(name='tests.flaky')
+def flaky(username, password, error=None):
+    raise error
+
+class RoutingTests(unittest.TestCase):
+    '''
+        The messages published again by a worker (retries, dead letters,
+        replays) go to the queue they came from, never to another campus
+        or to the interactive queue.
+    '''
+    def setUp(self):
+        self.producer = mock.MagicMock()
+        acquire = mock.MagicMock()
+        acquire.return_value.__enter__.return_value = self.producer
+        patch = mock.patch.object(celery.app, 'producer_or_acquire', acquire)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def published(self):
+        # the task messages, not the task-sent events
+        return [call.kwargs for call in self.producer.publish.call_args_list if call.kwargs.get('exchange') != 'celeryev']
+
+    def run_message(self, error, exchange, routing_key):
+        flaky.push_request(
+            id='abc', args=('ana', 'secret'), kwargs={'error': error}, retries=0, called_directly=False,
+            delivery_info={'exchange': exchange, 'routing_key': routing_key},
+        )
+        try:
+            flaky('ana', 'secret', error=error)
+        finally:
+            flaky.pop_request()
+
+    def test_retries_go_back_to_the_queue_they_came_from(self):
+        for exchange, queue in ((celery.broadcast_exchange.name, celery.campus_queue.name), (celery.bulk_broadcast_exchange.name, celery.campus_bulk_queue.name)):
+            with self.assertRaises(Retry):
+                self.run_message(ConnectionError('down'), exchange, '')
+            published = self.published()[-1]
+            self.assertEqual((published['exchange'], published['routing_key']), ('', queue))
+            self.assertNotIn('secret', published['headers']['argsrepr'] + published['headers']['kwargsrepr'])
+
+    def test_permanent_errors_are_dead_lettered(self):
+        with self.assertRaises(ValueError):
+            self.run_message(ValueError('bad'), celery.campus_exchange.name, celery.server_address)
+        published = self.published()[-1]
+        self.assertEqual((published['exchange'], published['routing_key']), ('', celery.dead_letter_queue.name))
+        self.assertEqual(published['headers']['dead_letter_queue'], celery.campus_queue.name)
+
+    def test_replays_go_back_to_the_queue_they_came_from(self):
+        message = mock.Mock(headers={
+            'task': 'tasks.delete_user', 'id': 'abc', 'idempotency_key': 'abc',
+            'dead_letter_queue': celery.campus_bulk_queue.name,
+        })
+        message.decode.return_value = (['ana'], {}, {})
+        replay(message, connection=mock.MagicMock())
+        published = self.published()[-1]
+        self.assertEqual((published['exchange'], published['routing_key']), ('', celery.campus_bulk_queue.name))
+        self.assertEqual(published['headers']['idempotency_key'], 'abc')
+        message.ack.assert_called_once_with()
+
+class QueueTests(unittest.TestCase):
+    def test_bulk_broadcasts_reach_the_bulk_queue_only(self):
+        exchanges = lambda queue: {binding.exchange.name for binding in queue.bindings}
+        self.assertIn(celery.bulk_broadcast_exchange.name, exchanges(celery.campus_bulk_queue))
+        self.assertNotIn(celery.bulk_broadcast_exchange.name, exchanges(celery.campus_queue))
+
+class TransientErrorTests(unittest.TestCase):
+    def test_transient_errors(self):
+        self.assertTrue(celery.is_transient(ldb.LdbError(ldb.ERR_UNAVAILABLE, 'down')))
+        self.assertTrue(celery.is_transient(ConnectionRefusedError()))
+        self.assertFalse(celery.is_transient(ldb.LdbError(ldb.ERR_CONSTRAINT_VIOLATION, 'bad')))
+        self.assertFalse(celery.is_transient(ValueError()))
+
+    def test_origin_queue(self):
+        request = mock.Mock(delivery_info={'exchange': celery.campus_exchange.name, 'routing_key': celery.server_address})
+        self.assertEqual(celery.origin_queue(request), celery.campus_queue.name)
+        request = mock.Mock(delivery_info={'exchange': celery.bulk_campus_exchange.name, 'routing_key': celery.server_address})
+        self.assertEqual(celery.origin_queue(request), celery.campus_bulk_queue.name)
+        request = mock.Mock(delivery_info={'exchange': '', 'routing_key': 'celery'})
+        self.assertEqual(celery.origin_queue(request), 'celery')
+
+class LdifValueTests(unittest.TestCase):
+    def test_safe_values_are_written_as_they_are(self):
+        self.assertEqual(tasks.ldif_value('Ana'), ': Ana')
+
+    def test_other_values_are_base64_encoded(self):
+        for value in ('Jo\u00e3o', ' leading space', 'trailing space ', ':colon', 'line\nbreak'):
+            encoded = tasks.ldif_value(value)
+            self.assertTrue(encoded.startswith(':: '))
+            self.assertEqual(base64.b64decode(encoded[3:]).decode('utf-8'), value)
+
+class CompletedTasksTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'completed.sqlite3')
+
+    def test_returns_the_result_of_completed_keys(self):
+        store = CompletedTasks(self.path)
+        self.assertIs(store.get('a'), MISSING)
+        store.put('a', 'tasks.create_user', {'done': 1})
+        self.assertEqual(store.get('a'), {'done': 1})
+        # the keys are kept on disk
+        self.assertEqual(CompletedTasks(self.path).get('a'), {'done': 1})
+
+    def test_keeps_only_the_most_recent_keys(self):
+        store = CompletedTasks(self.path, size=3, prune_every=5)
+        for i in range(10):
+            store.put(str(i), 'tasks.delete_user', i)
+        self.assertIs(store.get('0'), MISSING)
+        self.assertEqual(store.get('9'), 9)
+        store.prune()
+        self.assertEqual([store.get(str(i)) is MISSING for i in range(10)], [True] * 7 + [False] * 3)
+
+if __name__ == '__main__':
+    unittest.main()
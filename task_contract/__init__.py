@@ -0,0 +1,254 @@
+from celery import Task
+import inspect
+import unicodedata
+
+'''
+    task_contract is the contract between the django app and the samba
+    workers: the names, the signatures and the payloads of the tasks each
+    side sends to the other. It is the only code both sides share, so it
+    must not import django nor samba. The django container mounts it and
+    the samba image copies it (see docker-compose.yaml), and each side
+    publishes the tasks of the other side by name, with app.send_task,
+    instead of importing their code.
+
+    Every task is declared by a stub function with the signature of the
+    task. Publishers check their arguments against it (Contract.message)
+    and the workers check that their implementation matches it
+    (Contract.implementation), so a change in a signature fails at the
+    publisher or when the worker starts, instead of in every message.
+
+    VERSION must be increased whenever a change breaks the messages sent
+    by a previous version (e.g. a parameter is removed or renamed, a record
+    key is dropped) or a worker of a previous version would run them
+    differently (e.g. it ignores a new argument). Messages carry it in their contract_version header and
+    workers refuse messages of newer contracts (see ContractTask), which
+    happens when the django app is upgraded before a samba server.
+
+    Messages may also carry an idempotency_key header, the same for every
+    delivery of one operation (django uses the id the task got when it was
+    written to its outbox), which the samba workers use to skip the
+    operations they already completed.
+
+    Celery shows the arguments of a task in its events, logs and monitors
+    (argsrepr and kwargsrepr), and some arguments are passwords, so every
+    message is published with the redacted ones of Contract.redact.
+'''
+
+# 2: create_user takes enabled=True, which older workers ignore, creating a
+#    disabled account
+# 3: the records of reconcile_users carry enabled instead of is_verified
+VERSION = 3
+
+# the parameters and record keys whose values are never shown
+SECRET_NAMES = frozenset(('password',))
+
+# the contracts by task name
+contracts = {}
+
+class ContractError(Exception):
+    pass
+
+def normalize(s):
+    '''
+        Strip accents and characters that are not ASCII, as the samba
+        workers store names and usernames.
+    '''
+    return str(unicodedata.normalize('NFKD', s).encode('ascii', 'ignore').decode('utf-8'))
+
+class Contract:
+    '''
+        The name, signature and payload of a task.
+
+        records maps the parameters that receive lists of records (dicts)
+        to the keys every record must have. bulk tasks handle many users at
+        once and are sent to the bulk queues of the samba workers.
+    '''
+    def __init__(self, name, stub, records=None, bulk=False):
+        self.name = name
+        self.signature = inspect.signature(stub)
+        self.records = records or {}
+        self.bulk = bulk
+        self.__doc__ = stub.__doc__
+        contracts[name] = self
+
+    def __repr__(self):
+        return f"<Contract {self.name}{self.signature}>"
+
+    def message(self, args=(), kwargs=None, idempotency_key=None):
+        '''
+            Check the arguments of a task against the contract.
+
+            Returns: the arguments of app.send_task (args, kwargs, the
+                     headers carrying the contract version and the
+                     idempotency key, if any, and their redacted
+                     representations).
+        '''
+        kwargs = kwargs or {}
+        try:
+            bound = self.signature.bind(*args, **kwargs)
+        except TypeError as e:
+            raise ContractError(f"{self.name}: {e}") from None
+        for parameter, keys in self.records.items():
+            for record in bound.arguments.get(parameter) or ():
+                missing = keys - record.keys()
+                if missing:
+                    raise ContractError(f"{self.name}: records of {parameter} lack {', '.join(sorted(missing))}")
+        headers = {'contract_version': VERSION}
+        if idempotency_key:
+            headers['idempotency_key'] = idempotency_key
+        return {'args': tuple(args), 'kwargs': kwargs, 'headers': headers, **self.redact(args, kwargs)}
+
+    def _redact_value(self, name, value):
+        if name in SECRET_NAMES:
+            return '********'
+        if name in self.records or isinstance(value, (list, tuple)):
+            return f"<{len(value or ())} items>"
+        return value
+
+    def redact(self, args=(), kwargs=None):
+        '''
+            Returns: the argsrepr and kwargsrepr options of app.send_task,
+                     with passwords hidden and lists of records or
+                     usernames replaced by their length.
+        '''
+        names = [
+            p.name for p in self.signature.parameters.values()
+            if p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD)
+        ]
+        return {
+            'argsrepr': repr(tuple(
+                self._redact_value(names[i] if i < len(names) else '', value)
+                for i, value in enumerate(args)
+            )),
+            'kwargsrepr': repr({name: self._redact_value(name, value) for name, value in (kwargs or {}).items()}),
+        }
+
+    def implementation(self, function):
+        '''
+            Decorator for the function that implements the task, which
+            checks that its parameters are the ones of the contract.
+        '''
+        parameters = list(inspect.signature(function).parameters.values())
+        expected = list(self.signature.parameters.values())
+        if [(p.name, p.kind, p.default) for p in parameters] != [(p.name, p.kind, p.default) for p in expected]:
+            raise ContractError(f"{function.__module__}.{function.__name__} does not implement {self!r}")
+        return function
+
+def contract(name, records=None, bulk=False):
+    def declare(stub):
+        return Contract(name, stub, records, bulk)
+    return declare
+
+def redact(name, args=(), kwargs=None):
+    '''
+        The redacted argsrepr and kwargsrepr of a message of any task, e.g.
+        when it is sent again by a retry. Nothing is shown of the arguments
+        of tasks without a contract.
+    '''
+    if name in contracts:
+        return contracts[name].redact(args, kwargs)
+    return {'argsrepr': f"<{len(args or ())} arguments>", 'kwargsrepr': f"<{len(kwargs or {})} arguments>"}
+
+def header(request, name):
+    '''
+        A header of the message of a task request: workers get the message
+        headers in the request, eager calls (apply) in request.headers.
+    '''
+    return request.get(name, (request.headers or {}).get(name))
+
+class ContractTask(Task):
+    '''
+        Base task class of both celery apps (task_cls), which refuses
+        messages published with a newer contract than the one it knows.
+        Messages without the header predate the contract and are run.
+    '''
+    def __call__(self, *args, **kwargs):
+        version = header(self.request, 'contract_version')
+        if version is not None and version > VERSION:
+            raise ContractError(f"{self.name} was sent with contract version {version}, this worker knows version {VERSION}")
+        if self.request.called_directly:
+            return super().__call__(*args, **kwargs)
+        # Task.__call__ would push a new, empty request, hiding the one of
+        # the message (its id, headers, retries) from the task and from
+        # self.retry
+        return self.run(*args, **kwargs)
+
+# the keys of the records sent to the bulk tasks
+NEW_USER_RECORD = frozenset(('username', 'password', 'first_name', 'last_name'))
+RECONCILE_USER_RECORD = frozenset(('username', 'first_name', 'last_name', 'enabled'))
+DIRECTORY_CHANGE_RECORD = frozenset(('username', 'first_name', 'last_name', 'enabled', 'deleted'))
+
+# tasks run by the samba workers, published by django
+
+@contract('tasks.create_user')
+def create_user(username, password, **kwargs):
+    '''
+        Create a disabled user (or an enabled one, with enabled=True).
+        kwargs: first_name, last_name, login_shell, unix_home and enabled.
+    '''
+
+@contract('tasks.create_users_bulk', records={'users': NEW_USER_RECORD}, bulk=True)
+def create_users_bulk(users):
+    '''
+        Create many disabled users at once.
+    '''
+
+@contract('tasks.enable_account')
+def enable_account(username):
+    pass
+
+@contract('tasks.update_user_attributes')
+def update_user_attributes(username, **kwargs):
+    '''
+        Replace LDAP attributes of a user, e.g. givenName='Ana'.
+    '''
+
+@contract('tasks.update_user_password')
+def update_user_password(username, password):
+    pass
+
+@contract('tasks.delete_user')
+def delete_user(username):
+    pass
+
+@contract('tasks.reconcile_users', records={'users': RECONCILE_USER_RECORD}, bulk=True)
+def reconcile_users(users, lower=None, upper=None, run_id='', repair=False, page_size=1000):
+    '''
+        Compare a range of usernames, (lower, upper], with the directory.
+    '''
+
+@contract('tasks.user_changes', bulk=True)
+def user_changes(since_usn=None, page_size=1000):
+    '''
+        Send the users changed since a USN back to django.
+    '''
+
+# the operations of apply_to_users_bulk
+BULK_USER_OPERATIONS = ('delete', 'enable', 'disable', 'force_password_reset')
+
+@contract('tasks.apply_to_users_bulk', bulk=True)
+def apply_to_users_bulk(usernames, operation):
+    '''
+        Apply one of BULK_USER_OPERATIONS to many users at once.
+    '''
+
+# tasks run by the worker of the django container, published by the samba
+# workers
+
+@contract('campus.record_result')
+def record_result(task_id, task_name, server_address, status, result, started=None, finished=None, username=''):
+    pass
+
+@contract('campus.heartbeat')
+def heartbeat(server_address, worker_hostname, queue_depth):
+    pass
+
+@contract('campus.record_drift')
+def record_drift(run_id, server_address, drifts):
+    '''
+        drifts is a list of (username, kind, details, repaired) tuples.
+    '''
+
+@contract('campus.apply_directory_changes', records={'changes': DIRECTORY_CHANGE_RECORD})
+def apply_directory_changes(server_address, changes, usn=None):
+    pass